@@ -41,6 +41,7 @@ INSTALLED_APPS = [
     'django.contrib.sessions',
     'django.contrib.messages',
     'django.contrib.staticfiles',
+    'django.contrib.postgres',
     'crispy_forms',
     "crispy_bootstrap4",
     # customised app
@@ -48,6 +49,8 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    # first, so the time of the other middleware is measured too
+    'marketplace_app.instrumentation.PerformanceMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -79,7 +82,10 @@ WSGI_APPLICATION = 'marketplace.wsgi.application'
 
 # Email confirmation ( with email confirmation )
 
-EMAIL_BACKEND = 'django.core.mail.backends.smtp.EmailBackend'
+# the backend the email queue delivers through, e.g. the console or file based
+# backend to develop without a mail server
+EMAIL_BACKEND = env('EMAIL_BACKEND', default='django.core.mail.backends.smtp.EmailBackend')
+EMAIL_FILE_PATH = env('EMAIL_FILE_PATH', default=str(BASE_DIR / 'sent_emails'))
 EMAIL_HOST = env('EMAIL_HOST')
 EMAIL_PORT = env('EMAIL_PORT')
 EMAIL_USE_TLS = env('EMAIL_USE_TLS')
@@ -87,6 +93,16 @@ EMAIL_HOST_USER = env('EMAIL_NAME')
 EMAIL_HOST_PASSWORD = env('EMAIL_PASSWORD')
 PASSWORD_RESET_TIMEOUT = 60 * 60
 
+# the emails are queued in the database and sent by the send_queued_emails worker,
+# a failed email is retried after EMAIL_QUEUE_RETRY_DELAY seconds, doubling every attempt
+EMAIL_QUEUE_MAX_ATTEMPTS = env.int('EMAIL_QUEUE_MAX_ATTEMPTS', default=5)
+EMAIL_QUEUE_RETRY_DELAY = env.int('EMAIL_QUEUE_RETRY_DELAY', default=60)
+# the seconds a worker has to send the emails it claimed, before another worker sends them again
+EMAIL_QUEUE_LEASE = env.int('EMAIL_QUEUE_LEASE', default=300)
+
+# the domain of the links in the emails sent outside of a request
+SITE_DOMAIN = env('SITE_DOMAIN', default='localhost:8000')
+
 # Database
 # https://docs.djangoproject.com/en/4.2/ref/settings/#databases
 
@@ -102,6 +118,35 @@ DATABASES = {
 }
 
 
+# Cache
+# https://docs.djangoproject.com/en/4.2/topics/cache/
+# use a shared cache such as redis://localhost:6379/0 when running more than one process
+
+CACHES = {
+    'default': env.cache('CACHE_URL', default='locmemcache://'),
+}
+
+# how long the rendered car listing pages are cached, they are invalidated as the cars change
+CAR_LISTING_CACHE_TIMEOUT = env.int('CAR_LISTING_CACHE_TIMEOUT', default=60 * 60)
+
+# how long the order stats of a dashboard are cached, they are invalidated as the orders change
+ORDER_STATS_CACHE_TIMEOUT = env.int('ORDER_STATS_CACHE_TIMEOUT', default=60 * 60)
+
+# how long a process keeps the brands, models, fuel types and transmissions before reading them again,
+# they are reloaded as soon as they change in a process sharing the cache
+LOOKUP_CACHE_TIMEOUT = env.int('LOOKUP_CACHE_TIMEOUT', default=60)
+
+
+# Performance metrics
+# the wall, database and template time, the queries and the cache hits of the
+# requests by url name, served to Prometheus at /metrics and sent in a
+# Server-Timing header. When off, the middleware removes itself from the stack.
+
+PERFORMANCE_METRICS = env.bool('PERFORMANCE_METRICS', default=False)
+# the bearer token Prometheus sends to read the metrics, the metrics are public without it
+PERFORMANCE_METRICS_TOKEN = env('PERFORMANCE_METRICS_TOKEN', default='')
+
+
 # Password validation
 # https://docs.djangoproject.com/en/4.2/ref/settings/#auth-password-validators
 
@@ -137,6 +182,24 @@ USE_TZ = True
 
 STATIC_URL = 'static/'
 
+# Uploaded files
+# the uploads are streamed to a temporary file in chunks rather than read into memory
+
+MEDIA_URL = 'media/'
+MEDIA_ROOT = env('MEDIA_ROOT', default=str(BASE_DIR / 'media'))
+FILE_UPLOAD_HANDLERS = ['django.core.files.uploadhandler.TemporaryFileUploadHandler']
+
+# the largest car image accepted, in bytes
+CAR_IMAGE_MAX_SIZE = env.int('CAR_IMAGE_MAX_SIZE', default=10 * 1024 * 1024)
+# the thumbnails generated for every car image, as the largest width and height
+CAR_IMAGE_THUMBNAIL_SIZES = {
+    'small': (160, 120),
+    'card': (480, 360),
+    'large': (1280, 960),
+}
+# the seconds a worker has to generate the thumbnails of the images it claimed, before another worker takes them
+CAR_IMAGE_THUMBNAIL_LEASE = env.int('CAR_IMAGE_THUMBNAIL_LEASE', default=300)
+
 CRISPY_ALLOWED_TEMPLATE_PACKS = "bootstrap4"
 
 CRISPY_TEMPLATE_PACK = 'bootstrap4'
@@ -145,4 +208,9 @@ CRISPY_TEMPLATE_PACK = 'bootstrap4'
 # https://docs.djangoproject.com/en/4.2/ref/settings/#default-auto-field
 
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
+
+# Car listings pagination
+CAR_LISTINGS_PAGE_SIZE = env.int('CAR_LISTINGS_PAGE_SIZE', default=20)
+CAR_LISTINGS_MAX_PAGE_SIZE = env.int('CAR_LISTINGS_MAX_PAGE_SIZE', default=100)
+
 AUTH_USER_MODEL = 'auth.User'
\ No newline at end of file
@@ -14,6 +14,8 @@ Including another URLconf
     1. Import the include() function: from django.urls import include, path
     2. Add a URL to urlpatterns:  path('blog/', include('blog.urls'))
 """
+from django.conf import settings
+from django.conf.urls.static import static
 from django.contrib import admin
 from django.urls import path, include
 
@@ -39,3 +41,6 @@ urlpatterns = [
     path('activate_email_sent', include('marketplace_app.urls')),
     path('invalid_activation', include('marketplace_app.urls')),
 ]
+
+# the uploaded images are served by the web server in production
+urlpatterns += static(settings.MEDIA_URL, document_root=settings.MEDIA_ROOT)
@@ -1,11 +1,21 @@
 from django.contrib import admin
 from django.contrib.auth.models import Group
+from django.db.models import Q
 from . import models
+from .search import keyword_search
 
 @admin.register(models.Car)
 class CarAdmin(admin.ModelAdmin):
     list_display = ['id', 'year', 'model', 'transmission', 'registration_number', 'status']
     search_fields = ['id', 'year', 'model__name', 'transmission__name', 'status']
-    list_filter = ['year', 'model', 'transmission']
+    list_filter = ['year', 'model', 'transmission', 'status']
+
+    # search the indexed search vectors rather than scanning every field with ILIKE
+    def get_search_results(self, request, queryset, search_term):
+        if not search_term:
+            return queryset, False
+        if search_term.isdigit():
+            return queryset.filter(Q(id=search_term) | Q(year=search_term)), False
+        return keyword_search(queryset, search_term), False
     
 admin.site.unregister(Group)
\ No newline at end of file
@@ -0,0 +1,176 @@
+import hashlib
+
+from django.conf import settings
+from django.db.models import F
+from django.http import JsonResponse
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date
+from django.views.decorators.http import require_POST, require_safe
+
+from .forms import CarSearchForm
+from .lookups import get_lookups, get_version
+from .models import Car, Car_Brand, Car_Model
+from .orders import OrderError, OrderForbidden, OrderNotFound, cancel_order, complete_order, place_order
+from .pagination import KeysetPaginator, get_page_size
+from .search import SEARCH_SORTS, filter_cars, keyword_search
+
+# the fields of a car in the list and search responses, read with values()
+# so no model instance is built per row
+API_CAR_FIELDS = (
+    'id', 'year', 'price', 'odometer', 'condition', 'status', 'location', 'updated_at',
+)
+API_CAR_RELATED_FIELDS = {
+    'brand_name': F('model__brand__name'),
+    'model_name': F('model__name'),
+    'fuel_type_name': F('fuel_type__name'),
+    'transmission_name': F('transmission__name'),
+}
+# the detail response also has the longer fields
+API_CAR_DETAIL_FIELDS = API_CAR_FIELDS + ('registration_number', 'description', 'prev_owner_count', 'owner_id')
+
+def car_values(queryset, fields=API_CAR_FIELDS, *extra):
+    return queryset.values(*fields, *extra, **API_CAR_RELATED_FIELDS)
+
+def make_etag(rows, *extra):
+    '''
+    A strong ETag over the ids and the update times of the cars, so it changes
+    when any car of the response changes, is added or is removed.
+    '''
+    digest = hashlib.md5()
+    for row in rows:
+        digest.update('{}:{};'.format(row['id'], row['updated_at'].isoformat()).encode())
+    for value in extra:
+        digest.update('{};'.format(value).encode())
+    return '"{}"'.format(digest.hexdigest())
+
+def conditional_json(request, data, rows, *extra, last_modified=False):
+    '''
+    A JSON response with the ETag of the cars, and their Last-Modified if
+    last_modified is set, or a 304 response if the client already has the same version.
+    Only a single car has a Last-Modified: the latest update of a list does
+    not change when a car is deleted or leaves its filters.
+    '''
+    etag = make_etag(rows, *extra)
+    latest = max((row['updated_at'] for row in rows), default=None) if last_modified else None
+    timestamp = int(latest.timestamp()) if latest else None
+
+    response = get_conditional_response(request, etag=etag, last_modified=timestamp)
+    if response is None:
+        response = JsonResponse(data)
+    response.headers['ETag'] = etag
+    if timestamp is not None:
+        response.headers['Last-Modified'] = http_date(timestamp)
+    return response
+
+def car_page(request, queryset, sort):
+    '''
+    One page of cars as dictionaries, and the cursor of the next page.
+    '''
+    ordering = SEARCH_SORTS[sort]
+    field = ordering.lstrip('-')
+    extra = (field,) if field not in API_CAR_FIELDS else ()
+
+    page_size = get_page_size(request, settings.CAR_LISTINGS_PAGE_SIZE, settings.CAR_LISTINGS_MAX_PAGE_SIZE)
+    page = KeysetPaginator(car_values(queryset, API_CAR_FIELDS, *extra), ordering, page_size).page(request.GET.get('cursor'))
+
+    rows = page.object_list
+    for row in rows:
+        for name in extra:
+            row.pop(name)
+    return rows, page.next_cursor
+
+@require_safe
+def car_list_api(request):
+    sort = request.GET.get('sort', 'newest')
+    if sort not in SEARCH_SORTS or sort == 'relevance':
+        sort = 'newest'
+
+    rows, next_cursor = car_page(request, Car.objects.all(), sort)
+    return conditional_json(request, {'results': rows, 'next_cursor': next_cursor}, rows, next_cursor)
+
+@require_safe
+def car_detail_api(request, car_id):
+    row = car_values(Car.objects.filter(pk=car_id), API_CAR_DETAIL_FIELDS).first()
+    if row is None:
+        return JsonResponse({'error': "Car not found."}, status=404)
+    return conditional_json(request, row, [row], last_modified=True)
+
+@require_safe
+def car_search_api(request):
+    form = CarSearchForm(request.GET)
+    if not form.is_valid():
+        return JsonResponse({'errors': form.errors}, status=400)
+
+    results = filter_cars(Car.objects.all(), form.cleaned_data)
+    keywords = form.cleaned_data['q']
+    if keywords:
+        results = keyword_search(results, keywords)
+
+    sort = form.cleaned_data['sort'] or ('relevance' if keywords else 'newest')
+    if sort == 'relevance' and not keywords:
+        sort = 'newest'
+
+    rows, next_cursor = car_page(request, results, sort)
+    return conditional_json(request, {'results': rows, 'next_cursor': next_cursor}, rows, next_cursor)
+
+@require_safe
+def brand_models_api(request, brand_id):
+    '''
+    The models of a brand, for the model select of the car form. The models
+    are read from the lookup cache, and the ETag is the version of the models
+    table, so a client asking again before a model changes gets a 304 response
+    without the database being queried.
+    '''
+    etag = '"{}-{}"'.format(brand_id, get_version(Car_Model))
+    response = get_conditional_response(request, etag=etag)
+    if response is None:
+        if brand_id not in get_lookups(Car_Brand):
+            return JsonResponse({'error': "Brand not found."}, status=404)
+        models = sorted(
+            (model for model in get_lookups(Car_Model).values() if model.brand_id == brand_id),
+            key=lambda model: model.name,
+        )
+        response = JsonResponse({'results': [{'id': model.pk, 'name': model.name} for model in models]})
+    response.headers['ETag'] = etag
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
+
+def order_data(order):
+    return {
+        'id': order.pk,
+        'car_id': order.car_id,
+        'buyer_id': order.buyer_id,
+        'seller_id': order.seller_id,
+        'status': order.status,
+        'order_date': order.order_date,
+        'completed_at': order.completed_at,
+    }
+
+def order_response(request, action, *args):
+    '''
+    Run an order transition for the logged in user, as a JSON response.
+    '''
+    if not request.user.is_authenticated:
+        return JsonResponse({'error': "Authentication required."}, status=401)
+    try:
+        order = action(*args)
+    except OrderNotFound as error:
+        return JsonResponse({'error': str(error)}, status=404)
+    except OrderForbidden as error:
+        return JsonResponse({'error': str(error)}, status=403)
+    except OrderError as error:
+        # the car was taken, or is being ordered by another buyer
+        return JsonResponse({'error': str(error)}, status=409)
+    return JsonResponse(order_data(order), status=201 if action is place_order else 200)
+
+@require_POST
+def order_car_api(request, car_id):
+    return order_response(request, place_order, request.user, car_id)
+
+@require_POST
+def complete_order_api(request, order_id):
+    return order_response(request, complete_order, order_id, request.user)
+
+@require_POST
+def cancel_order_api(request, order_id):
+    return order_response(request, cancel_order, order_id, request.user)
@@ -4,3 +4,7 @@ from django.apps import AppConfig
 class MarketplaceAppConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'marketplace_app'
+
+    def ready(self):
+        # connect the signal receivers
+        from . import signals
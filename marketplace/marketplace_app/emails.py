@@ -0,0 +1,96 @@
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.mail import EmailMessage, get_connection
+from django.db import transaction
+from django.utils import timezone
+
+from .models import Outbound_Email
+
+def enqueue_email(subject, message, recipient_list, from_email=None):
+    '''
+    Queue an email to be sent by the send_queued_emails worker, in place of send_mail.
+    The email is saved with the current transaction, so it is only sent if it commits.
+    '''
+    return Outbound_Email.objects.create(
+        subject=subject,
+        body=message,
+        from_email=from_email or settings.EMAIL_HOST_USER or '',
+        recipients=list(recipient_list),
+    )
+
+def enqueue_emails(messages):
+    '''
+    Queue many (subject, message, recipient_list) emails in one query.
+    '''
+    return Outbound_Email.objects.bulk_create([
+        Outbound_Email(subject=subject, body=message, from_email=settings.EMAIL_HOST_USER or '', recipients=list(recipient_list))
+        for subject, message, recipient_list in messages
+    ])
+
+def retry_delay(attempts):
+    return timedelta(seconds=settings.EMAIL_QUEUE_RETRY_DELAY * 2 ** (attempts - 1))
+
+def due_emails():
+    return Outbound_Email.objects.filter(
+        sent_at__isnull=True, send_after__lte=timezone.now(), attempts__lt=settings.EMAIL_QUEUE_MAX_ATTEMPTS,
+    )
+
+def claim_emails(batch_size):
+    '''
+    Claim a batch of the due emails for this worker, by pushing their next
+    attempt EMAIL_QUEUE_LEASE seconds back and counting the attempt, and commit,
+    so the emails are sent without holding their row locks. The emails of a
+    worker which stops before recording the outcome are sent again once the
+    lease runs out.
+    '''
+    with transaction.atomic():
+        emails = list(due_emails().select_for_update(skip_locked=True).order_by('send_after', 'id')[:batch_size])
+        for email in emails:
+            email.attempts += 1
+            email.send_after = timezone.now() + timedelta(seconds=settings.EMAIL_QUEUE_LEASE)
+        Outbound_Email.objects.bulk_update(emails, ['attempts', 'send_after'])
+    return emails
+
+def send_queued_emails(batch_size=100, connection=None):
+    '''
+    Send a batch of the queued emails that are due, over a single connection
+    to the mail server. Returns the number of emails sent.
+    A failed email is retried with an exponential backoff, until it has been
+    attempted EMAIL_QUEUE_MAX_ATTEMPTS times.
+    The batch is claimed with SKIP LOCKED before it is sent, so several workers
+    can run at once.
+    '''
+    emails = claim_emails(batch_size)
+    if not emails:
+        return 0
+
+    connection = connection or get_connection()
+    sent = 0
+    # open the connection once for the whole batch, unless the caller already did
+    opened = connection.open()
+    try:
+        for email in emails:
+            message = EmailMessage(
+                subject=email.subject,
+                body=email.body,
+                from_email=email.from_email or None,
+                to=email.recipients,
+                connection=connection,
+            )
+            try:
+                message.send()
+            except Exception as error:
+                email.last_error = '{}: {}'.format(type(error).__name__, error)
+                email.send_after = timezone.now() + retry_delay(email.attempts)
+            else:
+                email.sent_at = timezone.now()
+                email.last_error = ''
+                sent += 1
+    finally:
+        if opened:
+            connection.close()
+        # the outcome of the emails attempted before an error is kept as well
+        Outbound_Email.objects.bulk_update(emails, ['last_error', 'send_after', 'sent_at'])
+
+    return sent
@@ -0,0 +1,63 @@
+import csv
+import json
+
+from django.core.serializers.json import DjangoJSONEncoder
+
+from .models import Car
+
+# the columns of an export and the fields they are read from, the columns
+# of an import followed by the id, the owner and the last update
+EXPORT_COLUMNS = {
+    'year': 'year',
+    'registration_number': 'registration_number',
+    'status': 'status',
+    'odometer': 'odometer',
+    'price': 'price',
+    'condition': 'condition',
+    'prev_owner_count': 'prev_owner_count',
+    'location': 'location',
+    'description': 'description',
+    'brand': 'model__brand__name',
+    'model': 'model__name',
+    'fuel_type': 'fuel_type__name',
+    'transmission': 'transmission__name',
+    'id': 'id',
+    'owner': 'owner__username',
+    'updated_at': 'updated_at',
+}
+
+EXPORT_FORMATS = ('csv', 'jsonl')
+
+def export_rows(queryset=None, chunk_size=2000):
+    '''
+    The cars as tuples of the export columns, joined in one query and read
+    through a server-side cursor chunk by chunk, so the memory used does not
+    grow with the number of cars.
+    '''
+    queryset = Car.objects.all() if queryset is None else queryset
+    return queryset.order_by('id').values_list(*EXPORT_COLUMNS.values()).iterator(chunk_size=chunk_size)
+
+class Echo:
+    '''
+    A file-like object returning what is written to it, so csv.writer
+    produces one line at a time.
+    '''
+    def write(self, value):
+        return value
+
+def csv_lines(rows):
+    writer = csv.writer(Echo())
+    yield writer.writerow(EXPORT_COLUMNS)
+    for row in rows:
+        yield writer.writerow(row)
+
+def jsonl_lines(rows):
+    for row in rows:
+        yield json.dumps(dict(zip(EXPORT_COLUMNS, row)), cls=DjangoJSONEncoder) + '\n'
+
+def export_lines(format, queryset=None, chunk_size=2000):
+    '''
+    The lines of a CSV or JSON lines export of the cars, generated as they are read.
+    '''
+    rows = export_rows(queryset, chunk_size)
+    return csv_lines(rows) if format == 'csv' else jsonl_lines(rows)
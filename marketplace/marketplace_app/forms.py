@@ -1,9 +1,13 @@
 from django import forms
+from django.conf import settings
 from django.contrib.auth.forms import UserCreationForm
 from django.contrib.auth.models import User
 from django.core.exceptions import ValidationError  
+from django.urls import reverse
+from django.utils.functional import cached_property
 from .models import User_Detail
 
+from .lookups import get_lookups
 from .models import Car, Car_Brand, Car_Model, Car_File, Fuel_Type, Transmission_Type, User_Detail, Listing
 
 class ResetPasswordForm(forms.Form):
@@ -117,10 +121,94 @@ class SignupForm(UserCreationForm):
             raise ValidationError("Password don't match")  
         return password2   
 
+class CachedModelChoiceIterator(forms.models.ModelChoiceIterator):
+    '''
+    The choices of a lookup table, from the in-process lookup cache instead of a query.
+    The field makes an iterator every time its choices are used, so the rows
+    are read once per iterator, whether it is iterated, counted or tested.
+    '''
+    @cached_property
+    def lookup_rows(self):
+        return list(get_lookups(self.queryset.model).values())
+
+    def rows(self):
+        return self.lookup_rows
+
+    def __iter__(self):
+        if self.field.empty_label is not None:
+            yield ("", self.field.empty_label)
+        for obj in self.rows():
+            yield self.choice(obj)
+
+    def __len__(self):
+        return len(self.rows()) + (1 if self.field.empty_label is not None else 0)
+
+    def __bool__(self):
+        return self.field.empty_label is not None or bool(self.rows())
+
+class BrandModelChoiceIterator(CachedModelChoiceIterator):
+    '''
+    The models of the brand chosen on the form only, the browser loads the
+    models of another brand when it is chosen.
+    '''
+    def rows(self):
+        return [model for model in super().rows() if model.brand_id == self.field.brand_id]
+
+class CachedModelChoiceField(forms.ModelChoiceField):
+    '''
+    A choice of a brand, model, fuel type or transmission, rendered and
+    validated from the in-process lookup cache.
+    '''
+    iterator = CachedModelChoiceIterator
+
+    def to_python(self, value):
+        if value in self.empty_values:
+            return None
+        try:
+            return get_lookups(self.queryset.model)[int(getattr(value, 'pk', value))]
+        except (KeyError, ValueError, TypeError):
+            # not cached yet, or invalid
+            return super().to_python(value)
+
 class CarForm(forms.ModelForm):
     '''
-    The form to create a new car
+    The form to create a new car.
+    With lazy_models, the model select only lists the models of the chosen
+    brand, and the others are loaded from the api when the brand changes.
     '''
+    brand = CachedModelChoiceField(queryset=Car_Brand.objects.all(), required=False)
+
+    def __init__(self, *args, lazy_models=False, **kwargs):
+        super().__init__(*args, **kwargs)
+        if lazy_models and 'model' in self.fields:
+            field = self.fields['model']
+            field.brand_id = self.get_brand_id()
+            field.iterator = BrandModelChoiceIterator
+            field.widget.choices = field.choices
+            field.widget.attrs['data-models-url'] = reverse('api_brand_models', args=[0])
+            self.fields['brand'].widget.attrs['data-model-select'] = field.widget.attrs.get('id', 'id_model')
+
+    def get_brand_id(self):
+        '''
+        The brand chosen on the form, or the brand of the car being edited.
+        '''
+        if self.is_bound:
+            try:
+                return int(self.data.get(self.add_prefix('brand')))
+            except (TypeError, ValueError):
+                return None
+        if self.instance.model_id is not None:
+            return get_lookups(Car_Model)[self.instance.model_id].brand_id
+        return None
+
+    def clean(self):
+        cleaned_data = super().clean()
+        brand = cleaned_data.get('brand')
+        model = cleaned_data.get('model')
+        if brand is not None and model is not None and model.brand_id != brand.pk:
+            self.add_error('model', "The model is not a model of the chosen brand.")
+        return cleaned_data
+
     class Meta:
         model = Car
         fields = (
@@ -141,7 +229,64 @@ class CarForm(forms.ModelForm):
             'fuel_type': 'Fuel type',
             'prev_owner_count': 'The number of previous owners'
         }
+        field_classes = {
+            'model': CachedModelChoiceField,
+            'fuel_type': CachedModelChoiceField,
+            'transmission': CachedModelChoiceField,
+        }
     
+class CarImportForm(CarForm):
+    '''
+    The form to validate a row of a car import, with the rules of CarForm.
+    The model, fuel type and transmission are resolved by name by the importer.
+    '''
+    brand = None
+
+    class Meta(CarForm.Meta):
+        fields = tuple(field for field in CarForm.Meta.fields if field not in ('model', 'fuel_type', 'transmission'))
+
+class CarImportUploadForm(forms.Form):
+    '''
+    The form to upload a CSV or JSON lines file of cars
+    '''
+    file = forms.FileField(help_text="A .csv file with a header row, or a .jsonl file with one car per line.")
+    create_lookups = forms.BooleanField(required=False, label="Create the brands, models, fuel types and transmissions not found")
+
+    def clean_file(self):
+        file = self.cleaned_data['file']
+        if not file.name.lower().endswith(('.csv', '.jsonl')):
+            raise ValidationError("The file must be a .csv or a .jsonl file.")
+        return file
+
+class MultipleImageInput(forms.ClearableFileInput):
+    allow_multiple_selected = True
+
+class MultipleImageField(forms.ImageField):
+    '''
+    An image field taking several files, each validated as an image.
+    '''
+    def __init__(self, *args, **kwargs):
+        kwargs.setdefault('widget', MultipleImageInput(attrs={'accept': 'image/*'}))
+        super().__init__(*args, **kwargs)
+
+    def clean(self, data, initial=None):
+        if isinstance(data, (list, tuple)):
+            return [super(MultipleImageField, self).clean(image, initial) for image in data]
+        return [super().clean(data, initial)]
+
+class CarImageUploadForm(forms.Form):
+    '''
+    The form to upload the images of a car
+    '''
+    images = MultipleImageField()
+
+    def clean_images(self):
+        images = self.cleaned_data['images']
+        for image in images:
+            if image.size > settings.CAR_IMAGE_MAX_SIZE:
+                raise ValidationError("{} is larger than {} MB.".format(image.name, settings.CAR_IMAGE_MAX_SIZE // (1024 * 1024)))
+        return images
+
 class CarModelForm(forms.ModelForm):
     '''
     The form to create a new model.
@@ -152,6 +297,9 @@ class CarModelForm(forms.ModelForm):
             'brand',
             'name',
         )
+        field_classes = {
+            'brand': CachedModelChoiceField,
+        }
 
 class CarBrandForm(forms.ModelForm):
     '''
@@ -183,6 +331,47 @@ class FuelForm(forms.ModelForm):
             'name',
         )
 
+class CarSearchForm(forms.Form):
+    '''
+    The form to filter and sort the car search results
+    '''
+    SORT_CHOICES = [
+        ('relevance', 'Relevance'),
+        ('newest', 'Newest'),
+        ('price', 'Price: low to high'),
+        ('-price', 'Price: high to low'),
+        ('year', 'Year: oldest first'),
+        ('-year', 'Year: newest first'),
+        ('odometer', 'Odometer: lowest first'),
+        ('-odometer', 'Odometer: highest first'),
+    ]
+
+    q = forms.CharField(label='Keywords', max_length=200, required=False)
+    brand = CachedModelChoiceField(queryset=Car_Brand.objects.all(), required=False)
+    model = CachedModelChoiceField(queryset=Car_Model.objects.all(), required=False)
+    year_min = forms.IntegerField(label='Year from', required=False)
+    year_max = forms.IntegerField(label='Year to', required=False)
+    price_min = forms.FloatField(label='Price from', required=False, min_value=0)
+    price_max = forms.FloatField(label='Price to', required=False, min_value=0)
+    odometer_min = forms.IntegerField(label='Odometer from', required=False, min_value=0)
+    odometer_max = forms.IntegerField(label='Odometer to', required=False, min_value=0)
+    fuel_type = CachedModelChoiceField(label='Fuel type', queryset=Fuel_Type.objects.all(), required=False)
+    transmission = CachedModelChoiceField(queryset=Transmission_Type.objects.all(), required=False)
+    condition = forms.ChoiceField(choices=[('', '---------')] + Car.CAR_CONDITION, required=False)
+    status = forms.ChoiceField(choices=[('', '---------')] + Car.CAR_STATUS, required=False)
+    location = forms.CharField(max_length=100, required=False)
+    sort = forms.ChoiceField(choices=SORT_CHOICES, required=False)
+
+    # checks the minimum of every range is not greater than its maximum
+    def clean(self):
+        cleaned_data = super().clean()
+        for field in ('year', 'price', 'odometer'):
+            minimum = cleaned_data.get(field + '_min')
+            maximum = cleaned_data.get(field + '_max')
+            if minimum is not None and maximum is not None and minimum > maximum:
+                raise ValidationError("The minimum {} cannot be greater than the maximum {}.".format(field, field))
+        return cleaned_data
+
 class UserUpdateForm(forms.ModelForm):
     # username = forms.CharField()
     email = forms.EmailField()
@@ -0,0 +1,155 @@
+import hashlib
+import io
+import os
+from datetime import timedelta
+
+from django.conf import settings
+from django.contrib.postgres.expressions import ArraySubquery
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.db import transaction
+from django.db.models import OuterRef, Q, Subquery
+from django.utils import timezone
+from PIL import Image, ImageOps
+
+from .models import Car_File
+
+# the thumbnails are always stored as JPEG
+THUMBNAIL_FORMAT = 'JPEG'
+THUMBNAIL_QUALITY = 85
+
+def image_name(sha256, extension):
+    # named by their content, so an image uploaded twice is stored once
+    return 'car_images/{}/{}{}'.format(sha256[:2], sha256, extension.lower())
+
+def thumbnail_name(sha256, size):
+    return 'car_images/thumbnails/{}/{}/{}.jpg'.format(size, sha256[:2], sha256)
+
+def hash_file(file):
+    '''
+    The SHA-256 of a file, read in chunks, e.g. from the temporary file of an upload.
+    '''
+    digest = hashlib.sha256()
+    for chunk in file.chunks():
+        digest.update(chunk)
+    file.seek(0)
+    return digest.hexdigest()
+
+def save_car_image(car, upload):
+    '''
+    Attach an uploaded image to a car. The file is stored under its hash,
+    unless a file with the same content is already stored, and the image is
+    queued for its thumbnails unless they were generated for the same content.
+    Returns the Car_File and whether it was created.
+    '''
+    sha256 = hash_file(upload)
+    name = image_name(sha256, os.path.splitext(upload.name)[1])
+    if not default_storage.exists(name):
+        name = default_storage.save(name, upload)
+
+    previous = Car_File.objects.filter(sha256=sha256, thumbnailed_at__isnull=False).first()
+    return Car_File.objects.get_or_create(car=car, sha256=sha256, defaults={
+        'file': name,
+        'thumbnailed_at': previous.thumbnailed_at if previous else None,
+        'thumbnail_error': previous.thumbnail_error if previous else '',
+    })
+
+def make_thumbnails(car_file):
+    '''
+    Write the thumbnails of every size of an image, skipping the ones already
+    written for the same content.
+    '''
+    if not car_file.sha256:
+        # the files uploaded before the images were hashed
+        with car_file.file.open('rb'):
+            car_file.sha256 = hash_file(car_file.file)
+
+    names = {size: thumbnail_name(car_file.sha256, size) for size in settings.CAR_IMAGE_THUMBNAIL_SIZES}
+    missing = [size for size, name in names.items() if not default_storage.exists(name)]
+    if not missing:
+        return
+
+    with car_file.file.open('rb') as file, Image.open(file) as image:
+        # the phone photos are rotated by their EXIF orientation
+        image = ImageOps.exif_transpose(image).convert('RGB')
+        for size in missing:
+            thumbnail = image.copy()
+            thumbnail.thumbnail(settings.CAR_IMAGE_THUMBNAIL_SIZES[size], Image.Resampling.LANCZOS)
+            buffer = io.BytesIO()
+            thumbnail.save(buffer, THUMBNAIL_FORMAT, quality=THUMBNAIL_QUALITY, optimize=True)
+            default_storage.save(names[size], ContentFile(buffer.getvalue()))
+
+def claim_car_files(batch_size):
+    '''
+    Claim the oldest images waiting for their thumbnails for this worker, by
+    leasing them for CAR_IMAGE_THUMBNAIL_LEASE seconds, and commit, so the
+    thumbnails are generated without holding the row locks. The images of a
+    worker which stops before recording the outcome are taken by another one
+    once the lease runs out.
+    '''
+    now = timezone.now()
+    with transaction.atomic():
+        car_files = list(
+            Car_File.objects.select_for_update(skip_locked=True)
+            .filter(Q(thumbnail_claimed_until__isnull=True) | Q(thumbnail_claimed_until__lte=now), thumbnailed_at__isnull=True)
+            .order_by('id')[:batch_size]
+        )
+        Car_File.objects.filter(pk__in=[car_file.pk for car_file in car_files]).update(
+            thumbnail_claimed_until=now + timedelta(seconds=settings.CAR_IMAGE_THUMBNAIL_LEASE),
+        )
+    return car_files
+
+def generate_thumbnails(batch_size=20):
+    '''
+    Generate the thumbnails of the oldest images waiting for them. The images
+    are claimed with SKIP LOCKED before they are read, so several workers can
+    share the queue. Returns the number of images processed.
+    '''
+    car_files = claim_car_files(batch_size)
+    for car_file in car_files:
+        try:
+            make_thumbnails(car_file)
+        except Exception as error:
+            # Pillow raises an OSError for the files that are not images, but a damaged image may
+            # raise anything, and is recorded rather than retried by every batch
+            car_file.thumbnail_error = '{}: {}'.format(type(error).__name__, error)[:255]
+        car_file.thumbnailed_at = timezone.now()
+    # the cached car listings are keyed on their ready images, so they need no invalidation
+    Car_File.objects.bulk_update(car_files, ['sha256', 'thumbnailed_at', 'thumbnail_error'])
+    return len(car_files)
+
+def ready_images():
+    return Car_File.objects.filter(thumbnailed_at__isnull=False, thumbnail_error='').order_by('id')
+
+def with_cover_image(cars):
+    '''
+    Annotate the cars with the hash of their first image with thumbnails,
+    read by a subquery in the same query as the cars.
+    '''
+    return cars.annotate(cover_image=Subquery(ready_images().filter(car=OuterRef('pk')).values('sha256')[:1]))
+
+def with_images(cars):
+    '''
+    Annotate the cars with the hashes of their images with thumbnails, in order,
+    gathered into an array by the same query as the cars.
+    '''
+    return cars.annotate(images=ArraySubquery(ready_images().filter(car=OuterRef('pk')).values('sha256')))
+
+def with_image_ids(cars):
+    '''
+    Annotate the cars with the ids of their images with thumbnails, in order,
+    gathered into an array by the same query as the cars.
+    '''
+    return cars.annotate(image_ids=ArraySubquery(ready_images().filter(car=OuterRef('pk')).values('id')))
+
+def delete_car_image(name, sha256):
+    '''
+    Delete a stored image and its thumbnails once no car uses its content.
+    '''
+    if sha256 and Car_File.objects.filter(sha256=sha256).exists():
+        return
+    if name:
+        default_storage.delete(name)
+    if sha256:
+        for size in settings.CAR_IMAGE_THUMBNAIL_SIZES:
+            default_storage.delete(thumbnail_name(sha256, size))
@@ -0,0 +1,178 @@
+import codecs
+import csv
+import json
+
+from django.db import transaction
+
+from .forms import CarImportForm
+from .matching import invalidate_matches, matching_user_ids_by_car
+from .models import Car, Car_Brand, Car_Model, Fuel_Type, Transmission_Type
+from .notifications import notify_new_matches
+from .search import update_search_vectors
+
+# the columns naming the lookup rows of a car, the other columns are the fields of CarImportForm
+LOOKUP_COLUMNS = ('brand', 'model', 'fuel_type', 'transmission')
+
+IMPORT_FORMATS = ('csv', 'jsonl')
+
+class ImportReport:
+    '''
+    The outcome of an import: the number of cars created, the errors of the
+    skipped rows, and the last line read and the error when the rest of the
+    file could not be read.
+    '''
+    def __init__(self):
+        self.created = 0
+        self.errors = []
+        self.stopped = None
+
+    def add_error(self, line, message):
+        self.errors.append((line, message))
+
+    def stop(self, line, error):
+        self.stopped = (line, "{}: {}".format(type(error).__name__, error))
+
+class LookupCache:
+    '''
+    Resolve the brands, models, fuel types and transmissions of the imported rows
+    by name, through their natural key managers. Every name is looked up once
+    per import, including the names that are not found.
+    '''
+    def __init__(self, create=False):
+        self.create = create
+        self.cache = {}
+
+    def get(self, model, key):
+        if (model, key) not in self.cache:
+            self.cache[model, key] = self.load(model, key)
+        return self.cache[model, key]
+
+    def load(self, model, key):
+        try:
+            if model is Car_Model:
+                # a model name is only unique within its brand
+                brand, name = key
+                return Car_Model.objects.get_by_natural_key(brand.name, name)
+            return model.objects.get_by_natural_key(key)
+        except model.DoesNotExist:
+            if not self.create:
+                return None
+            if model is Car_Model:
+                return Car_Model.objects.create(brand=key[0], name=key[1])
+            return model.objects.create(name=key)
+        except model.MultipleObjectsReturned:
+            return None
+
+    def resolve(self, row):
+        '''
+        The lookup rows of a car, and the errors of the names not found.
+        '''
+        names = {column: (row.get(column) or '').strip() for column in LOOKUP_COLUMNS}
+        errors = ["The {} is required.".format(column.replace('_', ' ')) for column, name in names.items() if not name]
+        if errors:
+            return None, errors
+
+        brand = self.get(Car_Brand, names['brand'])
+        lookups = {
+            'model': self.get(Car_Model, (brand, names['model'])) if brand else None,
+            'fuel_type': self.get(Fuel_Type, names['fuel_type']),
+            'transmission': self.get(Transmission_Type, names['transmission']),
+        }
+        if brand is None:
+            errors.append("Unknown brand \"{}\".".format(names['brand']))
+        for column, value in lookups.items():
+            if value is None and (brand is not None or column != 'model'):
+                errors.append("Unknown {} \"{}\".".format(column.replace('_', ' '), names[column]))
+        return lookups, errors
+
+def read_rows(lines, format):
+    '''
+    Parse the lines of a CSV file with a header row, or of a JSON lines file,
+    one row at a time. Yields the line number and the row, or an error message.
+    '''
+    if format == 'csv':
+        reader = csv.DictReader(lines)
+        for row in reader:
+            yield reader.line_num, row, None
+    else:
+        for line_number, line in enumerate(lines, start=1):
+            if not line.strip():
+                continue
+            try:
+                row = json.loads(line)
+            except ValueError as error:
+                yield line_number, None, "Invalid JSON: {}".format(error)
+                continue
+            if not isinstance(row, dict):
+                yield line_number, None, "Each line must be a JSON object."
+                continue
+            yield line_number, row, None
+
+def decode_lines(binary_lines):
+    '''
+    Decode the lines of an uploaded or opened binary file as they are read.
+    '''
+    return codecs.iterdecode(binary_lines, 'utf-8-sig')
+
+def save_cars(cars):
+    '''
+    Insert a chunk of cars in one query, and do what the Car signals would
+    have done for each of them: index them for the search, and match them
+    against the buyers' preferences. The whole chunk is indexed, matched and
+    notified by a few queries, whatever its size.
+    '''
+    with transaction.atomic():
+        Car.objects.bulk_create(cars)
+        update_search_vectors(car_ids=[car.pk for car in cars])
+
+        matches = matching_user_ids_by_car(cars)
+        notify_new_matches(cars, matches)
+        user_ids = set().union(*matches.values())
+        transaction.on_commit(lambda: invalidate_matches(user_ids))
+
+def import_cars(lines, format, owner, chunk_size=500, create_lookups=False):
+    '''
+    Import the cars of a CSV or JSON lines file for an owner. The rows are
+    validated with the CarForm rules and saved in chunks, a row with errors
+    is reported and skipped without aborting the rest of the import. A file
+    which cannot be decoded or parsed past a line stops the import there, the
+    cars read until then are still imported and the report says where it stopped.
+    '''
+    report = ImportReport()
+    lookups = LookupCache(create=create_lookups)
+    chunk = []
+    line = 0
+
+    try:
+        for line, row, error in read_rows(lines, format):
+            if error:
+                report.add_error(line, error)
+                continue
+
+            form = CarImportForm(data=row)
+            related, errors = lookups.resolve(row)
+            if not form.is_valid():
+                errors = ["{}: {}".format(field, ' '.join(messages)) for field, messages in form.errors.items()] + errors
+            if errors:
+                report.add_error(line, ' '.join(errors))
+                continue
+
+            car = form.save(commit=False)
+            car.owner = owner
+            car.model = related['model']
+            car.fuel_type = related['fuel_type']
+            car.transmission = related['transmission']
+            chunk.append(car)
+
+            if len(chunk) >= chunk_size:
+                save_cars(chunk)
+                report.created += len(chunk)
+                chunk = []
+    except (csv.Error, UnicodeDecodeError) as error:
+        # the chunks saved before are committed already, so the import is reported rather than raised
+        report.stop(line, error)
+
+    if chunk:
+        save_cars(chunk)
+        report.created += len(chunk)
+    return report
@@ -0,0 +1,245 @@
+import bisect
+import os
+import threading
+import time
+from contextlib import ExitStack
+from contextvars import ContextVar
+
+from django.conf import settings
+from django.core.cache import caches
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import connections
+from django.template.base import Template
+
+# the upper bounds of the request duration histogram, in seconds
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+# the timings of the request being served by this thread or task
+_current = ContextVar('request_timings', default=None)
+
+# a value no cache ever stores, to tell a miss from a cached None
+_MISSING = object()
+
+# the methods recorded by name, the others are recorded together so a client
+# cannot add a time series per method it makes up
+METHODS = {'GET', 'HEAD', 'POST', 'PUT', 'PATCH', 'DELETE', 'OPTIONS'}
+
+class RequestTimings:
+    '''
+    The database, template and cache work of one request.
+    '''
+    def __init__(self):
+        self.db_time = 0
+        self.queries = 0
+        self.template_time = 0
+        self.template_depth = 0
+        self.cache_hits = 0
+        self.cache_misses = 0
+        # the base get_many reads each key with get, which then counts nothing
+        self.reading_many = False
+
+    def time_query(self, execute, sql, params, many, context):
+        # a connection execute wrapper, see connection.execute_wrapper
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.db_time += time.perf_counter() - start
+            self.queries += 1
+
+class ViewMetrics:
+    '''
+    The totals of the requests served by a view with a method, since the process started.
+    '''
+    def __init__(self):
+        self.statuses = {}
+        self.buckets = [0] * len(DURATION_BUCKETS)
+        self.count = 0
+        self.duration = 0
+        self.db_time = 0
+        self.queries = 0
+        self.template_time = 0
+        self.cache_hits = 0
+        self.cache_misses = 0
+
+    def add(self, status, duration, timings):
+        self.statuses[status] = self.statuses.get(status, 0) + 1
+        # the buckets are cumulative when rendered, each request is counted in its smallest one
+        bucket = bisect.bisect_left(DURATION_BUCKETS, duration)
+        if bucket < len(self.buckets):
+            self.buckets[bucket] += 1
+        self.count += 1
+        self.duration += duration
+        self.db_time += timings.db_time
+        self.queries += timings.queries
+        self.template_time += timings.template_time
+        self.cache_hits += timings.cache_hits
+        self.cache_misses += timings.cache_misses
+
+# the metrics of this process by (url name, method), each worker process keeps its own
+_metrics = {}
+_lock = threading.Lock()
+
+def record_request(view, method, status, duration, timings):
+    with _lock:
+        _metrics.setdefault((view, method), ViewMetrics()).add(status, duration, timings)
+
+def reset_metrics():
+    with _lock:
+        _metrics.clear()
+
+def escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def render_metrics():
+    '''
+    The metrics of this process in the Prometheus text format. Every series
+    is labelled with the pid of the process, so the series of the workers of
+    a server are told apart rather than mixed, and are summed over the pid by
+    the queries.
+    '''
+    # read when rendered, as the workers are forked after this module is imported
+    pid = [('pid', os.getpid())]
+    with _lock:
+        metrics = sorted(_metrics.items())
+        lines = []
+
+        def family(name, kind, help, samples):
+            lines.append('# HELP {} {}'.format(name, help))
+            lines.append('# TYPE {} {}'.format(name, kind))
+            for suffix, labels, value in samples:
+                rendered = ','.join('{}="{}"'.format(label, escape_label(label_value)) for label, label_value in pid + labels)
+                lines.append('{}{}{{{}}} {}'.format(name, suffix, rendered, value))
+
+        def totals(attribute):
+            return [('', [('view', view), ('method', method)], getattr(view_metrics, attribute)) for (view, method), view_metrics in metrics]
+
+        family('marketplace_requests_total', 'counter', "The requests served, by url name, method and status.", [
+            ('', [('view', view), ('method', method), ('status', status)], count)
+            for (view, method), view_metrics in metrics
+            for status, count in sorted(view_metrics.statuses.items())
+        ])
+
+        durations = []
+        for (view, method), view_metrics in metrics:
+            labels = [('view', view), ('method', method)]
+            cumulative = 0
+            for bound, count in zip(DURATION_BUCKETS, view_metrics.buckets):
+                cumulative += count
+                durations.append(('_bucket', labels + [('le', bound)], cumulative))
+            durations.append(('_bucket', labels + [('le', '+Inf')], view_metrics.count))
+            durations.append(('_sum', labels, view_metrics.duration))
+            durations.append(('_count', labels, view_metrics.count))
+        family('marketplace_request_duration_seconds', 'histogram', "The wall time of the requests.", durations)
+
+        family('marketplace_db_duration_seconds_total', 'counter', "The time spent running database queries.", totals('db_time'))
+        family('marketplace_db_queries_total', 'counter', "The database queries run.", totals('queries'))
+        family('marketplace_template_duration_seconds_total', 'counter', "The time spent rendering templates.", totals('template_time'))
+        family('marketplace_cache_hits_total', 'counter', "The cache reads finding their key.", totals('cache_hits'))
+        family('marketplace_cache_misses_total', 'counter', "The cache reads missing their key.", totals('cache_misses'))
+    return '\n'.join(lines) + '\n'
+
+def instrument_templates():
+    '''
+    Time the rendering of the templates. An included template is rendered
+    within its parent, so only the outermost render is added.
+    '''
+    if getattr(Template.render, 'instrumented', False):
+        return
+    render = Template.render
+
+    def timed_render(self, context):
+        timings = _current.get()
+        if timings is None:
+            return render(self, context)
+        timings.template_depth += 1
+        start = time.perf_counter()
+        try:
+            return render(self, context)
+        finally:
+            timings.template_depth -= 1
+            if not timings.template_depth:
+                timings.template_time += time.perf_counter() - start
+
+    timed_render.instrumented = True
+    Template.render = timed_render
+
+def instrument_cache(cache_class):
+    '''
+    Count the hits and misses of the reads of a cache backend.
+    '''
+    if getattr(cache_class.get, 'instrumented', False):
+        return
+    get = cache_class.get
+    get_many = cache_class.get_many
+
+    def counted_get(self, key, default=None, version=None):
+        timings = _current.get()
+        if timings is None or timings.reading_many:
+            return get(self, key, default, version)
+        value = get(self, key, _MISSING, version)
+        if value is _MISSING:
+            timings.cache_misses += 1
+            return default
+        timings.cache_hits += 1
+        return value
+
+    def counted_get_many(self, keys, version=None):
+        timings = _current.get()
+        if timings is None or timings.reading_many:
+            return get_many(self, keys, version)
+        keys = list(keys)
+        timings.reading_many = True
+        try:
+            values = get_many(self, keys, version)
+        finally:
+            timings.reading_many = False
+        timings.cache_hits += len(values)
+        timings.cache_misses += len(keys) - len(values)
+        return values
+
+    counted_get.instrumented = True
+    cache_class.get = counted_get
+    cache_class.get_many = counted_get_many
+
+def server_timing(duration, timings):
+    return 'total;dur={:.1f}, db;dur={:.1f};desc="{} queries", template;dur={:.1f}, cache;desc="{} hits {} misses"'.format(
+        duration * 1000, timings.db_time * 1000, timings.queries,
+        timings.template_time * 1000, timings.cache_hits, timings.cache_misses,
+    )
+
+class PerformanceMiddleware:
+    '''
+    Record the wall time, the database time and queries, the template time and
+    the cache hits and misses of every request by url name, for the metrics
+    view, and send them in a Server-Timing header. Unless PERFORMANCE_METRICS
+    is set, the middleware removes itself and nothing is instrumented.
+    '''
+    def __init__(self, get_response):
+        if not settings.PERFORMANCE_METRICS:
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+        instrument_templates()
+        for alias in settings.CACHES:
+            instrument_cache(type(caches[alias]))
+
+    def __call__(self, request):
+        timings = RequestTimings()
+        token = _current.set(timings)
+        start = time.perf_counter()
+        try:
+            with ExitStack() as stack:
+                for connection in connections.all():
+                    stack.enter_context(connection.execute_wrapper(timings.time_query))
+                response = self.get_response(request)
+        finally:
+            _current.reset(token)
+        # a streamed response is timed until its first chunk is ready
+        duration = time.perf_counter() - start
+
+        match = getattr(request, 'resolver_match', None)
+        view = match.view_name if match is not None else 'unresolved'
+        method = request.method if request.method in METHODS else 'OTHER'
+        record_request(view, method, response.status_code, duration, timings)
+        response['Server-Timing'] = server_timing(duration, timings)
+        return response
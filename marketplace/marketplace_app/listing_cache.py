@@ -0,0 +1,42 @@
+import hashlib
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+
+# the version shared by every car, changed when a brand, model, fuel type or transmission changes
+GENERATION_KEY = 'car_listing_generation'
+
+def car_version_key(car_id):
+    return 'car_listing_version:{}'.format(car_id)
+
+def new_version():
+    return '{:x}'.format(time.time_ns())
+
+def car_listing_cache_key(car_id, updated_at, image_ids=()):
+    '''
+    The cache key of the rendered car listing, made of the version of the car,
+    the generation of the lookups, the last change of the car and the ids of
+    the images shown. A missing version is replaced by a new unique one rather
+    than restarting from a number, so a fragment cached under an evicted version
+    is never served again. The last change and the images are read from the
+    database by the caller, as the car may be edited and its thumbnails made
+    by a process which does not share the cache.
+    '''
+    keys = [car_version_key(car_id), GENERATION_KEY]
+    versions = cache.get_many(keys)
+    for key in keys:
+        if key not in versions:
+            # the versions expire with the fragments keyed on them
+            cache.add(key, new_version(), settings.CAR_LISTING_CACHE_TIMEOUT)
+            versions[key] = cache.get(key)
+    images = hashlib.sha1(','.join(str(image_id) for image_id in image_ids).encode()).hexdigest()
+    return 'car_listing:{}:{}:{}:{:x}:{}'.format(
+        car_id, *(versions[key] for key in keys), int(updated_at.timestamp() * 1000000), images,
+    )
+
+def invalidate_car_listings(car_ids):
+    cache.delete_many([car_version_key(car_id) for car_id in car_ids])
+
+def invalidate_all_car_listings():
+    cache.delete(GENERATION_KEY)
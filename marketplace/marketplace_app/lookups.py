@@ -0,0 +1,82 @@
+import copy
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+
+# the rows of the lookup tables loaded by this process, by model: (version, rows by id, rows by natural key)
+_loaded = {}
+
+def version_key(model):
+    return 'lookup_version:{}'.format(model._meta.label_lower)
+
+def get_version(model):
+    '''
+    The shared version of a lookup table. A missing version is replaced by a new
+    unique one, so every process reloads the table after it was evicted.
+    The version expires after LOOKUP_CACHE_TIMEOUT, so a table changed by a
+    process not sharing the cache, such as a command run under the default
+    local memory cache, is reloaded within that time.
+    '''
+    key = version_key(model)
+    version = cache.get(key)
+    if version is None:
+        cache.add(key, '{:x}'.format(time.time_ns()), settings.LOOKUP_CACHE_TIMEOUT)
+        version = cache.get(key)
+    return version
+
+def natural_key_fields(model):
+    # a model is shown and found with its brand
+    if any(field.name == 'brand' for field in model._meta.fields):
+        return ('brand__name', 'name')
+    return ('name',)
+
+def lookup_value(row, path):
+    # follow the related rows of a path like brand__name, loaded with the row
+    for field in path.split('__'):
+        row = getattr(row, field)
+    return row
+
+def load_lookups(model):
+    '''
+    The loaded rows of a lookup table, reloaded when its shared version
+    changes, which any process saving or deleting one of its rows does.
+    '''
+    version = get_version(model)
+    loaded = _loaded.get(model)
+    if loaded is None or loaded[0] != version:
+        fields = natural_key_fields(model)
+        queryset = model._default_manager.order_by('pk')
+        if 'brand__name' in fields:
+            queryset = queryset.select_related('brand')
+        rows = {row.pk: row for row in queryset}
+        loaded = (version, rows, {tuple(lookup_value(row, path) for path in fields): row for row in rows.values()})
+        _loaded[model] = loaded
+    return loaded
+
+def get_lookups(model):
+    '''
+    The rows of a lookup table by id, from the memory of this process.
+    The rows are read from the cache on every call but from the database
+    only after a change. Each call gets its own copies of the rows, so a
+    caller changing one does not change it for the others.
+    '''
+    return {pk: copy.copy(row) for pk, row in load_lookups(model)[1].items()}
+
+def get_lookup(model, *natural_key):
+    '''
+    Find one row of a lookup table in memory by its natural key, like
+    model.objects.get_by_natural_key(). The database is queried when the row
+    is not found, as it may have been added by a transaction not yet committed.
+    '''
+    row = load_lookups(model)[2].get(natural_key)
+    if row is not None:
+        return copy.copy(row)
+    return model._default_manager.get(**dict(zip(natural_key_fields(model), natural_key)))
+
+def invalidate_lookups(model):
+    '''
+    Make every process reload a lookup table, this one straight away.
+    '''
+    _loaded.pop(model, None)
+    cache.delete(version_key(model))
@@ -0,0 +1,131 @@
+import random
+import re
+
+from django.contrib.auth.hashers import make_password
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+
+from marketplace_app.models import Car, Car_Brand, Car_Model, Fuel_Type, Transmission_Type
+
+SCAN_PATTERN = re.compile(r'(Seq Scan|Index Only Scan(?: Backward)?|Index Scan(?: Backward)?|Bitmap Index Scan)(?: using (\S+))? on (\S+)')
+EXECUTION_TIME_PATTERN = re.compile(r'Execution Time: ([\d.]+) ms')
+
+# each location is a city followed by a suburb number
+LOCATIONS = ['Sydney', 'Melbourne', 'Brisbane', 'Perth', 'Adelaide', 'Hobart', 'Darwin', 'Canberra', 'Newcastle', 'Geelong']
+
+class Command(BaseCommand):
+    help = (
+        "Seed a large Car table inside a transaction and compare the EXPLAIN ANALYZE plans "
+        "of the hot car queries without and with the Car indexes. "
+        "Everything is rolled back at the end, so the database is left untouched."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rows', type=int, default=1000000, help="The number of cars to seed.")
+        parser.add_argument('--seed', type=int, default=42, help="The random seed of the generated data.")
+
+    def handle(self, *args, **options):
+        self.verbosity = options['verbosity']
+        with transaction.atomic():
+            owner_id, model_id = self.seed(options['rows'], options['seed'])
+            queries = self.get_queries(owner_id, model_id)
+
+            # explain every query without the indexes, then restore them
+            with transaction.atomic():
+                with connection.cursor() as cursor:
+                    for index in Car._meta.indexes:
+                        cursor.execute('DROP INDEX {}'.format(connection.ops.quote_name(index.name)))
+                without_indexes = {name: queryset.explain(analyze=True) for name, queryset in queries.items()}
+                transaction.set_rollback(True)
+
+            with_indexes = {name: queryset.explain(analyze=True) for name, queryset in queries.items()}
+
+            for name in queries:
+                self.stdout.write(self.style.MIGRATE_HEADING(name))
+                self.report('without indexes', without_indexes[name])
+                self.report('with indexes', with_indexes[name])
+
+            transaction.set_rollback(True)
+
+    def seed(self, rows, seed):
+        '''
+        Insert the lookup rows and the cars, returning an owner id and a model id to query.
+        '''
+        generator = random.Random(seed)
+        self.stdout.write("Seeding {} cars...".format(rows))
+
+        brands = Car_Brand.objects.bulk_create([Car_Brand(name="Benchmark Brand {}".format(i)) for i in range(20)])
+        models = Car_Model.objects.bulk_create([
+            Car_Model(brand=generator.choice(brands), name="Benchmark Model {}".format(i)) for i in range(200)
+        ])
+        fuels = Fuel_Type.objects.bulk_create([Fuel_Type(name=name) for name in ['Petrol', 'Diesel', 'Hybrid', 'Electric']])
+        transmissions = Transmission_Type.objects.bulk_create([Transmission_Type(name=name) for name in ['Automatic', 'Manual', 'CVT']])
+        password = make_password(None)
+        owners = User.objects.bulk_create([
+            User(username="benchmark{}@example.com".format(i), email="benchmark{}@example.com".format(i), password=password)
+            for i in range(1000)
+        ])
+
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT setseed(%s)', [generator.random() * 2 - 1])
+            cursor.execute(
+                '''
+                INSERT INTO marketplace_app_car
+                    (year, model_id, registration_number, status, description, odometer, price,
+                     condition, fuel_type_id, transmission_id, owner_id, prev_owner_count, location, updated_at)
+                SELECT
+                    1990 + floor(random() * 34)::int,
+                    (%(models)s::bigint[])[1 + floor(random() * cardinality(%(models)s::bigint[]))::int],
+                    upper(substr(md5(i::text), 1, 6)),
+                    (ARRAY['AVAILABLE', 'AVAILABLE', 'AVAILABLE', 'PENDING', 'SOLD', 'UNAVAILABLE'])[1 + floor(random() * 6)::int],
+                    NULL,
+                    floor(random() * 300000)::int,
+                    round((1000 + random() * 99000)::numeric, 2)::float8,
+                    (ARRAY['EXCELLENT', 'GOOD', 'FAIR', 'POOR'])[1 + floor(random() * 4)::int],
+                    (%(fuels)s::bigint[])[1 + floor(random() * cardinality(%(fuels)s::bigint[]))::int],
+                    (%(transmissions)s::bigint[])[1 + floor(random() * cardinality(%(transmissions)s::bigint[]))::int],
+                    (%(owners)s::int[])[1 + floor(random() * cardinality(%(owners)s::int[]))::int],
+                    1 + floor(random() * 4)::int,
+                    (%(locations)s::text[])[1 + floor(random() * cardinality(%(locations)s::text[]))::int]
+                        || ' ' || floor(random() * 100)::int,
+                    now()
+                FROM generate_series(1, %(rows)s) AS i
+                ''',
+                {
+                    'models': [model.id for model in models],
+                    'fuels': [fuel.id for fuel in fuels],
+                    'transmissions': [transmission.id for transmission in transmissions],
+                    'owners': [owner.id for owner in owners],
+                    'locations': LOCATIONS,
+                    'rows': rows,
+                },
+            )
+            cursor.execute('ANALYZE marketplace_app_car')
+
+        return owners[0].id, models[0].id
+
+    def get_queries(self, owner_id, model_id):
+        '''
+        The hot query paths of the listing, search and preference pages.
+        '''
+        return {
+            "Available cars by price": Car.objects.filter(status='AVAILABLE').order_by('price', 'id')[:20],
+            "Cars of a model from a year": Car.objects.filter(model_id=model_id, year__gte=2015),
+            "Available cars of an owner": Car.objects.filter(owner_id=owner_id, status='AVAILABLE'),
+            "Cars by odometer": Car.objects.filter(odometer__lte=20000).order_by('odometer', 'id')[:20],
+            "Cars by year": Car.objects.order_by('-year', '-id')[:20],
+            "Cars in a location": Car.objects.filter(location='Hobart 7'),
+        }
+
+    def report(self, label, plan):
+        # "Seq Scan on <table>", "Index Scan using <index> on <table>" or "Bitmap Index Scan on <index>"
+        scans = ', '.join(
+            '{} {}'.format(scan, index or target)
+            for scan, index, target in SCAN_PATTERN.findall(plan)
+        )
+        execution_time = EXECUTION_TIME_PATTERN.search(plan)
+        self.stdout.write("  {}: {} ({} ms)".format(label, scans, execution_time.group(1) if execution_time else '?'))
+        if self.verbosity >= 2:
+            for line in plan.splitlines():
+                self.stdout.write("      " + line)
@@ -0,0 +1,221 @@
+import json
+import math
+import statistics
+import subprocess
+import time
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.db.models import Count
+from django.test import Client, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+
+from marketplace_app.models import Car, Order
+
+# the GET routes measured: the name of the result, the url name, the ids of the url
+# taken from the benchmark data, the query string, and whether a user is logged in.
+# the routes changing data and the routes of the emailed tokens are left out.
+ROUTES = [
+    ('index', 'index', (), '', False),
+    ('car_listings', 'car_listings', (), '', False),
+    ('car_listings_by_price', 'car_listings', (), 'sort=price', False),
+    ('car_listing', 'car_listing', ('car_id',), '', False),
+    ('search', 'search', (), 'q={keyword}', False),
+    ('login', 'login', (), '', False),
+    ('signup', 'signup', (), '', False),
+    ('forgotpassword', 'forgotpassword', (), '', False),
+    ('rating_seller', 'rating_seller', ('seller_id',), '', True),
+    ('rating_buyer', 'rating_buyer', ('buyer_id',), '', True),
+    ('account_detail', 'account_detail', (), '', True),
+    ('preference_matches', 'preference_matches', (), '', True),
+    ('wishlist', 'wishlist', (), '', True),
+    ('sales_orders', 'sales_orders', (), '', True),
+    ('purchase_orders', 'purchase_orders', (), '', True),
+    ('car_images', 'car_images', ('own_car_id',), '', True),
+    ('create-car', 'create-car', (), '', True),
+    ('create-model', 'create-model', (), '', True),
+    ('create-brand', 'create-brand', (), '', True),
+    ('create-transmission', 'create-transmission', (), '', True),
+    ('create-fuel', 'create-fuel', (), '', True),
+    ('import-cars', 'import-cars', (), '', True),
+    ('api_car_list', 'api_car_list', (), '', False),
+    ('api_car_search', 'api_car_search', (), 'q={keyword}', False),
+    ('api_car_detail', 'api_car_detail', ('car_id',), '', False),
+    ('api_brand_models', 'api_brand_models', ('brand_id',), '', False),
+]
+
+PERCENTILES = (50, 95, 99)
+
+def percentile(sorted_values, percent):
+    # the nearest rank, so every reported latency was measured
+    return sorted_values[max(0, math.ceil(percent / 100 * len(sorted_values)) - 1)]
+
+def current_commit():
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, check=True, cwd=settings.BASE_DIR,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+class Command(BaseCommand):
+    help = (
+        "Measure the p50/p95/p99 latency, the query count and the response size of every "
+        "page and API route against the current database, such as one filled by seed_marketplace. "
+        "The results can be written as JSON and compared with the results of another commit."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--iterations', type=int, default=50, help="The number of timed requests per route.")
+        parser.add_argument('--warmup', type=int, default=5, help="The number of untimed requests per route, filling the caches.")
+        parser.add_argument('--username', help="The user logged in for the account pages, by default the seller with the most orders.")
+        parser.add_argument('--route', action='append', help="Only measure the given route, can be repeated.")
+        parser.add_argument('--output', help="Write the results as JSON to this file.")
+        parser.add_argument('--compare', help="Compare the results with the JSON results of a previous run.")
+        parser.add_argument('--threshold', type=float, default=0.2, help="The p95 increase reported as a regression, as a fraction.")
+
+    def handle(self, *args, **options):
+        routes = [route for route in ROUTES if not options['route'] or route[0] in options['route']]
+        if not routes:
+            raise CommandError("Unknown routes, choose from {}.".format(', '.join(route[0] for route in ROUTES)))
+        data = self.get_data(options['username'])
+
+        anonymous = Client()
+        logged_in = Client()
+        logged_in.force_login(data['user'])
+
+        results = {
+            'commit': current_commit(),
+            'created_at': timezone.now().isoformat(),
+            'iterations': options['iterations'],
+            'routes': {},
+        }
+        # the test client is served as testserver, and the query log of DEBUG would be timed too
+        with override_settings(DEBUG=False, ALLOWED_HOSTS=settings.ALLOWED_HOSTS + ['testserver']):
+            for name, url_name, arg_names, query, login in routes:
+                url = reverse(url_name, args=[data[arg] for arg in arg_names])
+                if query:
+                    url += '?' + query.format(**data)
+                result = self.measure(logged_in if login else anonymous, url, options['iterations'], options['warmup'])
+                results['routes'][name] = result
+                self.report(name, result)
+
+        if options['output']:
+            with open(options['output'], 'w') as file:
+                json.dump(results, file, indent=2)
+            self.stdout.write("Wrote the results to {}.".format(options['output']))
+
+        if options['compare']:
+            with open(options['compare']) as file:
+                baseline = json.load(file)
+            regressions = self.compare(baseline, results, options['threshold'])
+            if regressions:
+                raise CommandError("{} routes regressed: {}.".format(len(regressions), ', '.join(regressions)))
+
+    def get_data(self, username):
+        '''
+        The ids of the urls: a car for sale, a car of the logged in user, a seller
+        and a buyer the user traded with, and a brand.
+        '''
+        orders = Order.objects.order_by('-id')
+        if username:
+            user = User.objects.filter(username=username).first()
+            if user is None:
+                raise CommandError("The user {} does not exist.".format(username))
+        else:
+            seller = orders.values('seller').annotate(count=Count('pk')).order_by('-count', 'seller').first()
+            if seller is None:
+                raise CommandError("There are no orders to benchmark, seed the database with seed_marketplace first.")
+            user = User.objects.get(pk=seller['seller'])
+
+        car = Car.objects.filter(status='AVAILABLE').exclude(owner=user).select_related('model__brand').order_by('-id').first()
+        own_car_id = Car.objects.filter(owner=user).order_by('-id').values_list('pk', flat=True).first()
+        if car is None or own_car_id is None:
+            raise CommandError("The user {} has no car, or there is no car for sale.".format(user.username))
+        seller_id = orders.exclude(seller=user).values_list('seller', flat=True).first()
+        buyer_id = orders.filter(seller=user).values_list('buyer', flat=True).first()
+        return {
+            'user': user,
+            'car_id': car.pk,
+            'own_car_id': own_car_id,
+            'seller_id': seller_id or car.owner_id,
+            'buyer_id': buyer_id or car.owner_id,
+            'brand_id': car.model.brand_id,
+            'keyword': car.model.brand.name,
+        }
+
+    def fetch(self, client, url):
+        response = client.get(url)
+        # a streamed response is only produced as it is read
+        content = b''.join(response.streaming_content) if response.streaming else response.content
+        return response, content
+
+    def measure(self, client, url, iterations, warmup):
+        for _ in range(warmup):
+            self.fetch(client, url)
+
+        # the queries are counted apart, recording them would slow the timed requests down
+        with CaptureQueriesContext(connection) as queries:
+            response, content = self.fetch(client, url)
+        # the captured queries are read from the query log, which the next request clears
+        query_count = len(queries)
+
+        latencies = []
+        for _ in range(iterations):
+            start = time.perf_counter()
+            self.fetch(client, url)
+            latencies.append((time.perf_counter() - start) * 1000)
+        latencies.sort()
+
+        result = {
+            'url': url,
+            'status': response.status_code,
+            'queries': query_count,
+            'bytes': len(content),
+            'mean': round(statistics.mean(latencies), 3) if latencies else None,
+        }
+        for percent in PERCENTILES:
+            result['p{}'.format(percent)] = round(percentile(latencies, percent), 3) if latencies else None
+        return result
+
+    def report(self, name, result):
+        line = "{:<24} {:>3} {:>9} {:>9} {:>9} ms {:>4} queries {:>8} bytes".format(
+            name, result['status'],
+            *('-' if result[key] is None else '{:.2f}'.format(result[key]) for key in ('p50', 'p95', 'p99')),
+            result['queries'], result['bytes'],
+        )
+        # a redirect or an error is measured too, but it is not the page
+        self.stdout.write(line if result['status'] == 200 else self.style.WARNING(line))
+
+    def compare(self, baseline, results, threshold):
+        '''
+        Print the changes from the baseline results, and return the routes
+        making more queries or slower at p95 than the threshold allows.
+        '''
+        self.stdout.write(self.style.MIGRATE_HEADING("Compared with {}".format(baseline.get('commit') or 'the baseline')))
+        regressions = []
+        for name, result in results['routes'].items():
+            before = baseline.get('routes', {}).get(name)
+            if before is None:
+                self.stdout.write("{:<24} new route".format(name))
+                continue
+
+            slower = before['p95'] and result['p95'] and result['p95'] > before['p95'] * (1 + threshold)
+            more_queries = result['queries'] > before['queries']
+            line = "{:<24} p50 {:+.0%} p95 {:+.0%} queries {:+d} bytes {:+d}".format(
+                name,
+                (result['p50'] / before['p50'] - 1) if before['p50'] else 0,
+                (result['p95'] / before['p95'] - 1) if before['p95'] else 0,
+                result['queries'] - before['queries'],
+                result['bytes'] - before['bytes'],
+            )
+            if slower or more_queries:
+                regressions.append(name)
+                self.stdout.write(self.style.ERROR(line))
+            else:
+                self.stdout.write(line)
+        return regressions
@@ -0,0 +1,22 @@
+import sys
+
+from django.core.management.base import BaseCommand
+
+from marketplace_app.exporter import EXPORT_FORMATS, export_lines
+
+class Command(BaseCommand):
+    help = "Export every car as CSV or JSON lines, streamed with a constant memory use."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--format', choices=EXPORT_FORMATS, default='csv', help="The format of the export.")
+        parser.add_argument('--output', help="The file to write, by default the standard output.")
+        parser.add_argument('--chunk-size', type=int, default=2000, help="The number of cars read from the database at a time.")
+
+    def handle(self, *args, **options):
+        lines = export_lines(options['format'], chunk_size=options['chunk_size'])
+        if options['output']:
+            with open(options['output'], 'w', newline='') as file:
+                file.writelines(lines)
+        else:
+            for line in lines:
+                self.stdout.write(line, ending='')
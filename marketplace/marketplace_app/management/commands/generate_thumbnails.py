@@ -0,0 +1,23 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from marketplace_app.images import generate_thumbnails
+
+class Command(BaseCommand):
+    help = "Generate the thumbnails of the uploaded car images."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=20, help="The number of images processed per batch.")
+        parser.add_argument('--loop', action='store_true', help="Keep polling for new images.")
+        parser.add_argument('--interval', type=float, default=5, help="The seconds to wait between polls when the queue is empty.")
+
+    def handle(self, *args, **options):
+        while True:
+            processed = generate_thumbnails(options['batch_size'])
+            if processed:
+                self.stdout.write("Processed {} images.".format(processed))
+                continue
+            if not options['loop']:
+                break
+            time.sleep(options['interval'])
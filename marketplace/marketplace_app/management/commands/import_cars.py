@@ -0,0 +1,37 @@
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+
+from marketplace_app.importer import IMPORT_FORMATS, decode_lines, import_cars
+
+class Command(BaseCommand):
+    help = "Import the cars of a CSV or JSON lines file for an owner, reporting the rows that cannot be imported."
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help="The .csv or .jsonl file to import.")
+        parser.add_argument('--owner', required=True, help="The username of the owner of the cars.")
+        parser.add_argument('--format', choices=IMPORT_FORMATS, help="The format of the file, by default from its extension.")
+        parser.add_argument('--chunk-size', type=int, default=500, help="The number of cars inserted per query.")
+        parser.add_argument('--create-lookups', action='store_true', help="Create the brands, models, fuel types and transmissions not found.")
+
+    def handle(self, *args, **options):
+        try:
+            owner = User.objects.get(username=options['owner'])
+        except User.DoesNotExist:
+            raise CommandError("The owner {} does not exist.".format(options['owner']))
+
+        format = options['format'] or options['path'].rsplit('.', 1)[-1].lower()
+        if format not in IMPORT_FORMATS:
+            raise CommandError("Unknown format {}, use --format.".format(format))
+
+        with open(options['path'], 'rb') as file:
+            report = import_cars(
+                decode_lines(file), format, owner,
+                chunk_size=options['chunk_size'],
+                create_lookups=options['create_lookups'],
+            )
+
+        for line, message in report.errors:
+            self.stderr.write("Line {}: {}".format(line, message))
+        self.stdout.write(self.style.SUCCESS("Imported {} cars, skipped {} rows.".format(report.created, len(report.errors))))
+        if report.stopped:
+            raise CommandError("The import stopped after line {}, the rest of the file could not be read: {}".format(*report.stopped))
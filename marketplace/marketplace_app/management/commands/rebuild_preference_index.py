@@ -0,0 +1,16 @@
+from django.core.management.base import BaseCommand
+
+from marketplace_app.matching import index_preferences
+from marketplace_app.models import Preference
+
+class Command(BaseCommand):
+    help = "Rebuild the preference index used to find the buyers interested in a new car."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000, help="The number of preferences indexed per batch.")
+
+    def handle(self, *args, **options):
+        preference_ids = list(Preference.objects.order_by('pk').values_list('pk', flat=True))
+        for start in range(0, len(preference_ids), options['batch_size']):
+            index_preferences(preference_ids[start:start + options['batch_size']])
+        self.stdout.write("Indexed {} preferences.".format(len(preference_ids)))
@@ -0,0 +1,12 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from marketplace_app.ratings import rebuild_rating_summaries
+
+class Command(BaseCommand):
+    help = "Recompute the seller and buyer rating summaries of every user from their ratings."
+
+    def handle(self, *args, **options):
+        with transaction.atomic():
+            count = rebuild_rating_summaries()
+        self.stdout.write("Rebuilt {} rating summaries.".format(count))
@@ -0,0 +1,33 @@
+import datetime
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+
+from marketplace_app.seeding import Seeder, seed_username
+
+class Command(BaseCommand):
+    help = (
+        "Seed the database with users, cars, orders, ratings, preferences and wishlists "
+        "for load testing. The rows are streamed with COPY, and the same seed and date "
+        "generate the same rows."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=10000, help="The number of users to seed.")
+        parser.add_argument('--cars', type=int, default=50000, help="The number of cars to seed.")
+        parser.add_argument('--seed', type=int, default=42, help="The random seed of the generated data.")
+        parser.add_argument('--date', type=datetime.date.fromisoformat, help="The day the data is generated for, today by default.")
+        parser.add_argument('--password', default='password', help="The password of every seeded user.")
+
+    def handle(self, *args, **options):
+        if options['users'] < 2:
+            raise CommandError("Seed at least 2 users, a buyer and a seller.")
+        if User.objects.filter(username=seed_username(options['seed'], 0)).exists():
+            raise CommandError("The users of seed {} already exist, use another --seed.".format(options['seed']))
+
+        seeder = Seeder(options['seed'], options['date'] or timezone.localdate(), options['password'], stdout=self.stdout)
+        report = seeder.run(options['users'], options['cars'])
+        for model, count in report.counts.items():
+            self.stdout.write("  {}: {}".format(model._meta.label, count))
+        self.stdout.write(self.style.SUCCESS("Seeded {} rows.".format(sum(report.counts.values()))))
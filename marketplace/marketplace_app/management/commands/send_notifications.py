@@ -0,0 +1,23 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from marketplace_app.notifications import send_notifications
+
+class Command(BaseCommand):
+    help = "Queue the unsent notifications as one digest email per user."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=100, help="The number of notifications sent per batch.")
+        parser.add_argument('--loop', action='store_true', help="Keep polling for new notifications.")
+        parser.add_argument('--interval', type=float, default=10, help="The seconds to wait between polls when the queue is empty.")
+
+    def handle(self, *args, **options):
+        while True:
+            sent = send_notifications(options['batch_size'])
+            if sent:
+                self.stdout.write("Sent {} notifications.".format(sent))
+                continue
+            if not options['loop']:
+                break
+            time.sleep(options['interval'])
@@ -0,0 +1,37 @@
+import time
+
+from django.core.mail import get_connection
+from django.core.management.base import BaseCommand
+
+from marketplace_app.emails import due_emails, send_queued_emails
+
+class Command(BaseCommand):
+    help = "Send the queued emails over a single connection to the mail server."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=100, help="The number of emails sent per batch.")
+        parser.add_argument('--loop', action='store_true', help="Keep polling for new emails.")
+        parser.add_argument('--interval', type=float, default=5, help="The seconds to wait between polls when the queue is empty.")
+
+    def handle(self, *args, **options):
+        connection = get_connection()
+        while True:
+            try:
+                # the mail server is only connected to when there are emails to send,
+                # and the connection is kept open while there are more
+                if due_emails().exists():
+                    with connection:
+                        while True:
+                            sent = send_queued_emails(options['batch_size'], connection=connection)
+                            if not sent:
+                                break
+                            self.stdout.write("Sent {} emails.".format(sent))
+            except Exception as error:
+                # the mail server is unreachable, the emails stay queued
+                if not options['loop']:
+                    raise
+                self.stderr.write("Sending the emails failed: {}".format(error))
+
+            if not options['loop']:
+                break
+            time.sleep(options['interval'])
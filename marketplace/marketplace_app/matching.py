@@ -0,0 +1,266 @@
+from django.core.cache import cache
+from django.db import connection
+from django.db.models import Exists, OuterRef, Q
+
+from .models import (
+    Car, Car_Model, Preference, Preference_Term,
+    Preferred_Odometer_Range, Preferred_Price_Range, Preferred_Year_Range,
+)
+
+# the car fields a preference can match on
+MATCHING_FIELDS = {'year', 'price', 'odometer', 'fuel_type', 'transmission', 'model', 'status'}
+
+# how long the matching car ids of a user are kept in the cache
+MATCHES_TIMEOUT = 60 * 60 * 24
+
+# the dimensions of the preference index, from the most selective. A preference
+# is indexed under the first dimension it restricts only, so a new car reads the
+# index rows of the preferences restricting one of its values, and the rows of
+# the preferences restricting nothing, rather than a row of every preference
+INDEX_DIMENSIONS = ('make', 'year', 'price', 'odometer', 'fuel', 'transmission')
+
+# the dimension and term of the preferences restricting nothing, which match every car
+MATCH_ALL_DIMENSION = 'all'
+MATCH_ALL = 'all:*'
+
+# the width of the buckets of the indexed ranges
+YEAR_BUCKET = 1
+PRICE_BUCKET = 5000
+ODOMETER_BUCKET = 10000
+
+# ranges spanning more buckets are not indexed, the preference is indexed
+# under another dimension and the exact match of the candidates filters it
+MAX_BUCKETS = 50
+
+def matches_cache_key(user_id):
+    return 'preference_matches:{}'.format(user_id)
+
+def preference_filter(preference):
+    '''
+    Compile a preference into a Q object selecting the cars it matches.
+    The many-to-many choices are subqueries of the through tables, so the
+    whole preference is evaluated by the database in one query.
+    A range or a many-to-many field that is not set matches every car.
+    The brands and models are combined: a car matches when either its model
+    or its brand is preferred.
+    '''
+    condition = Q(status='AVAILABLE')
+
+    if preference.year_range is not None:
+        condition &= Q(year__gte=preference.year_range.year_min, year__lte=preference.year_range.year_max)
+    if preference.price_range is not None:
+        condition &= Q(price__gte=preference.price_range.price_min, price__lte=preference.price_range.price_max)
+    if preference.odometer_range is not None:
+        condition &= Q(odometer__gte=preference.odometer_range.odometer_min, odometer__lte=preference.odometer_range.odometer_max)
+
+    fuels = Preference.fuel.through.objects.filter(preference_id=preference.pk).values('fuel_type_id')
+    transmissions = Preference.transmission.through.objects.filter(preference_id=preference.pk).values('transmission_type_id')
+    models = Preference.model.through.objects.filter(preference_id=preference.pk).values('car_model_id')
+    brands = Preference.brand.through.objects.filter(preference_id=preference.pk).values('car_brand_id')
+
+    condition &= Q(fuel_type__in=fuels) | ~Exists(fuels)
+    condition &= Q(transmission__in=transmissions) | ~Exists(transmissions)
+    condition &= Q(model__in=models) | Q(model__brand__in=brands) | (~Exists(models) & ~Exists(brands))
+    return condition
+
+def matching_cars(preference):
+    return Car.objects.filter(preference_filter(preference))
+
+def matching_preferences(car):
+    '''
+    The preferences matching a car, in one query. This is the reverse of
+    preference_filter, used to keep the cached matches up to date.
+    Only the candidates found through the preference index are compared.
+    '''
+    if car.status != 'AVAILABLE':
+        return Preference.objects.none()
+
+    def chosen(field, lookup, value):
+        through = getattr(Preference, field).through.objects.filter(preference_id=OuterRef('pk'))
+        return Exists(through.filter(**{lookup: value})), ~Exists(through)
+
+    fuel_chosen, no_fuel = chosen('fuel', 'fuel_type_id', car.fuel_type_id)
+    transmission_chosen, no_transmission = chosen('transmission', 'transmission_type_id', car.transmission_id)
+    model_chosen, no_model = chosen('model', 'car_model_id', car.model_id)
+    # the brand of the car is joined through its model
+    brand_chosen, no_brand = chosen('brand', 'car_brand__car_model', car.model_id)
+
+    return Preference.objects.filter(
+        pk__in=candidate_preference_ids(car),
+    ).filter(
+        Q(year_range__isnull=True) | Q(year_range__year_min__lte=car.year, year_range__year_max__gte=car.year),
+        Q(price_range__isnull=True) | Q(price_range__price_min__lte=car.price, price_range__price_max__gte=car.price),
+        Q(odometer_range__isnull=True) | Q(odometer_range__odometer_min__lte=car.odometer, odometer_range__odometer_max__gte=car.odometer),
+        fuel_chosen | no_fuel,
+        transmission_chosen | no_transmission,
+        model_chosen | brand_chosen | (no_model & no_brand),
+    )
+
+def matching_user_ids(car):
+    return set(matching_preferences(car).values_list('user_id', flat=True))
+
+def matching_user_ids_by_car(cars):
+    '''
+    The ids of the users whose preference matches each of the saved cars, by
+    car id, in one query however many cars there are. The candidates of every
+    car are found through the preference index at once, then compared with
+    the car rows by the conditions of matching_preferences.
+    '''
+    matches = {car.pk: set() for car in cars}
+    pairs = [(car.pk, term) for car in cars if car.status == 'AVAILABLE' for term in car_terms(car)]
+    if not pairs:
+        return matches
+
+    through = {field: getattr(Preference, field).through._meta.db_table for field in ('fuel', 'transmission', 'model', 'brand')}
+    sql = '''
+        WITH car_term AS (
+            SELECT * FROM unnest(%s::bigint[], %s::text[]) AS car_term (car_id, term)
+        ), candidate AS (
+            SELECT DISTINCT car_term.car_id, term.preference_id
+            FROM car_term JOIN {term} AS term ON term.term = car_term.term
+        )
+        SELECT candidate.car_id, preference.user_id
+        FROM candidate
+        JOIN {car} AS car ON car.id = candidate.car_id
+        JOIN {model} AS model ON model.id = car.model_id
+        JOIN {preference} AS preference ON preference.user_id = candidate.preference_id
+        LEFT JOIN {year_range} AS year_range ON year_range.id = preference.year_range_id
+        LEFT JOIN {price_range} AS price_range ON price_range.id = preference.price_range_id
+        LEFT JOIN {odometer_range} AS odometer_range ON odometer_range.id = preference.odometer_range_id
+        WHERE (preference.year_range_id IS NULL OR car.year BETWEEN year_range.year_min AND year_range.year_max)
+        AND (preference.price_range_id IS NULL OR car.price BETWEEN price_range.price_min AND price_range.price_max)
+        AND (preference.odometer_range_id IS NULL OR car.odometer BETWEEN odometer_range.odometer_min AND odometer_range.odometer_max)
+        AND (
+            EXISTS (SELECT 1 FROM {fuel} WHERE preference_id = preference.user_id AND fuel_type_id = car.fuel_type_id)
+            OR NOT EXISTS (SELECT 1 FROM {fuel} WHERE preference_id = preference.user_id)
+        )
+        AND (
+            EXISTS (SELECT 1 FROM {transmission} WHERE preference_id = preference.user_id AND transmission_type_id = car.transmission_id)
+            OR NOT EXISTS (SELECT 1 FROM {transmission} WHERE preference_id = preference.user_id)
+        )
+        AND (
+            EXISTS (SELECT 1 FROM {model_choice} WHERE preference_id = preference.user_id AND car_model_id = car.model_id)
+            OR EXISTS (SELECT 1 FROM {brand_choice} WHERE preference_id = preference.user_id AND car_brand_id = model.brand_id)
+            OR (
+                NOT EXISTS (SELECT 1 FROM {model_choice} WHERE preference_id = preference.user_id)
+                AND NOT EXISTS (SELECT 1 FROM {brand_choice} WHERE preference_id = preference.user_id)
+            )
+        )
+    '''.format(
+        term=Preference_Term._meta.db_table,
+        car=Car._meta.db_table,
+        model=Car_Model._meta.db_table,
+        preference=Preference._meta.db_table,
+        year_range=Preferred_Year_Range._meta.db_table,
+        price_range=Preferred_Price_Range._meta.db_table,
+        odometer_range=Preferred_Odometer_Range._meta.db_table,
+        fuel=through['fuel'],
+        transmission=through['transmission'],
+        model_choice=through['model'],
+        brand_choice=through['brand'],
+    )
+
+    with connection.cursor() as cursor:
+        cursor.execute(sql, [[car_id for car_id, _ in pairs], [term for _, term in pairs]])
+        for car_id, user_id in cursor.fetchall():
+            matches[car_id].add(user_id)
+    return matches
+
+def get_matching_car_ids(user):
+    '''
+    The ids of the available cars matching the user's preference, newest first.
+    The ids are cached per user until the preference or one of the cars it
+    matches or matched changes, and computed again when next read.
+    '''
+    key = matches_cache_key(user.pk)
+    car_ids = cache.get(key)
+    if car_ids is None:
+        preference = Preference.objects.select_related('year_range', 'price_range', 'odometer_range').filter(user=user).first()
+        if preference is None:
+            car_ids = []
+        else:
+            car_ids = list(matching_cars(preference).order_by('-id').values_list('id', flat=True))
+        cache.set(key, car_ids, MATCHES_TIMEOUT)
+    return car_ids
+
+def invalidate_matches(user_ids):
+    # the keys are deleted rather than updated, as concurrent updates of a list would be lost
+    cache.delete_many([matches_cache_key(user_id) for user_id in user_ids])
+
+def range_terms(dimension, minimum, maximum, width):
+    first = int(minimum // width)
+    last = int(maximum // width)
+    if last - first >= MAX_BUCKETS:
+        return []
+    return ['{}:{}'.format(dimension, bucket) for bucket in range(first, last + 1)]
+
+def preference_terms(preference, fuel_ids, transmission_ids, model_ids, brand_ids):
+    '''
+    The (dimension, term) pairs indexing a preference, the terms of the most
+    selective dimension it restricts, or the match-all term.
+    '''
+    terms = {
+        'make': ['make:model:{}'.format(model_id) for model_id in model_ids] + ['make:brand:{}'.format(brand_id) for brand_id in brand_ids],
+        'year': [],
+        'price': [],
+        'odometer': [],
+        'fuel': ['fuel:{}'.format(fuel_id) for fuel_id in fuel_ids],
+        'transmission': ['transmission:{}'.format(transmission_id) for transmission_id in transmission_ids],
+    }
+    if preference.year_range is not None:
+        terms['year'] = range_terms('year', preference.year_range.year_min, preference.year_range.year_max, YEAR_BUCKET)
+    if preference.price_range is not None:
+        terms['price'] = range_terms('price', preference.price_range.price_min, preference.price_range.price_max, PRICE_BUCKET)
+    if preference.odometer_range is not None:
+        terms['odometer'] = range_terms('odometer', preference.odometer_range.odometer_min, preference.odometer_range.odometer_max, ODOMETER_BUCKET)
+
+    for dimension in INDEX_DIMENSIONS:
+        if terms[dimension]:
+            return [(dimension, term) for term in terms[dimension]]
+    return [(MATCH_ALL_DIMENSION, MATCH_ALL)]
+
+def car_terms(car):
+    '''
+    The terms of the preference index matching a car, one per dimension and the match-all term.
+    '''
+    return [
+        'make:model:{}'.format(car.model_id),
+        'make:brand:{}'.format(car.model.brand_id),
+        'year:{}'.format(int(car.year // YEAR_BUCKET)),
+        'price:{}'.format(int(car.price // PRICE_BUCKET)),
+        'odometer:{}'.format(int(car.odometer // ODOMETER_BUCKET)),
+        'fuel:{}'.format(car.fuel_type_id),
+        'transmission:{}'.format(car.transmission_id),
+        MATCH_ALL,
+    ]
+
+def candidate_preference_ids(car):
+    '''
+    The ids of the preferences indexed under a term of the car. Only the index
+    rows of the car's terms are read: the preferences restricting one of its
+    values and the preferences restricting nothing. The other dimensions of
+    the candidates are compared by the exact match afterwards.
+    '''
+    return Preference_Term.objects.filter(term__in=car_terms(car)).values('preference_id')
+
+def index_preferences(preference_ids):
+    '''
+    Rebuild the preference index rows of the given preferences.
+    '''
+    preference_ids = list(preference_ids)
+    preferences = Preference.objects.select_related('year_range', 'price_range', 'odometer_range').filter(pk__in=preference_ids)
+
+    choices = {}
+    for field, column in (('fuel', 'fuel_type_id'), ('transmission', 'transmission_type_id'), ('model', 'car_model_id'), ('brand', 'car_brand_id')):
+        choices[field] = {}
+        rows = getattr(Preference, field).through.objects.filter(preference_id__in=preference_ids).values_list('preference_id', column)
+        for preference_id, choice_id in rows:
+            choices[field].setdefault(preference_id, []).append(choice_id)
+
+    terms = []
+    for preference in preferences:
+        pairs = preference_terms(preference, *(choices[field].get(preference.pk, []) for field in ('fuel', 'transmission', 'model', 'brand')))
+        terms.extend(Preference_Term(preference=preference, dimension=dimension, term=term) for dimension, term in pairs)
+
+    Preference_Term.objects.filter(preference_id__in=preference_ids).delete()
+    Preference_Term.objects.bulk_create(terms)
@@ -0,0 +1,39 @@
+# Generated by Django 4.2.5 on 2026-10-18 12:00
+
+import django.contrib.postgres.indexes
+from django.contrib.postgres.operations import TrigramExtension
+import django.contrib.postgres.search
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('marketplace_app', '0010_car_indexes'),
+    ]
+
+    operations = [
+        TrigramExtension(),
+        migrations.AddField(
+            model_name='car',
+            name='search_vector',
+            field=django.contrib.postgres.search.SearchVectorField(blank=True, editable=False, null=True),
+        ),
+        migrations.AddIndex(
+            model_name='car',
+            index=django.contrib.postgres.indexes.GinIndex(fields=['search_vector'], name='car_search_vector_idx'),
+        ),
+        migrations.RunSQL(
+            sql='''
+            UPDATE marketplace_app_car AS car SET search_vector =
+                setweight(to_tsvector('english', coalesce(brand.name, '')), 'A') ||
+                setweight(to_tsvector('english', coalesce(model.name, '')), 'A') ||
+                setweight(to_tsvector('english', coalesce(car.location, '')), 'B') ||
+                setweight(to_tsvector('english', coalesce(car.description, '')), 'C')
+            FROM marketplace_app_car_model AS model
+            JOIN marketplace_app_car_brand AS brand ON brand.id = model.brand_id
+            WHERE car.model_id = model.id
+            ''',
+            reverse_sql=migrations.RunSQL.noop,
+        ),
+    ]
@@ -0,0 +1,42 @@
+# Generated by Django 4.2.5 on 2026-10-18 12:04
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('marketplace_app', '0011_car_search_vector'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Preference_Term',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('dimension', models.CharField(max_length=12)),
+                ('term', models.CharField(max_length=40)),
+                ('preference', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='terms', to='marketplace_app.preference')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['term', 'preference', 'dimension'], name='preference_term_idx')],
+            },
+        ),
+        migrations.CreateModel(
+            name='Notification',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('kind', models.CharField(choices=[('NEW_MATCH', 'A new car matches your preferences.')], max_length=12)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('sent_at', models.DateTimeField(blank=True, null=True)),
+                ('car', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='notifications', to='marketplace_app.car')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='notifications', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'indexes': [models.Index(condition=models.Q(('sent_at__isnull', True)), fields=['user', 'id'], name='notification_unsent_idx')],
+            },
+        ),
+    ]
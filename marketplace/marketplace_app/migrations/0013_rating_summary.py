@@ -0,0 +1,62 @@
+# Generated by Django 4.2.5 on 2026-10-18 12:08
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def summarise_ratings(apps, schema_editor):
+    Rating_Summary = apps.get_model('marketplace_app', 'Rating_Summary')
+    summaries = {}
+    for model_name, column, prefix in [('Seller_Rating', 'seller_id', 'seller'), ('Buyer_Rating', 'buyer_id', 'buyer')]:
+        ratings = apps.get_model('marketplace_app', model_name).objects.values_list(column, 'rating')
+        for user_id, rating in ratings.iterator():
+            summary = summaries.setdefault(user_id, Rating_Summary(user_id=user_id))
+            setattr(summary, prefix + '_rating_count', getattr(summary, prefix + '_rating_count') + 1)
+            setattr(summary, prefix + '_rating_sum', getattr(summary, prefix + '_rating_sum') + rating)
+            if 1 <= rating <= 5:
+                star = '{}_rating_{}'.format(prefix, rating)
+                setattr(summary, star, getattr(summary, star) + 1)
+    for summary in summaries.values():
+        for prefix in ['seller', 'buyer']:
+            count = getattr(summary, prefix + '_rating_count')
+            if count:
+                setattr(summary, prefix + '_rating_average', getattr(summary, prefix + '_rating_sum') / count)
+    Rating_Summary.objects.bulk_create(summaries.values(), batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('auth', '0012_alter_user_first_name_max_length'),
+        ('marketplace_app', '0012_preference_terms_notifications'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Rating_Summary',
+            fields=[
+                ('user', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='rating_summary', serialize=False, to=settings.AUTH_USER_MODEL)),
+                ('seller_rating_count', models.PositiveIntegerField(default=0)),
+                ('seller_rating_sum', models.PositiveIntegerField(default=0)),
+                ('seller_rating_average', models.FloatField(blank=True, null=True)),
+                ('seller_rating_1', models.PositiveIntegerField(default=0)),
+                ('seller_rating_2', models.PositiveIntegerField(default=0)),
+                ('seller_rating_3', models.PositiveIntegerField(default=0)),
+                ('seller_rating_4', models.PositiveIntegerField(default=0)),
+                ('seller_rating_5', models.PositiveIntegerField(default=0)),
+                ('buyer_rating_count', models.PositiveIntegerField(default=0)),
+                ('buyer_rating_sum', models.PositiveIntegerField(default=0)),
+                ('buyer_rating_average', models.FloatField(blank=True, null=True)),
+                ('buyer_rating_1', models.PositiveIntegerField(default=0)),
+                ('buyer_rating_2', models.PositiveIntegerField(default=0)),
+                ('buyer_rating_3', models.PositiveIntegerField(default=0)),
+                ('buyer_rating_4', models.PositiveIntegerField(default=0)),
+                ('buyer_rating_5', models.PositiveIntegerField(default=0)),
+            ],
+            options={
+                'indexes': [models.Index(models.OrderBy(models.F('seller_rating_average'), descending=True, nulls_last=True), models.OrderBy(models.F('seller_rating_count'), descending=True), name='summary_seller_rating_idx'), models.Index(models.OrderBy(models.F('buyer_rating_average'), descending=True, nulls_last=True), models.OrderBy(models.F('buyer_rating_count'), descending=True), name='summary_buyer_rating_idx')],
+            },
+        ),
+        migrations.RunPython(summarise_ratings, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 4.2.5 on 2026-10-18 12:26
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('marketplace_app', '0015_car_updated_at'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='notification',
+            name='previous_price',
+            field=models.FloatField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='notification',
+            name='status',
+            field=models.CharField(blank=True, choices=[('AVAILABLE', 'The car is available for sale.'), ('PENDING', 'The car is pending for sale.'), ('SOLD', 'The car is sold.'), ('UNAVAILABLE', 'The car is not available for sale.')], max_length=11),
+        ),
+        migrations.AlterField(
+            model_name='notification',
+            name='kind',
+            field=models.CharField(choices=[('NEW_MATCH', 'A new car matches your preferences.'), ('PRICE_DROP', 'The price of a car in your wishlist has dropped.'), ('STATUS_CHANGE', 'A car in your wishlist is no longer available.')], max_length=16),
+        ),
+    ]
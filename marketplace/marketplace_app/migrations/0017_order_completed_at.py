@@ -0,0 +1,23 @@
+# Generated by Django 4.2.5 on 2026-10-18 12:28
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('marketplace_app', '0016_notification_wishlist_changes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='order',
+            name='completed_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AlterField(
+            model_name='order',
+            name='status',
+            field=models.CharField(choices=[('PENDING', 'The order is pending.'), ('COMPLETED', 'The order is completed.'), ('CANCELLED', 'The order is cancelled.')], default='PENDING', max_length=9),
+        ),
+    ]
@@ -0,0 +1,21 @@
+# Generated by Django 4.2.5 on 2026-10-18 12:31
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('marketplace_app', '0017_order_completed_at'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='order',
+            index=models.Index(fields=['seller', 'id'], name='order_seller_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='order',
+            index=models.Index(fields=['buyer', 'id'], name='order_buyer_idx'),
+        ),
+    ]
@@ -0,0 +1,46 @@
+# Generated by Django 4.2.5 on 2026-10-18 12:33
+
+from django.db import migrations, models
+import marketplace_app.models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('marketplace_app', '0018_order_dashboard_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='car_file',
+            name='sha256',
+            field=models.CharField(blank=True, db_index=True, max_length=64, null=True),
+        ),
+        migrations.AddField(
+            model_name='car_file',
+            name='thumbnail_error',
+            field=models.CharField(blank=True, max_length=255),
+        ),
+        migrations.AddField(
+            model_name='car_file',
+            name='thumbnailed_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AlterField(
+            model_name='car_file',
+            name='file',
+            field=models.FileField(max_length=255, upload_to=marketplace_app.models.car_file_path),
+        ),
+        migrations.AddIndex(
+            model_name='car_file',
+            index=models.Index(condition=models.Q(('thumbnailed_at__isnull', True)), fields=['id'], name='car_file_pending_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='car_file',
+            index=models.Index(condition=models.Q(('thumbnail_error', ''), ('thumbnailed_at__isnull', False)), fields=['car', 'id'], name='car_file_ready_idx'),
+        ),
+        migrations.AddConstraint(
+            model_name='car_file',
+            constraint=models.UniqueConstraint(fields=('car', 'sha256'), name='car_file_car_sha256_uniq'),
+        ),
+    ]
@@ -0,0 +1,61 @@
+# Generated by Django 4.2.5 on 2026-10-18 12:36
+
+from django.db import migrations
+
+
+# the prefix of the preference index terms of the rows of a lookup, see matching.preference_terms
+TERM_PREFIXES = {
+    'Car_Brand': 'make:brand:',
+    'Car_Model': 'make:model:',
+    'Fuel_Type': 'fuel:',
+    'Transmission_Type': 'transmission:',
+}
+
+def merge_rows(model, keep, duplicates, Preference_Term):
+    '''
+    Point every reference to the duplicates at the row kept, then delete them.
+    The duplicates are merged one at a time, so a row choosing several of them
+    keeps one choice.
+    '''
+    prefix = TERM_PREFIXES[model.__name__]
+    for duplicate in duplicates:
+        for relation in model._meta.related_objects:
+            if relation.many_to_many:
+                field = relation.field
+                through = field.remote_field.through
+                source, target = field.m2m_field_name(), field.m2m_reverse_field_name()
+                chosen = through.objects.filter(**{target: keep}).values(source)
+                # a row choosing both the kept row and a duplicate keeps one choice
+                through.objects.filter(**{target: duplicate, source + '__in': chosen}).delete()
+                through.objects.filter(**{target: duplicate}).update(**{target: keep})
+            else:
+                relation.related_model.objects.filter(**{relation.field.name: duplicate}).update(**{relation.field.name: keep})
+
+        # the signals rebuilding the preference index are not sent during a migration
+        indexed = Preference_Term.objects.filter(term=prefix + str(keep)).values('preference_id')
+        Preference_Term.objects.filter(term=prefix + str(duplicate), preference_id__in=indexed).delete()
+        Preference_Term.objects.filter(term=prefix + str(duplicate)).update(term=prefix + str(keep))
+    model.objects.filter(pk__in=duplicates).delete()
+
+def merge_duplicate_lookups(apps, schema_editor):
+    Preference_Term = apps.get_model('marketplace_app', 'Preference_Term')
+    # the brands first, so the models of merged brands are compared by their kept brand
+    for model_name, key in [('Car_Brand', ('name',)), ('Fuel_Type', ('name',)), ('Transmission_Type', ('name',)), ('Car_Model', ('brand_id', 'name'))]:
+        model = apps.get_model('marketplace_app', model_name)
+        rows = {}
+        for row in model.objects.order_by('pk').values('pk', *key):
+            rows.setdefault(tuple(row[field] for field in key), []).append(row['pk'])
+        for keep, *duplicates in rows.values():
+            if duplicates:
+                merge_rows(model, keep, duplicates, Preference_Term)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('marketplace_app', '0019_car_file_images'),
+    ]
+
+    operations = [
+        migrations.RunPython(merge_duplicate_lookups, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,32 @@
+# Generated by Django 4.2.5 on 2026-10-18 12:37
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('marketplace_app', '0020_merge_duplicate_lookups'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='car_brand',
+            name='name',
+            field=models.CharField(max_length=30, unique=True),
+        ),
+        migrations.AlterField(
+            model_name='fuel_type',
+            name='name',
+            field=models.CharField(max_length=11, unique=True),
+        ),
+        migrations.AlterField(
+            model_name='transmission_type',
+            name='name',
+            field=models.CharField(max_length=20, unique=True),
+        ),
+        migrations.AddConstraint(
+            model_name='car_model',
+            constraint=models.UniqueConstraint(fields=('brand', 'name'), name='car_model_brand_name_uniq', violation_error_message='The brand already has a model with this name.'),
+        ),
+    ]
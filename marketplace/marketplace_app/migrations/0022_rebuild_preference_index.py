@@ -0,0 +1,24 @@
+# Generated by Django 4.2.5 on 2026-10-18 12:38
+
+from django.db import migrations
+
+
+def rebuild_preference_index(apps, schema_editor):
+    # the terms are computed by the app, as the index keeps no history of its format
+    from marketplace_app.matching import index_preferences
+
+    Preference = apps.get_model('marketplace_app', 'Preference')
+    preference_ids = list(Preference.objects.order_by('pk').values_list('pk', flat=True))
+    for start in range(0, len(preference_ids), 1000):
+        index_preferences(preference_ids[start:start + 1000])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('marketplace_app', '0021_unique_lookup_names'),
+    ]
+
+    operations = [
+        migrations.RunPython(rebuild_preference_index, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 4.2.5 on 2026-10-18 13:47
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('marketplace_app', '0022_rebuild_preference_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='car_file',
+            name='thumbnail_claimed_until',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+    ]
@@ -0,0 +1,15 @@
+# Generated by Django 4.2.5 on 2026-10-18 14:02
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('marketplace_app', '0023_car_file_thumbnail_claimed_until'),
+    ]
+
+    operations = [
+        # the partial index was dropped from 0010, a database which applied it before keeps it otherwise
+        migrations.RunSQL('DROP INDEX IF EXISTS car_available_price_idx', migrations.RunSQL.noop),
+    ]
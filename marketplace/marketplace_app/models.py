@@ -1,9 +1,14 @@
 from django.db import models
 from django.contrib.auth.models import User
+from django.contrib.postgres.indexes import GinIndex
+from django.contrib.postgres.search import SearchVectorField
 from django.core.exceptions import ValidationError
 from django.utils.translation import gettext_lazy as _
+from django.utils import timezone
 from django.utils.timezone import datetime
 
+from .lookups import get_lookup
+
 def validate_year(year):
     """
     Validate whether the year is in the correct format.
@@ -44,18 +49,22 @@ class User_Detail(models.Model):
             
 # define a natural key for car brand 
 # to be better referenced as a foreign key
+# the natural keys are found in the lookup cache, so loading a fixture does not query them per row
 class FuelTypeManager(models.Manager):
     def get_by_natural_key(self, name):
-        return self.get(name=name)
+        return get_lookup(self.model, name)
 
 class Fuel_Type(models.Model):
     '''
     The model to store fuel types.
     '''
-    name = models.CharField(max_length=11)
+    name = models.CharField(max_length=11, unique=True)
     
     objects = FuelTypeManager()
 
+    def natural_key(self):
+        return (self.name,)
+
     def __str__(self):
         return self.name
     
@@ -63,24 +72,28 @@ class Fuel_Type(models.Model):
 # to be better referenced as a foreign key
 class CarBrandManager(models.Manager):
     def get_by_natural_key(self, name):
-        return self.get(name=name)
+        return get_lookup(self.model, name)
     
 class Car_Brand(models.Model):
     '''
     The model to store car brand information.
     '''
-    name = models.CharField(max_length=30)
+    name = models.CharField(max_length=30, unique=True)
     
     objects = CarBrandManager()
 
+    def natural_key(self):
+        return (self.name,)
+
     def __str__(self) -> str:
         return self.name
 
 # define a natural key method for car model 
 # to be better referenced as a foreign key
+# a model name is only unique within its brand, so the key is the brand name and the model name
 class CarModelManager(models.Manager):
-    def get_by_natural_key(self, name):
-        return self.get(name=name)
+    def get_by_natural_key(self, brand_name, name):
+        return get_lookup(self.model, brand_name, name)
     
 class Car_Model(models.Model):
     '''
@@ -91,21 +104,33 @@ class Car_Model(models.Model):
     
     objects = CarModelManager()
 
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['brand', 'name'], name='car_model_brand_name_uniq', violation_error_message=_("The brand already has a model with this name.")),
+        ]
+
+    def natural_key(self):
+        return self.brand.natural_key() + (self.name,)
+    natural_key.dependencies = ['marketplace_app.car_brand']
+
     def __str__(self) -> str:
         return self.name
 
 class TransmissionManager(models.Manager):
         def get_by_natural_key(self, name):
-            return self.get(name=name)
+            return get_lookup(self.model, name)
     
 class Transmission_Type(models.Model):
     '''
     The model to store transmission types.
     '''
-    name = models.CharField(max_length=20)
+    name = models.CharField(max_length=20, unique=True)
     
     objects = TransmissionManager()
 
+    def natural_key(self):
+        return (self.name,)
+
     def __str__(self) -> str:
         return self.name
 
@@ -140,17 +165,70 @@ class Car(models.Model):
     owner = models.ForeignKey(User, on_delete=models.CASCADE, related_name="cars")
     prev_owner_count = models.IntegerField(default=1)
     location = models.CharField(max_length=100)
+    # brand, model, location and description, maintained by search.update_search_vectors
+    search_vector = SearchVectorField(blank=True, null=True, editable=False)
+    # the last change of the car, the ETag and Last-Modified of the API
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        indexes = [
+            GinIndex(fields=['search_vector'], name='car_search_vector_idx'),
+            # keyset pagination over every car by each sort field, and the available cars sorted by price
+            models.Index(fields=['price', 'id'], name='car_price_idx'),
+            models.Index(fields=['year', 'id'], name='car_year_idx'),
+            models.Index(fields=['odometer', 'id'], name='car_odometer_idx'),
+            models.Index(fields=['status', 'id'], name='car_status_idx'),
+            # cars of a model filtered by year, and cars of an owner by status
+            models.Index(fields=['model', 'year'], name='car_model_year_idx'),
+            models.Index(fields=['owner', 'status'], name='car_owner_status_idx'),
+            models.Index(fields=['location'], name='car_location_idx'),
+        ]
     
+    # the fields whose values are kept when a car is loaded, so a save can tell
+    # what it changes without reading the car again
+    TRACKED_FIELDS = ('year', 'price', 'odometer', 'status', 'model_id', 'fuel_type_id', 'transmission_id')
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        # the deferred fields are not loaded, their values are read if a save needs them
+        instance._loaded_values = {
+            field: value for field, value in zip(field_names, values) if field in cls.TRACKED_FIELDS
+        }
+        return instance
+
     def __str__(self) -> str:
         return "[Car ID: {}] {} {} {}, {}".format(self.id,  self.year, self.model, self.transmission, self.registration_number)
 
 
+def car_file_path(instance, filename):
+    return 'car/{}/uploads/{}'.format(instance.car_id, filename)
+
 class Car_File(models.Model):
     '''
     The model to store car files.
+    The images are stored once per content, named by their hash, see images.save_car_image.
     '''
     car = models.ForeignKey(Car, on_delete=models.CASCADE, related_name="files")
-    file = models.FileField(upload_to='car/<int:car_id>/uploads')
+    file = models.FileField(upload_to=car_file_path, max_length=255)
+    sha256 = models.CharField(max_length=64, blank=True, null=True, db_index=True)
+    # set once the thumbnails are generated, with the error if the image could not be read
+    thumbnailed_at = models.DateTimeField(blank=True, null=True)
+    thumbnail_error = models.CharField(max_length=255, blank=True)
+    # the end of the lease of the worker generating the thumbnails, after which another worker may take the image
+    thumbnail_claimed_until = models.DateTimeField(blank=True, null=True)
+
+    class Meta:
+        constraints = [
+            # an image is attached once to a car
+            models.UniqueConstraint(fields=['car', 'sha256'], name='car_file_car_sha256_uniq'),
+        ]
+        indexes = [
+            # the queue of images waiting for their thumbnails
+            models.Index(fields=['id'], condition=models.Q(thumbnailed_at__isnull=True), name='car_file_pending_idx'),
+            # the first image of a car shown on its card
+            models.Index(fields=['car', 'id'], condition=models.Q(thumbnailed_at__isnull=False, thumbnail_error=''), name='car_file_ready_idx'),
+        ]
 
 class Wishlist(models.Model):
     '''
@@ -166,6 +244,7 @@ class Order(models.Model):
     ORDER_STATUS = [
         ("PENDING", "The order is pending."),
         ("COMPLETED", "The order is completed."),
+        ("CANCELLED", "The order is cancelled."),
     ]
 
     seller = models.ForeignKey(User, on_delete=models.CASCADE, related_name= "sales_orders")
@@ -173,6 +252,14 @@ class Order(models.Model):
     car = models.ForeignKey(Car, on_delete=models.CASCADE, related_name="orders")
     status = models.CharField(max_length=9, choices=ORDER_STATUS, default="PENDING")
     order_date = models.DateTimeField(auto_now_add=True)
+    completed_at = models.DateTimeField(blank=True, null=True)
+
+    class Meta:
+        indexes = [
+            # the dashboards of a seller and of a buyer, newest first
+            models.Index(fields=['seller', 'id'], name='order_seller_idx'),
+            models.Index(fields=['buyer', 'id'], name='order_buyer_idx'),
+        ]
 
     def clean(self):
         '''
@@ -241,6 +328,68 @@ class Preference(models.Model):
     model = models.ManyToManyField(Car_Model, related_name="preferences", blank=True)
     brand = models.ManyToManyField(Car_Brand, related_name="preferences", blank=True)
 
+class Preference_Term(models.Model):
+    '''
+    The model to store the inverted index of the preferences.
+    Each row links a car attribute term, such as "fuel:2" or "price:3",
+    to a preference accepting cars with that attribute.
+    '''
+    preference = models.ForeignKey(Preference, on_delete=models.CASCADE, related_name="terms")
+    dimension = models.CharField(max_length=12)
+    term = models.CharField(max_length=40)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['term', 'preference', 'dimension'], name='preference_term_idx'),
+        ]
+
+class Notification(models.Model):
+    '''
+    The model to store the notifications waiting to be sent to a user.
+    '''
+    NOTIFICATION_KIND = [
+        ("NEW_MATCH", "A new car matches your preferences."),
+        ("PRICE_DROP", "The price of a car in your wishlist has dropped."),
+        ("STATUS_CHANGE", "A car in your wishlist is no longer available."),
+    ]
+
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name="notifications")
+    car = models.ForeignKey(Car, on_delete=models.CASCADE, related_name="notifications")
+    kind = models.CharField(max_length=16, choices=NOTIFICATION_KIND)
+    # the price before a price drop, and the status of a status change
+    previous_price = models.FloatField(blank=True, null=True)
+    status = models.CharField(max_length=11, choices=Car.CAR_STATUS, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    sent_at = models.DateTimeField(blank=True, null=True)
+
+    class Meta:
+        indexes = [
+            # the queue of notifications waiting to be sent
+            models.Index(fields=['user', 'id'], condition=models.Q(sent_at__isnull=True), name='notification_unsent_idx'),
+        ]
+
+class Outbound_Email(models.Model):
+    '''
+    The model to store the emails waiting to be sent by the email queue worker.
+    '''
+
+    subject = models.CharField(max_length=255)
+    body = models.TextField()
+    from_email = models.CharField(max_length=255, blank=True)
+    recipients = models.JSONField(default=list)
+    created_at = models.DateTimeField(auto_now_add=True)
+    # the time of the next attempt, pushed back after every failure
+    send_after = models.DateTimeField(default=timezone.now)
+    attempts = models.PositiveIntegerField(default=0)
+    last_error = models.TextField(blank=True)
+    sent_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        indexes = [
+            # the worker only reads the unsent emails, oldest first
+            models.Index(fields=['send_after', 'id'], condition=models.Q(sent_at__isnull=True), name='outbound_email_queue_idx'),
+        ]
+
 class Rating(models.Model):
     '''
     The model to store the rating information.
@@ -289,6 +438,45 @@ class Buyer_Rating(Rating):
         if self.seller == self.buyer:
             raise ValidationError(_("The buyer and seller cannot be the same person."))
         
+class Rating_Summary(models.Model):
+    '''
+    The model to store the rating aggregates of a user, as a seller and as a buyer.
+    It is kept up to date as the ratings are saved, so reading it does not scan the ratings.
+    '''
+
+    user = models.OneToOneField(User, on_delete=models.CASCADE, primary_key=True, related_name="rating_summary")
+
+    seller_rating_count = models.PositiveIntegerField(default=0)
+    seller_rating_sum = models.PositiveIntegerField(default=0)
+    seller_rating_average = models.FloatField(null=True, blank=True)
+    seller_rating_1 = models.PositiveIntegerField(default=0)
+    seller_rating_2 = models.PositiveIntegerField(default=0)
+    seller_rating_3 = models.PositiveIntegerField(default=0)
+    seller_rating_4 = models.PositiveIntegerField(default=0)
+    seller_rating_5 = models.PositiveIntegerField(default=0)
+
+    buyer_rating_count = models.PositiveIntegerField(default=0)
+    buyer_rating_sum = models.PositiveIntegerField(default=0)
+    buyer_rating_average = models.FloatField(null=True, blank=True)
+    buyer_rating_1 = models.PositiveIntegerField(default=0)
+    buyer_rating_2 = models.PositiveIntegerField(default=0)
+    buyer_rating_3 = models.PositiveIntegerField(default=0)
+    buyer_rating_4 = models.PositiveIntegerField(default=0)
+    buyer_rating_5 = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        indexes = [
+            # sort the sellers and the buyers by reputation
+            models.Index(models.F('seller_rating_average').desc(nulls_last=True), models.F('seller_rating_count').desc(), name='summary_seller_rating_idx'),
+            models.Index(models.F('buyer_rating_average').desc(nulls_last=True), models.F('buyer_rating_count').desc(), name='summary_buyer_rating_idx'),
+        ]
+
+    def seller_histogram(self):
+        return [getattr(self, 'seller_rating_{}'.format(star)) for star, _ in Rating.RATING]
+
+    def buyer_histogram(self):
+        return [getattr(self, 'buyer_rating_{}'.format(star)) for star, _ in Rating.RATING]
+
 # class Profile(models.Model):
 #     user = models.OneToOneField(User, on_delete=models.CASCADE)  
       
@@ -0,0 +1,75 @@
+from django.conf import settings
+from django.db import transaction
+from django.template.loader import render_to_string
+from django.utils import timezone
+
+from .emails import enqueue_emails
+from .models import Notification
+from .wishlists import WishlistCar
+
+APP_NAME = "marketplace_app/"
+
+def notify_new_match(car, user_ids):
+    '''
+    Queue a notification of a new car for every user whose preference it matches.
+    '''
+    notify_new_matches([car], {car.pk: user_ids})
+
+def notify_new_matches(cars, user_ids_by_car):
+    '''
+    Queue the notifications of new cars in one insert, given the ids of the
+    users whose preference matches each car.
+    '''
+    Notification.objects.bulk_create([
+        Notification(user_id=user_id, car=car, kind="NEW_MATCH")
+        for car in cars
+        for user_id in user_ids_by_car.get(car.pk, ())
+        if user_id != car.owner_id
+    ], batch_size=1000)
+
+def notify_wishlists(car, kind, **fields):
+    '''
+    Queue a notification of a change of a car for every user with the car in
+    their wishlist. The users are read in one query and the notifications
+    inserted in bulk, the digest emails are sent later by send_notifications.
+    '''
+    user_ids = WishlistCar.objects.filter(car_id=car.pk).exclude(wishlist_id=car.owner_id).values_list('wishlist_id', flat=True)
+    Notification.objects.bulk_create([
+        Notification(user_id=user_id, car=car, kind=kind, **fields)
+        for user_id in user_ids
+    ], batch_size=1000)
+
+def send_notifications(batch_size=100):
+    '''
+    Send the oldest unsent notifications, one digest email per user, through
+    the email queue. Returns the number of notifications sent.
+    '''
+    with transaction.atomic():
+        notifications = list(
+            Notification.objects.select_for_update(skip_locked=True, of=('self',))
+            .filter(sent_at__isnull=True)
+            .select_related('user', 'car__model__brand')
+            .order_by('user_id', 'id')[:batch_size]
+        )
+        if not notifications:
+            return 0
+
+        digests = {}
+        for notification in notifications:
+            digests.setdefault(notification.user, []).append(notification)
+
+        messages = []
+        for user, user_notifications in digests.items():
+            if not user.email:
+                continue
+            message = render_to_string(APP_NAME + 'notification_email.html', {
+                'user': user,
+                'notifications': user_notifications,
+                'domain': settings.SITE_DOMAIN,
+            })
+            messages.append(('Cars You May Be Interested In', message, [user.email]))
+
+        enqueue_emails(messages)
+        Notification.objects.filter(pk__in=[notification.pk for notification in notifications]).update(sent_at=timezone.now())
+
+    return len(notifications)
@@ -0,0 +1,159 @@
+from django.conf import settings
+from django.core.cache import cache
+from django.db import OperationalError, transaction
+from django.db.models import Avg, Count, F, Q, Sum
+from django.utils import timezone
+
+from .models import Car, Order
+
+class OrderError(Exception):
+    '''
+    An order that cannot be placed or changed, with the message shown to the user.
+    '''
+
+class OrderNotFound(OrderError):
+    pass
+
+class OrderForbidden(OrderError):
+    pass
+
+# the message of a car or order locked by another transaction
+LOCKED_MESSAGE = "Another buyer is ordering this car, please try again."
+
+# the postgres error of a NOWAIT lock already held by another transaction
+LOCK_NOT_AVAILABLE = '55P03'
+
+def is_lock_error(error):
+    return getattr(error.__cause__, 'sqlstate', None) == LOCK_NOT_AVAILABLE
+
+def place_order(buyer, car_id):
+    '''
+    Order a car for a buyer. The car row is locked, checked to be available,
+    and marked as pending in the same transaction that creates the order,
+    so two buyers can never order the same car. The lock is taken with
+    NOWAIT: a buyer racing another for the car fails straight away rather
+    than queueing behind the other order.
+    '''
+    try:
+        with transaction.atomic():
+            car = Car.objects.select_for_update(nowait=True).filter(pk=car_id).first()
+            if car is None:
+                raise OrderNotFound("The car does not exist.")
+            if car.owner_id == buyer.pk:
+                raise OrderForbidden("You cannot order your own car.")
+            if car.status != 'AVAILABLE':
+                raise OrderError("The car is no longer available.")
+
+            order = Order.objects.create(seller_id=car.owner_id, buyer=buyer, car=car)
+            car.status = 'PENDING'
+            car.save(update_fields=['status', 'updated_at'])
+    except OperationalError as error:
+        if not is_lock_error(error):
+            raise
+        raise OrderError(LOCKED_MESSAGE)
+    return order
+
+def lock_order(order_id):
+    '''
+    Lock a pending order and its car, in the same order as place_order locks
+    the car, so the transitions of an order never deadlock with a new order.
+    '''
+    car_id = Order.objects.filter(pk=order_id).values_list('car_id', flat=True).first()
+    if car_id is None:
+        raise OrderNotFound("The order does not exist.")
+    car = Car.objects.select_for_update(nowait=True).get(pk=car_id)
+    order = Order.objects.select_for_update(nowait=True).filter(pk=order_id, status='PENDING').first()
+    if order is None:
+        raise OrderError("The order is not pending.")
+    order.car = car
+    return order
+
+def complete_order(order_id, seller):
+    '''
+    Complete a pending order of a seller, and mark its car as sold.
+    '''
+    try:
+        with transaction.atomic():
+            order = lock_order(order_id)
+            if order.seller_id != seller.pk:
+                raise OrderForbidden("Only the seller can complete the order.")
+
+            order.status = 'COMPLETED'
+            order.completed_at = timezone.now()
+            order.save(update_fields=['status', 'completed_at'])
+            order.car.status = 'SOLD'
+            order.car.save(update_fields=['status', 'updated_at'])
+    except OperationalError as error:
+        if not is_lock_error(error):
+            raise
+        raise OrderError(LOCKED_MESSAGE)
+    return order
+
+def cancel_order(order_id, user):
+    '''
+    Cancel a pending order, by its buyer or its seller, and make its car available again.
+    '''
+    try:
+        with transaction.atomic():
+            order = lock_order(order_id)
+            if user.pk not in (order.buyer_id, order.seller_id):
+                raise OrderForbidden("Only the buyer or the seller can cancel the order.")
+
+            order.status = 'CANCELLED'
+            order.save(update_fields=['status'])
+            order.car.status = 'AVAILABLE'
+            order.car.save(update_fields=['status', 'updated_at'])
+    except OperationalError as error:
+        if not is_lock_error(error):
+            raise
+        raise OrderError(LOCKED_MESSAGE)
+    return order
+
+# the dashboards of a user, and the order field naming the user in each
+ORDER_ROLES = {
+    'sales': 'seller',
+    'purchases': 'buyer',
+}
+
+def order_stats_cache_key(role, user_id):
+    return 'order_stats:{}:{}'.format(role, user_id)
+
+def compute_order_stats(role, user_id):
+    '''
+    The number of orders by status, the value of the completed orders and
+    their average days to completion, grouped by status in one query.
+    '''
+    rows = Order.objects.filter(**{ORDER_ROLES[role]: user_id}).values('status').order_by().annotate(
+        count=Count('pk'),
+        value=Sum('car__price', filter=Q(status='COMPLETED')),
+        duration=Avg(F('completed_at') - F('order_date'), filter=Q(status='COMPLETED')),
+    )
+
+    stats = {
+        'counts': {status: 0 for status, _ in Order.ORDER_STATUS},
+        'total': 0,
+        'total_value': 0,
+        'average_days': None,
+    }
+    for row in rows:
+        stats['counts'][row['status']] = row['count']
+        stats['total'] += row['count']
+        if row['status'] == 'COMPLETED':
+            stats['total_value'] = row['value'] or 0
+            if row['duration'] is not None:
+                stats['average_days'] = row['duration'].total_seconds() / (60 * 60 * 24)
+    return stats
+
+def get_order_stats(role, user):
+    '''
+    The order stats of a dashboard, cached per user until one of their orders changes.
+    '''
+    key = order_stats_cache_key(role, user.pk)
+    stats = cache.get(key)
+    if stats is None:
+        stats = compute_order_stats(role, user.pk)
+        cache.set(key, stats, settings.ORDER_STATS_CACHE_TIMEOUT)
+    return stats
+
+def invalidate_order_stats(seller_id, buyer_id):
+    cache.delete_many([order_stats_cache_key('sales', seller_id), order_stats_cache_key('purchases', buyer_id)])
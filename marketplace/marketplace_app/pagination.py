@@ -0,0 +1,136 @@
+import base64
+import binascii
+import json
+
+from django.db.models import DecimalField, FloatField, IntegerField, Q
+
+class KeysetPage:
+    '''
+    One page of results produced by a KeysetPaginator.
+    '''
+    def __init__(self, object_list, next_cursor, cursor=None):
+        self.object_list = object_list
+        self.next_cursor = next_cursor
+        self.cursor = cursor
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+    def __len__(self):
+        return len(self.object_list)
+
+    def has_next(self):
+        return self.next_cursor is not None
+
+    def is_first(self):
+        return self.cursor is None
+
+class KeysetPaginator:
+    '''
+    Paginate a queryset with a cursor over (sort field, id) instead of OFFSET.
+    The cost of fetching a page stays the same however deep the client pages,
+    because the database seeks straight to the cursor through an index.
+
+    `ordering` is a single field name, optionally prefixed with "-" for
+    descending order. The primary key is always used as the tie-breaker.
+    '''
+    def __init__(self, queryset, ordering='-id', page_size=20):
+        self.queryset = queryset
+        self.descending = ordering.startswith('-')
+        self.field = ordering.lstrip('-')
+        self.page_size = page_size
+
+    def get_ordering(self):
+        prefix = '-' if self.descending else ''
+        if self.field == 'id':
+            return [prefix + 'id']
+        return [prefix + self.field, prefix + 'id']
+
+    def encode_cursor(self, obj):
+        # the rows of a values() queryset are dictionaries
+        get = obj.get if isinstance(obj, dict) else lambda field: getattr(obj, field)
+        if self.field == 'id':
+            position = [get('id')]
+        else:
+            position = [get(self.field), get('id')]
+        raw = json.dumps(position, separators=(',', ':')).encode()
+        return base64.urlsafe_b64encode(raw).decode().rstrip('=')
+
+    def decode_cursor(self, cursor):
+        '''
+        Return the position stored in the cursor, or None if it is invalid.
+        '''
+        try:
+            raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+            position = json.loads(raw)
+        except (binascii.Error, ValueError, TypeError):
+            return None
+
+        expected_length = 1 if self.field == 'id' else 2
+        if not isinstance(position, list) or len(position) != expected_length:
+            return None
+        if not self.is_valid_value(position[-1], IntegerField()):
+            return None
+        if self.field != 'id' and not self.is_valid_value(position[0], self.get_sort_field()):
+            return None
+        return position
+
+    def get_sort_field(self):
+        # the sort field is a field of the model, or an annotation such as a rank
+        annotation = self.queryset.query.annotations.get(self.field)
+        if annotation is not None:
+            return annotation.output_field
+        return self.queryset.model._meta.get_field(self.field)
+
+    def is_valid_value(self, value, field):
+        '''
+        Whether a value of a cursor can be compared with the field, a crafted
+        cursor could otherwise make the query fail.
+        '''
+        # a bool is an int to Python but not to the database
+        if value is None or isinstance(value, bool):
+            return False
+        if isinstance(field, IntegerField):
+            return isinstance(value, int)
+        if isinstance(field, (FloatField, DecimalField)):
+            return isinstance(value, (int, float))
+        return isinstance(value, str)
+
+    def get_filter(self, position):
+        lookup = 'lt' if self.descending else 'gt'
+        if self.field == 'id':
+            return Q(**{'id__' + lookup: position[0]})
+
+        value, last_id = position
+        return (
+            Q(**{self.field + '__' + lookup: value})
+            | Q(**{self.field: value, 'id__' + lookup: last_id})
+        )
+
+    def page(self, cursor=None):
+        queryset = self.queryset.order_by(*self.get_ordering())
+
+        position = self.decode_cursor(cursor) if cursor else None
+        if position is None:
+            cursor = None
+        else:
+            queryset = queryset.filter(self.get_filter(position))
+
+        # fetch one extra row to know whether there is a next page
+        object_list = list(queryset[:self.page_size + 1])
+        next_cursor = None
+        if len(object_list) > self.page_size:
+            object_list = object_list[:self.page_size]
+            next_cursor = self.encode_cursor(object_list[-1])
+
+        return KeysetPage(object_list, next_cursor, cursor)
+
+def get_page_size(request, default, maximum):
+    '''
+    Read the requested page size from the query string, bounded by the maximum.
+    '''
+    try:
+        page_size = int(request.GET.get('page_size', default))
+    except ValueError:
+        return default
+    return max(1, min(page_size, maximum))
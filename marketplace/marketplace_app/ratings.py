@@ -0,0 +1,88 @@
+from django.db import transaction
+from django.db.models import Count, F, FloatField, Q, Sum
+from django.db.models.functions import Cast, Coalesce, NullIf
+
+from .models import Buyer_Rating, Rating, Rating_Summary, Seller_Rating
+
+# the rated user of each kind of rating, and the prefix of its summary columns
+RATED_USER = {
+    Seller_Rating: ('seller_id', 'seller'),
+    Buyer_Rating: ('buyer_id', 'buyer'),
+}
+
+def record_rating(rating, sign=1):
+    '''
+    Add a rating to (sign=1) or remove it from (sign=-1) the summary of the rated user.
+    The columns are updated in place by the database, so concurrent ratings are not lost.
+    A summary is not created when removing, as the user may be being deleted.
+    '''
+    column, prefix = RATED_USER[type(rating)]
+    user_id = getattr(rating, column)
+    count = '{}_rating_count'.format(prefix)
+    total = '{}_rating_sum'.format(prefix)
+    updates = {
+        count: F(count) + sign,
+        total: F(total) + sign * rating.rating,
+        # the right hand side reads the values from before the update
+        '{}_rating_average'.format(prefix): Cast(F(total) + sign * rating.rating, FloatField()) / NullIf(F(count) + sign, 0),
+    }
+    # a comment can be left without a star rating
+    if rating.rating in dict(Rating.RATING):
+        star = '{}_rating_{}'.format(prefix, rating.rating)
+        updates[star] = F(star) + sign
+
+    with transaction.atomic():
+        if sign > 0:
+            Rating_Summary.objects.get_or_create(user_id=user_id)
+        Rating_Summary.objects.filter(user_id=user_id).update(**updates)
+
+def rebuild_rating_summaries(user_ids=None):
+    '''
+    Recompute the rating summaries from the ratings, for the given users or
+    for everyone. Returns the number of summaries written.
+    '''
+    aggregates = {}
+    for model, (column, prefix) in RATED_USER.items():
+        ratings = model.objects.all()
+        if user_ids is not None:
+            ratings = ratings.filter(**{column + '__in': user_ids})
+
+        stars = {
+            '{}_rating_{}'.format(prefix, star): Count('pk', filter=Q(rating=star))
+            for star, _ in Rating.RATING
+        }
+        rows = ratings.values(column).order_by().annotate(
+            count=Count('pk'),
+            total=Sum('rating'),
+            **stars
+        )
+        for row in rows:
+            summary = aggregates.setdefault(row[column], Rating_Summary(user_id=row[column]))
+            setattr(summary, '{}_rating_count'.format(prefix), row['count'])
+            setattr(summary, '{}_rating_sum'.format(prefix), row['total'])
+            setattr(summary, '{}_rating_average'.format(prefix), row['total'] / row['count'])
+            for field in stars:
+                setattr(summary, field, row[field])
+
+    summaries = Rating_Summary.objects.all()
+    if user_ids is not None:
+        summaries = summaries.filter(user_id__in=user_ids)
+    summaries.delete()
+    Rating_Summary.objects.bulk_create(aggregates.values(), batch_size=1000)
+    return len(aggregates)
+
+def get_rating_summary(user):
+    '''
+    The rating summary of a user, an empty one if the user was never rated.
+    '''
+    return Rating_Summary.objects.filter(user=user).first() or Rating_Summary(user=user)
+
+def with_seller_rating(cars):
+    '''
+    Annotate the cars with the average rating and the rating count of their seller,
+    joined from the seller's summary in the same query.
+    '''
+    return cars.annotate(
+        seller_rating=F('owner__rating_summary__seller_rating_average'),
+        seller_rating_count=Coalesce(F('owner__rating_summary__seller_rating_count'), 0),
+    )
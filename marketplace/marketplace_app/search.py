@@ -0,0 +1,194 @@
+from django.contrib.postgres.search import SearchQuery, SearchRank, TrigramWordSimilarity
+from django.db import connection, connections
+from django.db.models import F, FloatField, Q
+from django.db.models.functions import Cast, Greatest
+
+from .lookups import get_lookups
+from .models import Car, Car_Brand, Car_Model, Fuel_Type, Transmission_Type
+
+# the text search configuration of the car search vectors
+SEARCH_CONFIG = 'english'
+
+# the minimum word similarity of a misspelled brand or model name
+TRIGRAM_THRESHOLD = 0.4
+
+# sort options for the search results, mapped to the keyset ordering
+SEARCH_SORTS = {
+    'relevance': '-rank',
+    'newest': '-id',
+    'price': 'price',
+    '-price': '-price',
+    'year': 'year',
+    '-year': '-year',
+    'odometer': 'odometer',
+    '-odometer': '-odometer',
+}
+
+# facet name -> (value expression, lookup table labelling the values or None to use the value)
+FACETS = {
+    'brand': ('model__brand_id', Car_Brand),
+    'model': ('model_id', Car_Model),
+    'fuel_type': ('fuel_type_id', Fuel_Type),
+    'transmission': ('transmission_id', Transmission_Type),
+    'condition': ('condition', None),
+    'status': ('status', None),
+    'location': ('location', None),
+    'year': ('year', None),
+}
+
+# labels of the facets whose values are model choices
+FACET_CHOICES = {
+    'condition': dict(Car.CAR_CONDITION),
+    'status': dict(Car.CAR_STATUS),
+}
+
+# the maximum number of values listed per facet
+FACET_LIMIT = 10
+
+def filter_cars(queryset, data):
+    '''
+    Apply the cleaned search form data to a Car queryset.
+    '''
+    exact_filters = {
+        'brand': 'model__brand',
+        'model': 'model',
+        'fuel_type': 'fuel_type',
+        'transmission': 'transmission',
+        'condition': 'condition',
+        'status': 'status',
+        'location': 'location',
+    }
+    range_filters = {
+        'year_min': 'year__gte',
+        'year_max': 'year__lte',
+        'price_min': 'price__gte',
+        'price_max': 'price__lte',
+        'odometer_min': 'odometer__gte',
+        'odometer_max': 'odometer__lte',
+    }
+
+    filters = {}
+    for field, lookup in list(exact_filters.items()) + list(range_filters.items()):
+        value = data.get(field)
+        if value not in (None, ''):
+            filters[lookup] = value
+
+    return queryset.filter(**filters)
+
+def get_facets(queryset, limit=FACET_LIMIT):
+    '''
+    Count the cars of the queryset per value of every facet.
+    All facets and the total are computed by a single query grouping by
+    GROUPING SETS, so the cost does not depend on the number of distinct values.
+    Returns the total count and a dict of facet name -> list of
+    {'value', 'label', 'count'}, most common values first.
+    '''
+    annotations = {}
+    grouping_sets = []
+    for name, (value_expression, lookup) in FACETS.items():
+        annotations['facet_' + name] = F(value_expression)
+        grouping_sets.append(['facet_' + name])
+
+    rows_queryset = queryset.order_by().annotate(**annotations).values(*annotations)
+    rows_sql, params = rows_queryset.query.sql_with_params()
+
+    select_columns = [column for columns in grouping_sets for column in columns]
+    sql = 'SELECT {columns}, {groupings}, COUNT(*) FROM ({rows}) facet_rows GROUP BY GROUPING SETS ({sets})'.format(
+        columns=', '.join(select_columns),
+        groupings=', '.join('GROUPING({})'.format(columns[0]) for columns in grouping_sets),
+        rows=rows_sql,
+        # the empty grouping set counts all rows
+        sets=', '.join('({})'.format(', '.join(columns)) for columns in grouping_sets + [[]]),
+    )
+
+    with connections[queryset.db].cursor() as cursor:
+        cursor.execute(sql, params)
+        rows = cursor.fetchall()
+
+    total = 0
+    facets = {name: [] for name in FACETS}
+    names = list(FACETS)
+    # the names are read from the lookup cache rather than joined, once per table
+    lookup_rows = {name: get_lookups(lookup) for name, (column, lookup) in FACETS.items() if lookup is not None}
+    for row in rows:
+        values = dict(zip(select_columns, row))
+        groupings = row[len(select_columns):-1]
+        if 0 not in groupings:
+            total = row[-1]
+            continue
+
+        # the facet a row belongs to is the one whose column was grouped
+        name = names[groupings.index(0)]
+        value = values['facet_' + name]
+        lookup = FACETS[name][1]
+        if name in FACET_CHOICES:
+            label = FACET_CHOICES[name].get(value, value)
+        elif lookup is not None:
+            lookup_row = lookup_rows[name].get(value)
+            label = lookup_row.name if lookup_row is not None else value
+        else:
+            label = value
+        facets[name].append({'value': value, 'label': label, 'count': row[-1]})
+
+    for name in facets:
+        facets[name].sort(key=lambda facet: (-facet['count'], str(facet['label'])))
+        facets[name] = facets[name][:limit]
+
+    return total, facets
+
+def update_search_vectors(car_ids=None, model_ids=None, brand_ids=None):
+    '''
+    Rebuild the search vectors of the given cars, the cars of the given models
+    and the cars of the given brands, in a single UPDATE.
+    Every car is updated when no ids are given.
+    '''
+    conditions = []
+    params = []
+    for column, ids in (('car.id', car_ids), ('car.model_id', model_ids), ('model.brand_id', brand_ids)):
+        if ids is not None:
+            conditions.append('{} = ANY(%s)'.format(column))
+            params.append(list(ids))
+
+    sql = '''
+        UPDATE marketplace_app_car AS car SET search_vector =
+            setweight(to_tsvector(%s, coalesce(brand.name, '')), 'A') ||
+            setweight(to_tsvector(%s, coalesce(model.name, '')), 'A') ||
+            setweight(to_tsvector(%s, coalesce(car.location, '')), 'B') ||
+            setweight(to_tsvector(%s, coalesce(car.description, '')), 'C')
+        FROM marketplace_app_car_model AS model
+        JOIN marketplace_app_car_brand AS brand ON brand.id = model.brand_id
+        WHERE car.model_id = model.id
+    '''
+    if conditions:
+        sql += ' AND ({})'.format(' OR '.join(conditions))
+
+    with connection.cursor() as cursor:
+        cursor.execute(sql, [SEARCH_CONFIG] * 4 + params)
+
+def keyword_search(queryset, keywords):
+    '''
+    Filter a Car queryset by keywords, annotating each car with its "rank".
+    The rank is cast to double precision, so the rank stored in a page cursor
+    compares equal to the rank of its row when the cursor is sent back.
+    Cars are matched by full-text search over their search vector first.
+    When nothing matches, cars whose brand or model name is similar to the
+    keywords are returned instead, so misspelled names still find results.
+    '''
+    query = SearchQuery(keywords, config=SEARCH_CONFIG, search_type='websearch')
+    matches = queryset.filter(search_vector=query)
+    if matches.exists():
+        return matches.annotate(rank=Cast(SearchRank(F('search_vector'), query), FloatField()))
+
+    # the brand and model tables are small, so comparing every name is cheap
+    similar_models = Car_Model.objects.annotate(
+        similarity=TrigramWordSimilarity(keywords, 'name'),
+    ).filter(similarity__gte=TRIGRAM_THRESHOLD).values('id')
+    similar_brands = Car_Brand.objects.annotate(
+        similarity=TrigramWordSimilarity(keywords, 'name'),
+    ).filter(similarity__gte=TRIGRAM_THRESHOLD).values('id')
+    return queryset.filter(
+        Q(model__in=similar_models) | Q(model__brand__in=similar_brands)
+    ).annotate(rank=Cast(Greatest(
+        TrigramWordSimilarity(keywords, 'model__name'),
+        TrigramWordSimilarity(keywords, 'model__brand__name'),
+    ), FloatField()))
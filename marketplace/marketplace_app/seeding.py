@@ -0,0 +1,335 @@
+import datetime
+import random
+import string
+
+from django.contrib.auth.hashers import make_password
+from django.contrib.auth.models import User
+from django.core.management import call_command
+from django.db import connection, transaction
+
+from .listing_cache import invalidate_all_car_listings
+from .matching import index_preferences, invalidate_matches
+from .models import (
+    Buyer_Rating, Car, Car_Model, Fuel_Type, Order, Preference, Preferred_Odometer_Range,
+    Preferred_Price_Range, Preferred_Year_Range, Seller_Rating, Transmission_Type, User_Detail, Wishlist,
+)
+from .ratings import rebuild_rating_summaries
+from .search import update_search_vectors
+
+# the fixtures loaded when the database has no lookup rows to seed the cars with
+LOOKUP_FIXTURES = ('car_brand', 'car_model', 'fuel_type', 'transmission')
+
+# the cities of the cars and the users, weighted by their population in millions
+CITIES = [
+    ('Sydney', 'NSW', 5.3), ('Melbourne', 'VIC', 5.1), ('Brisbane', 'QLD', 2.6), ('Perth', 'WA', 2.2),
+    ('Adelaide', 'SA', 1.4), ('Gold Coast', 'QLD', 0.7), ('Newcastle', 'NSW', 0.5), ('Canberra', 'ACT', 0.5),
+    ('Wollongong', 'NSW', 0.3), ('Geelong', 'VIC', 0.3), ('Hobart', 'TAS', 0.25), ('Darwin', 'NT', 0.15),
+]
+
+FIRST_NAMES = ['Olivia', 'Jack', 'Charlotte', 'Noah', 'Amelia', 'William', 'Isla', 'Oliver', 'Mia', 'Leo', 'Ava', 'Lucas', 'Grace', 'Henry', 'Chloe', 'Thomas', 'Wei', 'Priya', 'Mohammed', 'Yuki']
+LAST_NAMES = ['Smith', 'Jones', 'Williams', 'Brown', 'Wilson', 'Taylor', 'Nguyen', 'Johnson', 'Martin', 'White', 'Anderson', 'Walker', 'Thompson', 'Chen', 'Kelly', 'Singh', 'Lee', 'Ryan', 'Patel', 'King']
+
+DESCRIPTIONS = [
+    None,
+    "Full service history, one careful owner.",
+    "Selling as I am moving overseas, priced to sell.",
+    "New tyres and brakes, registered until next year.",
+    "Minor scratches on the rear bumper, drives perfectly.",
+    "Dealer serviced, logbooks included, no accidents.",
+    "Needs some work, great project car.",
+]
+
+# the choices and their weights
+CAR_STATUSES = (['AVAILABLE', 'PENDING', 'SOLD', 'UNAVAILABLE'], [70, 5, 20, 5])
+STARS = ([1, 2, 3, 4, 5], [3, 4, 10, 30, 53])
+# from the newest cars to the oldest
+CONDITIONS = ['EXCELLENT', 'GOOD', 'FAIR', 'POOR']
+RATING_COMMENTS = ['', '', "Smooth sale.", "Great communication.", "Car as described.", "Late to the inspection."]
+
+# the share of the users selling cars as dealers or as private sellers, with a
+# preference and with a wishlist, and the share of the cars listed by the dealers
+DEALER_SHARE = 0.02
+DEALER_CARS_SHARE = 0.5
+SELLER_SHARE = 0.3
+PREFERENCE_SHARE = 0.3
+WISHLIST_SHARE = 0.2
+# the share of the available cars with a cancelled order, and of the completed orders rated
+CANCELLED_SHARE = 0.03
+SELLER_RATED_SHARE = 0.6
+BUYER_RATED_SHARE = 0.4
+# the mean number of cars in a wishlist
+WISHLIST_MEAN_SIZE = 5
+
+# the number of preferences indexed per batch
+INDEX_BATCH_SIZE = 1000
+
+class SeedReport:
+    '''
+    The number of rows written to each table by a seed.
+    '''
+    def __init__(self):
+        self.counts = {}
+
+    def add(self, model, count):
+        self.counts[model] = self.counts.get(model, 0) + count
+
+def seed_username(seed, number):
+    return 'seed{}-{}'.format(seed, number)
+
+def reserve_ids(model, count):
+    '''
+    Take the next ids of a table from its sequence, so the rows copied with
+    explicit ids never collide with the rows inserted by other connections.
+    '''
+    with connection.cursor() as cursor:
+        cursor.execute(
+            'SELECT nextval(pg_get_serial_sequence(%s, %s)) FROM generate_series(1, %s)',
+            [model._meta.db_table, model._meta.pk.column, count],
+        )
+        return [row[0] for row in cursor.fetchall()]
+
+def copy_rows(model, fields, rows):
+    '''
+    Stream rows into a table with COPY, the fastest way to load postgres.
+    The rows are tuples of the values of the given fields, the rows are not
+    saved through the models so no signal is sent. Returns the number of rows.
+    '''
+    columns = ', '.join(connection.ops.quote_name(model._meta.get_field(field).column) for field in fields)
+    sql = 'COPY {} ({}) FROM STDIN'.format(connection.ops.quote_name(model._meta.db_table), columns)
+    count = 0
+    with connection.cursor() as cursor, cursor.cursor.copy(sql) as copy:
+        for row in rows:
+            copy.write_row(row)
+            count += 1
+    return count
+
+def popularity_weights(generator, count, exponent=1.0):
+    # a few popular choices and a long tail, in a random order of the choices
+    weights = [1 / (rank + 1) ** exponent for rank in range(count)]
+    generator.shuffle(weights)
+    return weights
+
+class Seeder:
+    '''
+    Generate a marketplace of users, their cars, orders, ratings, preferences
+    and wishlists. Every table has its own random generator seeded from the
+    seed, so the same seed and date generate the same rows.
+    '''
+    def __init__(self, seed, today, password, stdout=None):
+        self.seed = seed
+        self.today = today
+        self.now = datetime.datetime.combine(today, datetime.time(12), tzinfo=datetime.timezone.utc)
+        self.password = make_password(password)
+        self.stdout = stdout
+        self.report = SeedReport()
+
+    def random(self, table):
+        return random.Random('{}:{}'.format(self.seed, table))
+
+    def log(self, message):
+        if self.stdout is not None:
+            self.stdout.write(message)
+
+    def days_ago(self, generator, days):
+        return self.now - datetime.timedelta(days=generator.uniform(0, days))
+
+    def load_lookups(self):
+        if not Car_Model.objects.exists():
+            call_command(*(('loaddata',) + LOOKUP_FIXTURES), verbosity=0)
+        generator = self.random('lookups')
+        self.models = list(Car_Model.objects.order_by('pk').values_list('pk', 'brand_id'))
+        self.fuel_ids = list(Fuel_Type.objects.order_by('pk').values_list('pk', flat=True))
+        self.transmission_ids = list(Transmission_Type.objects.order_by('pk').values_list('pk', flat=True))
+        # the first fuel and transmission are the most common, as petrol and automatic are
+        self.model_weights = popularity_weights(generator, len(self.models), exponent=0.8)
+        self.fuel_weights = [1 / (rank + 1) ** 2 for rank in range(len(self.fuel_ids))]
+        self.transmission_weights = [1 / (rank + 1) ** 2 for rank in range(len(self.transmission_ids))]
+        self.city_weights = [weight for _, _, weight in CITIES]
+
+    def seed_users(self, count):
+        generator = self.random('users')
+        self.user_ids = reserve_ids(User, count)
+
+        def users():
+            for number, user_id in enumerate(self.user_ids):
+                username = seed_username(self.seed, number)
+                yield (
+                    user_id, username, '{}@example.com'.format(username), self.password,
+                    generator.choice(FIRST_NAMES), generator.choice(LAST_NAMES),
+                    False, False, True, self.days_ago(generator, 3 * 365),
+                )
+
+        def details():
+            for user_id in self.user_ids:
+                city, state, _ = generator.choices(CITIES, self.city_weights)[0]
+                yield (
+                    user_id, 400000000 + generator.randrange(100000000),
+                    generator.random() < 0.8, '{}, {}'.format(city, state),
+                )
+
+        self.report.add(User, copy_rows(User, [
+            'id', 'username', 'email', 'password', 'first_name', 'last_name',
+            'is_superuser', 'is_staff', 'is_active', 'date_joined',
+        ], users()))
+        self.report.add(User_Detail, copy_rows(User_Detail, ['user', 'mobile', 'email_confirmed', 'city_address'], details()))
+
+        # a few dealers list half of the cars, the private sellers the rest
+        sellers = generator.sample(self.user_ids, max(2, int(count * (DEALER_SHARE + SELLER_SHARE))))
+        dealer_count = max(1, int(count * DEALER_SHARE))
+        self.dealer_ids, self.private_seller_ids = sellers[:dealer_count], sellers[dealer_count:]
+
+    def car_row(self, generator, car_id, owner_id):
+        age = min(int(generator.expovariate(1 / 6)), 30)
+        model_id, _ = generator.choices(self.models, self.model_weights)[0]
+        city, state, _ = generator.choices(CITIES, self.city_weights)[0]
+        # a new car loses about a tenth of its value every year
+        price = max(500, round(generator.lognormvariate(10.3, 0.45) * 0.9 ** age, -2))
+        odometer = max(0, int(age * generator.gauss(14000, 5000) + generator.uniform(0, 2000)))
+        condition = CONDITIONS[min(3, max(0, int(age / 6 + generator.gauss(0, 0.8))))]
+        return (
+            car_id, self.today.year - age, model_id,
+            ''.join(generator.choices(string.ascii_uppercase + string.digits, k=6)),
+            generator.choices(*CAR_STATUSES)[0], generator.choice(DESCRIPTIONS),
+            odometer, price, condition,
+            generator.choices(self.fuel_ids, self.fuel_weights)[0],
+            generator.choices(self.transmission_ids, self.transmission_weights)[0],
+            owner_id, 1 + min(age // 4, int(generator.expovariate(1))),
+            '{}, {}, Australia'.format(city, state), self.days_ago(generator, 365),
+        )
+
+    def order_row(self, generator, car_id, seller_id, status, updated_at):
+        buyer_id = generator.choice(self.user_ids)
+        while buyer_id == seller_id:
+            buyer_id = generator.choice(self.user_ids)
+        order_date = updated_at - datetime.timedelta(days=generator.uniform(0, 60))
+        if status == 'SOLD':
+            return (seller_id, buyer_id, car_id, 'COMPLETED', order_date, updated_at)
+        if status == 'PENDING':
+            return (seller_id, buyer_id, car_id, 'PENDING', order_date, None)
+        return (seller_id, buyer_id, car_id, 'CANCELLED', order_date, None)
+
+    def seed_cars(self, count):
+        generator = self.random('cars')
+        self.car_ids = reserve_ids(Car, count)
+        self.orders = []
+
+        def cars():
+            for car_id in self.car_ids:
+                sellers = self.dealer_ids if generator.random() < DEALER_CARS_SHARE else self.private_seller_ids
+                row = self.car_row(generator, car_id, generator.choice(sellers))
+                status, owner_id, updated_at = row[4], row[11], row[14]
+                # the sold and pending cars have an order, a few available cars had one cancelled
+                if status in ('SOLD', 'PENDING') or (status == 'AVAILABLE' and generator.random() < CANCELLED_SHARE):
+                    self.orders.append(self.order_row(generator, car_id, owner_id, status, updated_at))
+                yield row
+
+        self.report.add(Car, copy_rows(Car, [
+            'id', 'year', 'model', 'registration_number', 'status', 'description', 'odometer', 'price',
+            'condition', 'fuel_type', 'transmission', 'owner', 'prev_owner_count', 'location', 'updated_at',
+        ], cars()))
+        self.report.add(Order, copy_rows(Order, ['seller', 'buyer', 'car', 'status', 'order_date', 'completed_at'], self.orders))
+
+    def seed_ratings(self):
+        generator = self.random('ratings')
+        completed = [order for order in self.orders if order[3] == 'COMPLETED']
+        seller_ratings = (
+            (seller_id, buyer_id, generator.choices(*STARS)[0], generator.choice(RATING_COMMENTS))
+            for seller_id, buyer_id, *_ in completed if generator.random() < SELLER_RATED_SHARE
+        )
+        self.report.add(Seller_Rating, copy_rows(Seller_Rating, ['seller', 'buyer', 'rating', 'comment'], seller_ratings))
+        buyer_ratings = (
+            (buyer_id, seller_id, generator.choices(*STARS)[0], generator.choice(RATING_COMMENTS))
+            for seller_id, buyer_id, *_ in completed if generator.random() < BUYER_RATED_SHARE
+        )
+        self.report.add(Buyer_Rating, copy_rows(Buyer_Rating, ['buyer', 'seller', 'rating', 'comment'], buyer_ratings))
+
+    def seed_preferences(self):
+        generator = self.random('preferences')
+        self.preference_ids = sorted(generator.sample(self.user_ids, int(len(self.user_ids) * PREFERENCE_SHARE)))
+        year_ids = reserve_ids(Preferred_Year_Range, len(self.preference_ids))
+        price_ids = reserve_ids(Preferred_Price_Range, len(self.preference_ids))
+        odometer_ids = reserve_ids(Preferred_Odometer_Range, len(self.preference_ids))
+
+        # the ranges and the choices of each preference, a buyer sets some of them only
+        years, prices, odometers, preferences = [], [], [], []
+        choices = {'fuel': [], 'transmission': [], 'model': [], 'brand': []}
+        for user_id, year_id, price_id, odometer_id in zip(self.preference_ids, year_ids, price_ids, odometer_ids):
+            preference = [user_id, None, None, None]
+            if generator.random() < 0.6:
+                years.append((year_id, self.today.year - generator.randint(2, 15), self.today.year - generator.randint(0, 1)))
+                preference[1] = year_id
+            if generator.random() < 0.7:
+                price_max = round(generator.lognormvariate(10.2, 0.5), -3)
+                prices.append((price_id, round(price_max * generator.uniform(0, 0.6), -3), price_max))
+                preference[2] = price_id
+            if generator.random() < 0.4:
+                odometers.append((odometer_id, 0, generator.choice([50000, 100000, 150000, 200000])))
+                preference[3] = odometer_id
+            preferences.append(preference)
+
+            if generator.random() < 0.5:
+                brand_ids = {brand_id for _, brand_id in generator.choices(self.models, self.model_weights, k=generator.randint(1, 3))}
+                choices['brand'].extend((user_id, brand_id) for brand_id in brand_ids)
+            elif generator.random() < 0.4:
+                model_ids = {model_id for model_id, _ in generator.choices(self.models, self.model_weights, k=generator.randint(1, 2))}
+                choices['model'].extend((user_id, model_id) for model_id in model_ids)
+            if generator.random() < 0.3:
+                choices['fuel'].append((user_id, generator.choices(self.fuel_ids, self.fuel_weights)[0]))
+            if generator.random() < 0.3:
+                choices['transmission'].append((user_id, generator.choices(self.transmission_ids, self.transmission_weights)[0]))
+
+        self.report.add(Preferred_Year_Range, copy_rows(Preferred_Year_Range, ['id', 'year_min', 'year_max'], years))
+        self.report.add(Preferred_Price_Range, copy_rows(Preferred_Price_Range, ['id', 'price_min', 'price_max'], prices))
+        self.report.add(Preferred_Odometer_Range, copy_rows(Preferred_Odometer_Range, ['id', 'odometer_min', 'odometer_max'], odometers))
+        self.report.add(Preference, copy_rows(Preference, ['user', 'year_range', 'price_range', 'odometer_range'], preferences))
+        for field, rows in choices.items():
+            through = getattr(Preference, field).through
+            # the through table columns are named after the models, such as car_brand
+            self.report.add(through, copy_rows(through, [f.name for f in through._meta.fields if f.name != 'id'], rows))
+
+    def seed_wishlists(self):
+        generator = self.random('wishlists')
+        user_ids = sorted(generator.sample(self.user_ids, int(len(self.user_ids) * WISHLIST_SHARE)))
+        rows = []
+        for user_id in user_ids:
+            size = min(len(self.car_ids), 1 + int(generator.expovariate(1 / (WISHLIST_MEAN_SIZE - 1))))
+            rows.extend((user_id, car_id) for car_id in sorted(generator.sample(self.car_ids, size)))
+        self.report.add(Wishlist, copy_rows(Wishlist, ['user'], ((user_id,) for user_id in user_ids)))
+        self.report.add(Wishlist.cars.through, copy_rows(Wishlist.cars.through, ['wishlist', 'car'], rows))
+
+    def rebuild(self):
+        '''
+        Rebuild what the signals keep up to date as rows are saved one by one:
+        the search vectors, the preference index and the rating summaries.
+        '''
+        self.log("Rebuilding the search vectors...")
+        for start in range(0, len(self.car_ids), INDEX_BATCH_SIZE * 100):
+            update_search_vectors(car_ids=self.car_ids[start:start + INDEX_BATCH_SIZE * 100])
+        self.log("Indexing the preferences...")
+        for start in range(0, len(self.preference_ids), INDEX_BATCH_SIZE):
+            index_preferences(self.preference_ids[start:start + INDEX_BATCH_SIZE])
+        self.log("Rebuilding the rating summaries...")
+        rebuild_rating_summaries()
+
+    def run(self, users, cars):
+        # the cached matches of the existing buyers miss the new cars
+        existing_preference_ids = list(Preference.objects.values_list('pk', flat=True))
+        with transaction.atomic():
+            self.load_lookups()
+            self.log("Seeding {} users...".format(users))
+            self.seed_users(users)
+            self.log("Seeding {} cars...".format(cars))
+            self.seed_cars(cars)
+            self.log("Seeding the ratings, preferences and wishlists...")
+            self.seed_ratings()
+            self.seed_preferences()
+            self.seed_wishlists()
+            self.rebuild()
+            transaction.on_commit(invalidate_all_car_listings)
+            transaction.on_commit(lambda: invalidate_matches(existing_preference_ids))
+
+        # refresh the planner statistics of the tables, outside of the transaction
+        with connection.cursor() as cursor:
+            for model in self.report.counts:
+                cursor.execute('ANALYZE {}'.format(connection.ops.quote_name(model._meta.db_table)))
+        return self.report
@@ -0,0 +1,262 @@
+from django.db import transaction
+from django.utils import timezone
+from django.db.models.signals import m2m_changed, post_delete, post_save, pre_save
+from django.dispatch import receiver
+
+from .images import delete_car_image
+from .lookups import invalidate_lookups
+from .listing_cache import invalidate_all_car_listings, invalidate_car_listings
+from .matching import MATCHING_FIELDS, index_preferences, invalidate_matches, matching_user_ids
+from .models import *
+from .notifications import notify_new_match, notify_wishlists
+from .orders import invalidate_order_stats
+from .ratings import RATED_USER, rebuild_rating_summaries, record_rating
+from .search import update_search_vectors
+
+# fields of a car that are part of its search vector
+SEARCH_VECTOR_FIELDS = {'model', 'location', 'description'}
+
+@receiver(post_save, sender=Car)
+def update_car_search_vector(sender, instance, update_fields=None, **kwargs):
+    if update_fields is None or SEARCH_VECTOR_FIELDS.intersection(update_fields):
+        update_search_vectors(car_ids=[instance.pk])
+
+@receiver(post_save, sender=Car_Model)
+def update_model_search_vectors(sender, instance, created=False, **kwargs):
+    # a new model has no cars yet
+    if not created:
+        update_search_vectors(model_ids=[instance.pk])
+
+@receiver(post_save, sender=Car_Brand)
+def update_brand_search_vectors(sender, instance, created=False, **kwargs):
+    if not created:
+        update_search_vectors(brand_ids=[instance.pk])
+
+@receiver(pre_save, sender=Car)
+def capture_car_changes(sender, instance, update_fields=None, raw=False, **kwargs):
+    '''
+    Keep the values of the tracked fields from before this save, and the
+    saved fields that change, from the values kept when the car was loaded.
+    The car is only read again when it was not loaded with all of them.
+    '''
+    instance._previous_values = None
+    instance._changes = {}
+    if raw:
+        return
+    if instance.pk is None:
+        # a new car is written as it is
+        instance._loaded_values = {field: getattr(instance, field) for field in Car.TRACKED_FIELDS}
+        return
+
+    loaded = getattr(instance, '_loaded_values', {})
+    if len(loaded) < len(Car.TRACKED_FIELDS):
+        loaded = Car.objects.filter(pk=instance.pk).values(*Car.TRACKED_FIELDS).first()
+        if loaded is None:
+            return
+
+    saved = {field.attname for field in Car._meta.concrete_fields if update_fields is None or field.name in update_fields}
+    instance._previous_values = dict(loaded)
+    instance._changes = {
+        field: value for field, value in loaded.items()
+        if field in saved and getattr(instance, field) != value
+    }
+    # the next save compares with the values written by this one
+    instance._loaded_values = {field: getattr(instance, field) if field in saved else value for field, value in loaded.items()}
+
+@receiver(pre_save, sender=Car)
+def find_previous_matches(sender, instance, update_fields=None, raw=False, **kwargs):
+    # the users the car matched before this save
+    instance._previous_match_user_ids = set()
+    if raw or instance._previous_values is None:
+        return
+    if update_fields is not None and not MATCHING_FIELDS.intersection(update_fields):
+        return
+
+    previous = Car(pk=instance.pk, **instance._previous_values)
+    instance._previous_match_user_ids = matching_user_ids(previous)
+
+@receiver(post_save, sender=Car)
+def update_matches(sender, instance, created=False, update_fields=None, raw=False, **kwargs):
+    if raw or (update_fields is not None and not MATCHING_FIELDS.intersection(update_fields)):
+        return
+
+    previous_user_ids = getattr(instance, '_previous_match_user_ids', set())
+    user_ids = matching_user_ids(instance)
+    if created:
+        notify_new_match(instance, user_ids)
+    # only the users the car started or stopped matching are affected
+    changed_user_ids = user_ids ^ previous_user_ids
+    transaction.on_commit(lambda: invalidate_matches(changed_user_ids))
+
+# the statuses the buyers wishlisting a car are told about
+WISHLIST_ALERT_STATUSES = {'PENDING', 'SOLD'}
+
+@receiver(post_save, sender=Car)
+def notify_wishlist_changes(sender, instance, created=False, raw=False, **kwargs):
+    if created or raw:
+        return
+    changes = getattr(instance, '_changes', {})
+    if 'price' in changes and instance.price < changes['price']:
+        notify_wishlists(instance, 'PRICE_DROP', previous_price=changes['price'])
+    if 'status' in changes and instance.status in WISHLIST_ALERT_STATUSES:
+        notify_wishlists(instance, 'STATUS_CHANGE', status=instance.status)
+
+@receiver(post_delete, sender=Car)
+def remove_matches(sender, instance, **kwargs):
+    user_ids = matching_user_ids(instance)
+    transaction.on_commit(lambda: invalidate_matches(user_ids))
+
+@receiver(post_save, sender=Preference)
+def update_preference_matches(sender, instance, raw=False, **kwargs):
+    if not raw:
+        index_preferences([instance.pk])
+    user_id = instance.user_id
+    transaction.on_commit(lambda: invalidate_matches([user_id]))
+
+@receiver(post_delete, sender=Preference)
+def invalidate_preference_matches(sender, instance, **kwargs):
+    user_id = instance.user_id
+    transaction.on_commit(lambda: invalidate_matches([user_id]))
+
+@receiver(m2m_changed, sender=Preference.fuel.through)
+@receiver(m2m_changed, sender=Preference.transmission.through)
+@receiver(m2m_changed, sender=Preference.model.through)
+@receiver(m2m_changed, sender=Preference.brand.through)
+def update_preference_choice_matches(sender, instance, action, reverse, pk_set=None, **kwargs):
+    if reverse and action == 'pre_clear':
+        # the instance is a fuel type, transmission, model or brand, whose
+        # preferences are only known before they are cleared
+        instance._cleared_preference_ids = list(instance.preferences.values_list('user_id', flat=True))
+        return
+    if not action.startswith('post_'):
+        return
+    if not reverse:
+        user_ids = [instance.pk]
+    elif action == 'post_clear':
+        user_ids = getattr(instance, '_cleared_preference_ids', [])
+    else:
+        user_ids = list(pk_set or [])
+    index_preferences(user_ids)
+    transaction.on_commit(lambda: invalidate_matches(user_ids))
+
+@receiver(post_save, sender=Preferred_Year_Range)
+@receiver(post_save, sender=Preferred_Price_Range)
+@receiver(post_save, sender=Preferred_Odometer_Range)
+def update_range_matches(sender, instance, created=False, **kwargs):
+    # a new range is not used by any preference yet
+    if created:
+        return
+    user_ids = list(instance.preferences.values_list('user_id', flat=True))
+    index_preferences(user_ids)
+    transaction.on_commit(lambda: invalidate_matches(user_ids))
+
+@receiver(post_save, sender=Seller_Rating)
+@receiver(post_save, sender=Buyer_Rating)
+def add_rating_to_summary(sender, instance, created=False, raw=False, **kwargs):
+    if raw:
+        return
+    if created:
+        record_rating(instance)
+    else:
+        # the rating may have changed, recompute the summary of the rated user
+        rebuild_rating_summaries([getattr(instance, RATED_USER[sender][0])])
+
+@receiver(post_delete, sender=Seller_Rating)
+@receiver(post_delete, sender=Buyer_Rating)
+def remove_rating_from_summary(sender, instance, **kwargs):
+    record_rating(instance, sign=-1)
+
+# fields of a user shown on the listings of their cars
+SELLER_FIELDS = {'first_name', 'last_name'}
+
+@receiver(post_save, sender=Car)
+@receiver(post_delete, sender=Car)
+def invalidate_car_listing(sender, instance, **kwargs):
+    car_id = instance.pk
+    transaction.on_commit(lambda: invalidate_car_listings([car_id]))
+
+@receiver(post_save, sender=Car_Brand)
+@receiver(post_save, sender=Car_Model)
+@receiver(post_save, sender=Fuel_Type)
+@receiver(post_save, sender=Transmission_Type)
+@receiver(post_delete, sender=Car_Brand)
+@receiver(post_delete, sender=Car_Model)
+@receiver(post_delete, sender=Fuel_Type)
+@receiver(post_delete, sender=Transmission_Type)
+def invalidate_all_car_listing(sender, created=False, **kwargs):
+    # a new lookup row is not shown on any listing yet
+    if not created:
+        transaction.on_commit(invalidate_all_car_listings)
+
+def invalidate_seller_car_listings(seller_id):
+    car_ids = list(Car.objects.filter(owner_id=seller_id).values_list('id', flat=True))
+    transaction.on_commit(lambda: invalidate_car_listings(car_ids))
+
+@receiver(post_save, sender=User)
+def invalidate_seller_listings(sender, instance, created=False, update_fields=None, raw=False, **kwargs):
+    # logging in only updates last_login
+    if created or raw or (update_fields is not None and not SELLER_FIELDS.intersection(update_fields)):
+        return
+    invalidate_seller_car_listings(instance.pk)
+
+@receiver(post_save, sender=Seller_Rating)
+@receiver(post_delete, sender=Seller_Rating)
+def invalidate_rated_seller_listings(sender, instance, raw=False, **kwargs):
+    if not raw:
+        invalidate_seller_car_listings(instance.seller_id)
+
+# the cars showing a renamed lookup row, to change their updated_at and so their ETag
+@receiver(post_save, sender=Car_Brand)
+@receiver(post_save, sender=Car_Model)
+@receiver(post_save, sender=Fuel_Type)
+@receiver(post_save, sender=Transmission_Type)
+def touch_cars(sender, instance, created=False, raw=False, **kwargs):
+    if created or raw:
+        return
+    lookup = {
+        Car_Brand: 'model__brand',
+        Car_Model: 'model',
+        Fuel_Type: 'fuel_type',
+        Transmission_Type: 'transmission',
+    }[sender]
+    Car.objects.filter(**{lookup: instance}).update(updated_at=timezone.now())
+
+@receiver(post_save, sender=Car_Brand)
+@receiver(post_save, sender=Car_Model)
+@receiver(post_save, sender=Fuel_Type)
+@receiver(post_save, sender=Transmission_Type)
+@receiver(post_delete, sender=Car_Brand)
+@receiver(post_delete, sender=Car_Model)
+@receiver(post_delete, sender=Fuel_Type)
+@receiver(post_delete, sender=Transmission_Type)
+def invalidate_lookup_cache(sender, **kwargs):
+    # the models are loaded and found with the name of their brand
+    models = [sender, Car_Model] if sender is Car_Brand else [sender]
+
+    def invalidate():
+        for model in models:
+            invalidate_lookups(model)
+
+    # again once committed, in case another process reloaded the table in between
+    invalidate()
+    transaction.on_commit(invalidate)
+
+@receiver(post_save, sender=Order)
+@receiver(post_delete, sender=Order)
+def invalidate_order_dashboards(sender, instance, **kwargs):
+    seller_id, buyer_id = instance.seller_id, instance.buyer_id
+    transaction.on_commit(lambda: invalidate_order_stats(seller_id, buyer_id))
+
+# the images are shown on the cached car listing
+@receiver(post_save, sender=Car_File)
+def invalidate_car_image_listing(sender, instance, raw=False, **kwargs):
+    if not raw:
+        car_id = instance.car_id
+        transaction.on_commit(lambda: invalidate_car_listings([car_id]))
+
+@receiver(post_delete, sender=Car_File)
+def remove_car_image(sender, instance, **kwargs):
+    car_id, name, sha256 = instance.car_id, instance.file.name, instance.sha256
+    transaction.on_commit(lambda: invalidate_car_listings([car_id]))
+    # the stored file may be shared with other cars
+    transaction.on_commit(lambda: delete_car_image(name, sha256))
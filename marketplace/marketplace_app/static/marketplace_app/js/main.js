@@ -21,3 +21,24 @@ $('.star').on('click', function() {
     }).appendTo('form');
 });
 
+
+// car form: load the models of the chosen brand
+$('[data-model-select]').on('change', function() {
+    const modelSelect = $('#' + $(this).data('model-select'));
+    const brand = $(this).val();
+
+    modelSelect.find('option[value!=""]').remove();
+    if (!brand) {
+        return;
+    }
+
+    // the url is rendered for brand 0
+    const url = modelSelect.data('models-url').replace('/0/', '/' + brand + '/');
+    fetch(url, {credentials: 'same-origin'})
+        .then(response => response.json())
+        .then(data => {
+            data.results.forEach(model => {
+                $('<option>').val(model.id).text(model.name).appendTo(modelSelect);
+            });
+        });
+});
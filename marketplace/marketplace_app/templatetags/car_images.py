@@ -0,0 +1,19 @@
+from django import template
+from django.core.files.storage import default_storage
+from django.templatetags.static import static
+
+from ..images import thumbnail_name
+
+register = template.Library()
+
+# shown for the cars without an image
+PLACEHOLDER_IMAGE = 'marketplace_app/img/no_image.svg'
+
+@register.filter
+def thumbnail(sha256, size='card'):
+    '''
+    The url of a thumbnail of a car image, from the hash of the image.
+    '''
+    if not sha256:
+        return static(PLACEHOLDER_IMAGE)
+    return default_storage.url(thumbnail_name(sha256, size))
@@ -0,0 +1,116 @@
+import re
+from collections import Counter
+from contextlib import ContextDecorator
+
+from django.db import connection
+from django.test import Client
+from django.test.utils import CaptureQueriesContext
+from django.urls import Resolver404, resolve
+
+from marketplace_app.urls import QUERY_BUDGETS
+
+# the literals of a query, replaced to find the same query run with other values
+LITERAL_PATTERN = re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b|\$\d+")
+IN_LIST_PATTERN = re.compile(r'IN \((?:\?, )*\?\)')
+# the statements of the transactions, which repeat by design
+TRANSACTION_PATTERN = re.compile(r'^(SAVEPOINT|RELEASE SAVEPOINT|ROLLBACK TO SAVEPOINT)\b')
+
+# the times a query may run with other literals, such as loading the user and
+# a seller, before it is taken for a query run for each row of a list
+MAX_REPEATS = 2
+
+class QueryBudgetExceeded(AssertionError):
+    pass
+
+def normalize_sql(sql):
+    return IN_LIST_PATTERN.sub('IN (?)', LITERAL_PATTERN.sub('?', sql))
+
+def duplicate_queries(queries, max_repeats=MAX_REPEATS):
+    '''
+    The queries run twice with the same literals, and the queries run more
+    than max_repeats times with only their literals changed, the pattern of
+    a query run for each row of a list, with how many times they ran.
+    '''
+    queries = [query['sql'] for query in queries if not TRANSACTION_PATTERN.match(query['sql'])]
+    duplicates = {sql: count for sql, count in Counter(queries).items() if count > 1}
+    if max_repeats is not None:
+        duplicates.update(
+            (sql, count) for sql, count in Counter(normalize_sql(sql) for sql in queries).items()
+            if count > max_repeats
+        )
+    return duplicates
+
+def check_query_budget(queries, max_queries, max_repeats=MAX_REPEATS, label='The code'):
+    '''
+    Raise QueryBudgetExceeded listing the queries when there are more than the
+    budget, or when a query is duplicated or repeated for each row.
+    '''
+    problems = []
+    if max_queries is not None and len(queries) > max_queries:
+        problems.append("{} ran {} queries, over its budget of {}.".format(label, len(queries), max_queries))
+    problems.extend(
+        "{} ran the same query {} times: {}".format(label, count, sql)
+        for sql, count in duplicate_queries(queries, max_repeats).items()
+    )
+    if problems:
+        problems.extend('{}. {}'.format(number, query['sql']) for number, query in enumerate(queries, start=1))
+        raise QueryBudgetExceeded('\n'.join(problems))
+
+class query_budget(ContextDecorator):
+    '''
+    Fail when the code of the block, or the decorated function, runs more than
+    max_queries queries, or runs a query twice or once for each row.
+
+        with query_budget(2):
+            place_order(buyer, car.pk)
+    '''
+    def __init__(self, max_queries, max_repeats=MAX_REPEATS):
+        self.max_queries = max_queries
+        self.max_repeats = max_repeats
+
+    def __enter__(self):
+        self.context = CaptureQueriesContext(connection)
+        self.context.__enter__()
+        return self.context
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.context.__exit__(exc_type, exc_value, traceback)
+        if exc_type is None:
+            check_query_budget(self.context.captured_queries, self.max_queries, self.max_repeats)
+
+def get_query_budget(url_name, method):
+    '''
+    The budget of a url of the app declared in QUERY_BUDGETS, a number for
+    every method or a number by method, None for a view not budgeted.
+    '''
+    if url_name not in QUERY_BUDGETS:
+        raise QueryBudgetExceeded("The url {} has no query budget in QUERY_BUDGETS.".format(url_name))
+    budget = QUERY_BUDGETS[url_name]
+    if isinstance(budget, dict):
+        if method not in budget:
+            raise QueryBudgetExceeded("The url {} has no {} query budget in QUERY_BUDGETS.".format(url_name, method))
+        return budget[method]
+    return budget
+
+class QueryBudgetClient(Client):
+    '''
+    A test client checking every request to a view of the app against the
+    budget of its url, so every view test fails when the view runs more
+    queries than its budget or runs a query once per row.
+    Set client_class = QueryBudgetClient on a test case to check its requests.
+    '''
+    def request(self, **request):
+        with CaptureQueriesContext(connection) as queries:
+            response = super().request(**request)
+
+        try:
+            match = resolve(request['PATH_INFO'])
+        except Resolver404:
+            return response
+        # the budgets are declared for the urls of the app only
+        if match.func.__module__.startswith('marketplace_app.'):
+            max_queries = get_query_budget(match.url_name, request['REQUEST_METHOD'])
+            if max_queries is not None:
+                label = '{} {}'.format(request['REQUEST_METHOD'], request['PATH_INFO'])
+                check_query_budget(queries.captured_queries, max_queries, label=label)
+        return response
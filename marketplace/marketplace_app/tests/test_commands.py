@@ -0,0 +1,571 @@
+import csv
+import json
+import os
+import tempfile
+from io import BytesIO, StringIO
+from unittest import mock
+
+from django.core import mail
+from django.core.files.storage import default_storage
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.mail.backends.locmem import EmailBackend
+from django.core.management import CommandError, call_command
+from django.db import connection, transaction
+from django.db.models import F, Sum
+from django.conf import settings
+from django.core.cache import cache
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+
+from marketplace_app.emails import enqueue_email, send_queued_emails
+from marketplace_app.images import generate_thumbnails, image_name, save_car_image, thumbnail_name
+from marketplace_app.importer import import_cars
+from marketplace_app.matching import get_matching_car_ids, matches_cache_key, matching_user_ids
+from marketplace_app.models import *
+from marketplace_app.tests.query_budget import query_budget
+from PIL import Image
+
+class BenchmarkCarIndexesTest(TestCase):
+    def test_benchmark_rolls_back(self):
+        '''
+        Test the benchmark reports every query and leaves no seeded rows behind
+        '''
+        out = StringIO()
+        call_command('benchmark_car_indexes', rows=500, stdout=out)
+
+        self.assertIn('Available cars by price', out.getvalue())
+        self.assertIn('with indexes: ', out.getvalue())
+        self.assertFalse(Car.objects.exists())
+        self.assertFalse(Car_Brand.objects.exists())
+
+class RebuildPreferenceIndexTest(TestCase):
+    def test_rebuild_preference_index(self):
+        '''
+        Test the index is rebuilt for every preference
+        '''
+        buyer = User.objects.create(username='buyer@example.com', email='buyer@example.com')
+        preference = Preference.objects.create(
+            user=buyer,
+            year_range=Preferred_Year_Range.objects.create(year_min=2018, year_max=2020),
+        )
+        Preference_Term.objects.all().delete()
+
+        out = StringIO()
+        call_command('rebuild_preference_index', stdout=out)
+
+        self.assertIn('Indexed 1 preferences.', out.getvalue())
+        self.assertEqual(
+            set(preference.terms.filter(dimension='year').values_list('term', flat=True)),
+            {'year:2018', 'year:2019', 'year:2020'},
+        )
+        # only the dimension the preference restricts is indexed
+        self.assertEqual(preference.terms.count(), 3)
+
+class RebuildRatingSummariesTest(TestCase):
+    def test_rebuild_rating_summaries(self):
+        '''
+        Test the summaries are recomputed from the ratings
+        '''
+        seller = User.objects.create(username='seller@example.com', email='seller@example.com')
+        buyer = User.objects.create(username='buyer@example.com', email='buyer@example.com')
+        Seller_Rating.objects.create(rating=4, seller=seller, buyer=buyer)
+        Seller_Rating.objects.create(rating=2, seller=seller, buyer=buyer)
+        Rating_Summary.objects.update(seller_rating_count=0, seller_rating_sum=0, seller_rating_average=None)
+
+        out = StringIO()
+        call_command('rebuild_rating_summaries', stdout=out)
+
+        self.assertIn('Rebuilt 1 rating summaries.', out.getvalue())
+        summary = Rating_Summary.objects.get(user=seller)
+        self.assertEqual(summary.seller_rating_count, 2)
+        self.assertEqual(summary.seller_rating_average, 3)
+        self.assertEqual(summary.seller_histogram(), [0, 1, 0, 1, 0])
+
+class FailingEmailBackend(EmailBackend):
+    '''
+    A mail backend rejecting every email, as an unreachable mail server would.
+    '''
+    def send_messages(self, messages):
+        raise ConnectionRefusedError("Connection refused")
+
+class CountingEmailBackend(EmailBackend):
+    '''
+    A mail backend counting the connections opened to the mail server, and
+    recording the queued emails as they are while being sent.
+    '''
+    opened = 0
+    claimed = []
+
+    connection = None
+
+    def open(self):
+        # like the SMTP backend, an open connection is reused
+        if self.connection:
+            return False
+        self.connection = True
+        CountingEmailBackend.opened += 1
+        return True
+
+    def close(self):
+        self.connection = None
+
+    def send_messages(self, messages):
+        CountingEmailBackend.claimed.extend(Outbound_Email.objects.values_list('attempts', 'send_after'))
+        return super().send_messages(messages)
+
+@override_settings(EMAIL_QUEUE_MAX_ATTEMPTS=2, EMAIL_QUEUE_RETRY_DELAY=60, EMAIL_QUEUE_LEASE=300)
+class SendQueuedEmailsTest(TestCase):
+    def test_send_queued_emails(self):
+        '''
+        Test every queued email is sent once, over a single connection
+        '''
+        for index in range(3):
+            enqueue_email('Subject {}'.format(index), 'Body', ['user{}@example.com'.format(index)])
+
+        out = StringIO()
+        call_command('send_queued_emails', batch_size=2, stdout=out)
+
+        self.assertIn('Sent 2 emails.', out.getvalue())
+        self.assertIn('Sent 1 emails.', out.getvalue())
+        self.assertEqual([message.subject for message in mail.outbox], ['Subject 0', 'Subject 1', 'Subject 2'])
+        self.assertFalse(Outbound_Email.objects.filter(sent_at__isnull=True).exists())
+
+        call_command('send_queued_emails', stdout=out)
+        self.assertEqual(len(mail.outbox), 3)
+
+    @override_settings(EMAIL_BACKEND='marketplace_app.tests.test_commands.CountingEmailBackend')
+    def test_send_queued_emails_connects_when_due(self):
+        '''
+        Test the mail server is not connected to while the queue is empty, and the emails are claimed before they are sent
+        '''
+        CountingEmailBackend.opened = 0
+        CountingEmailBackend.claimed = []
+        call_command('send_queued_emails', stdout=StringIO())
+        self.assertEqual(CountingEmailBackend.opened, 0)
+
+        enqueue_email('Subject', 'Body', ['user@example.com'])
+        call_command('send_queued_emails', stdout=StringIO())
+        self.assertEqual(CountingEmailBackend.opened, 1)
+        self.assertEqual(len(mail.outbox), 1)
+        # the attempt was counted and the email leased to the worker before it was sent
+        attempts, send_after = CountingEmailBackend.claimed[0]
+        self.assertEqual(attempts, 1)
+        self.assertGreater(send_after, timezone.now() + timezone.timedelta(seconds=250))
+
+    def test_send_queued_emails_retry(self):
+        '''
+        Test a failed email is retried after a growing delay, up to the maximum attempts
+        '''
+        email = enqueue_email('Subject', 'Body', ['user@example.com'])
+
+        self.assertEqual(send_queued_emails(connection=FailingEmailBackend()), 0)
+        email.refresh_from_db()
+        self.assertEqual(email.attempts, 1)
+        self.assertIn('Connection refused', email.last_error)
+        self.assertGreater(email.send_after, timezone.now() + timezone.timedelta(seconds=50))
+
+        # not due yet
+        self.assertEqual(send_queued_emails(), 0)
+
+        Outbound_Email.objects.update(send_after=timezone.now())
+        send_queued_emails(connection=FailingEmailBackend())
+        email.refresh_from_db()
+        self.assertEqual(email.attempts, 2)
+        self.assertGreater(email.send_after, timezone.now() + timezone.timedelta(seconds=110))
+
+        # given up after the maximum attempts
+        Outbound_Email.objects.update(send_after=timezone.now())
+        self.assertEqual(send_queued_emails(), 0)
+        self.assertEqual(len(mail.outbox), 0)
+
+class ImportCarsTest(TestCase):
+    def setUp(self):
+        self.owner = User.objects.create(username='dealer@example.com', email='dealer@example.com')
+        brand = Car_Brand.objects.create(name='Toyota')
+        Car_Model.objects.create(brand=brand, name='Corolla')
+        Fuel_Type.objects.create(name='Petrol')
+        Transmission_Type.objects.create(name='Automatic')
+
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = directory.name
+
+    def write_file(self, name, content):
+        path = os.path.join(self.directory, name)
+        with open(path, 'w') as file:
+            file.write(content)
+        return path
+
+    def test_import_cars_csv(self):
+        '''
+        Test the valid rows are imported and the invalid rows reported without aborting the import
+        '''
+        path = self.write_file('cars.csv', (
+            'year,registration_number,status,odometer,price,condition,prev_owner_count,location,description,brand,model,fuel_type,transmission\n'
+            '2019,ABC123,AVAILABLE,40000,20000,GOOD,1,Sydney,One owner,Toyota,Corolla,Petrol,Automatic\n'
+            '2020,DEF456,AVAILABLE,not a number,21000,GOOD,1,Sydney,,Toyota,Corolla,Petrol,Automatic\n'
+            '2021,GHI789,AVAILABLE,10000,25000,GOOD,1,Melbourne,,Toyota,Camry,Petrol,Automatic\n'
+            '2018,JKL012,SOLD,80000,15000,FAIR,2,Perth,,Toyota,Corolla,Petrol,Automatic\n'
+        ))
+        out, err = StringIO(), StringIO()
+        with CaptureQueriesContext(connection) as queries:
+            call_command('import_cars', path, owner='dealer@example.com', chunk_size=1, stdout=out, stderr=err)
+
+        # the lookup tables are read at most once
+        lookups = [query['sql'] for query in queries if query['sql'].startswith('SELECT') and ' FROM "marketplace_app_car_brand"' in query['sql']]
+        self.assertLessEqual(len(lookups), 1)
+
+        self.assertIn('Imported 2 cars, skipped 2 rows.', out.getvalue())
+        self.assertIn('Line 3: odometer: Enter a whole number.', err.getvalue())
+        self.assertIn('Line 4: Unknown model "Camry".', err.getvalue())
+        self.assertEqual(list(Car.objects.order_by('year').values_list('registration_number', 'owner')), [('JKL012', self.owner.id), ('ABC123', self.owner.id)])
+        # the imported cars are searchable
+        self.assertTrue(Car.objects.filter(search_vector='corolla').exists())
+
+    def test_import_cars_jsonl(self):
+        '''
+        Test the JSON lines are imported, creating the missing lookups when asked
+        '''
+        path = self.write_file('cars.jsonl', (
+            '{"year": 2021, "registration_number": "GHI789", "status": "AVAILABLE", "odometer": 10000, "price": 25000, '
+            '"condition": "GOOD", "prev_owner_count": 1, "location": "Melbourne", "brand": "Toyota", "model": "Camry", '
+            '"fuel_type": "Hybrid", "transmission": "Automatic"}\n'
+            '\n'
+            'not json\n'
+        ))
+        out, err = StringIO(), StringIO()
+        call_command('import_cars', path, owner='dealer@example.com', create_lookups=True, stdout=out, stderr=err)
+
+        self.assertIn('Imported 1 cars, skipped 1 rows.', out.getvalue())
+        self.assertIn('Line 3: Invalid JSON', err.getvalue())
+        car = Car.objects.get()
+        self.assertEqual((car.model.name, car.model.brand.name, car.fuel_type.name), ('Camry', 'Toyota', 'Hybrid'))
+
+    def test_import_cars_stopped(self):
+        '''
+        Test the chunks read before a malformed line stay imported and the line is reported
+        '''
+        path = self.write_file('cars.csv', (
+            'year,registration_number,status,odometer,price,condition,prev_owner_count,location,description,brand,model,fuel_type,transmission\n'
+            '2019,ABC123,AVAILABLE,40000,20000,GOOD,1,Sydney,,Toyota,Corolla,Petrol,Automatic\n'
+            '2020,DEF456,AVAILABLE,40000,20000,GOOD,1,Sydney,,Toyota,Corolla,Petrol,Automatic\n'
+            # a field longer than the csv module accepts
+            '2021,GHI789,AVAILABLE,40000,20000,GOOD,1,Sydney,{},Toyota,Corolla,Petrol,Automatic\n'.format('x' * (csv.field_size_limit() + 1))
+        ))
+        out = StringIO()
+        with self.assertRaisesMessage(CommandError, 'The import stopped after line 3'):
+            call_command('import_cars', path, owner='dealer@example.com', chunk_size=1, stdout=out, stderr=StringIO())
+        self.assertIn('Imported 2 cars, skipped 0 rows.', out.getvalue())
+        self.assertEqual(set(Car.objects.values_list('registration_number', flat=True)), {'ABC123', 'DEF456'})
+
+    def test_import_cars_notifies_buyers(self):
+        '''
+        Test the imported cars notify the buyers whose preference they match
+        '''
+        buyer = User.objects.create(username='buyer@example.com', email='buyer@example.com')
+        Preference.objects.create(user=buyer, price_range=Preferred_Price_Range.objects.create(price_min=10000, price_max=22000))
+        path = self.write_file('cars.csv', (
+            'year,registration_number,status,odometer,price,condition,prev_owner_count,location,description,brand,model,fuel_type,transmission\n'
+            '2019,ABC123,AVAILABLE,40000,20000,GOOD,1,Sydney,,Toyota,Corolla,Petrol,Automatic\n'
+            '2021,GHI789,AVAILABLE,10000,25000,GOOD,1,Melbourne,,Toyota,Corolla,Petrol,Automatic\n'
+        ))
+        call_command('import_cars', path, owner='dealer@example.com', stdout=StringIO(), stderr=StringIO())
+
+        self.assertEqual(list(Notification.objects.values_list('user', 'car__registration_number')), [(buyer.id, 'ABC123')])
+
+    def test_import_cars_bounded_queries(self):
+        '''
+        Test a chunk of 500 cars is matched, notified and added to the cached matches in a few queries
+        '''
+        Fuel_Type.objects.create(name='Diesel')
+        other_model = Car_Model.objects.create(brand=Car_Brand.objects.create(name='Mazda'), name='3')
+        buyers = [User.objects.create(username='buyer{}@example.com'.format(number)) for number in range(4)]
+        Preference.objects.create(user=buyers[0], price_range=Preferred_Price_Range.objects.create(price_min=10000, price_max=12000))
+        Preference.objects.create(user=buyers[1], odometer_range=Preferred_Odometer_Range.objects.create(odometer_min=0, odometer_max=20000)).fuel.add(Fuel_Type.objects.get(name='Diesel'))
+        Preference.objects.create(user=buyers[2], year_range=Preferred_Year_Range.objects.create(year_min=2015, year_max=2018)).brand.add(Car_Brand.objects.get(name='Toyota'))
+        Preference.objects.create(user=buyers[3]).model.add(other_model)
+        self.assertEqual(get_matching_car_ids(buyers[3]), [])
+
+        rows = ['year,registration_number,status,odometer,price,condition,prev_owner_count,location,description,brand,model,fuel_type,transmission\n']
+        for number in range(500):
+            rows.append('{},R{:05},{},{},{},GOOD,1,Sydney,,{},{},{},Automatic\n'.format(
+                2000 + number % 20, number, 'SOLD' if number % 7 == 0 else 'AVAILABLE', number * 100, 10000 + number * 10,
+                *(('Mazda', '3') if number % 3 == 0 else ('Toyota', 'Corolla')), 'Diesel' if number % 2 else 'Petrol',
+            ))
+        path = self.write_file('cars.csv', ''.join(rows))
+
+        with self.captureOnCommitCallbacks(execute=True), query_budget(11):
+            call_command('import_cars', path, owner='dealer@example.com', chunk_size=500, stdout=StringIO(), stderr=StringIO())
+
+        # the same matches as the cars saved one by one
+        cars = list(Car.objects.select_related('model'))
+        self.assertEqual(len(cars), 500)
+        expected = {(user_id, car.pk) for car in cars for user_id in matching_user_ids(car)}
+        self.assertEqual(set(Notification.objects.values_list('user', 'car')), expected)
+        self.assertEqual({user_id for user_id, _ in expected}, {buyer.pk for buyer in buyers})
+        # the cached matches are computed again when next read
+        self.assertIsNone(cache.get(matches_cache_key(buyers[3].pk)))
+        self.assertEqual(get_matching_car_ids(buyers[3]), sorted((car_id for user_id, car_id in expected if user_id == buyers[3].pk), reverse=True))
+
+class ExportCarsTest(TestCase):
+    def setUp(self):
+        model = Car_Model.objects.create(brand=Car_Brand.objects.create(name='Toyota'), name='Corolla')
+        fuel_type = Fuel_Type.objects.create(name='Petrol')
+        transmission = Transmission_Type.objects.create(name='Automatic')
+        owner = User.objects.create(username='dealer@example.com', email='dealer@example.com')
+        for registration_number in ['ABC123', 'DEF456']:
+            Car.objects.create(
+                year=2020, model=model, registration_number=registration_number,
+                status='AVAILABLE', odometer=50000, price=20000, condition='GOOD', description='Comma, "quoted"',
+                fuel_type=fuel_type, transmission=transmission, owner=owner, location='Sydney',
+            )
+
+    def test_export_cars_csv(self):
+        '''
+        Test every car is exported with its related names, in a file the importer reads back
+        '''
+        out = StringIO()
+        with self.assertNumQueries(1):
+            call_command('export_cars', chunk_size=1, stdout=out)
+
+        rows = list(csv.DictReader(StringIO(out.getvalue())))
+        self.assertEqual([row['registration_number'] for row in rows], ['ABC123', 'DEF456'])
+        self.assertEqual(rows[0]['brand'], 'Toyota')
+        self.assertEqual(rows[0]['owner'], 'dealer@example.com')
+        self.assertEqual(rows[0]['description'], 'Comma, "quoted"')
+
+        report = import_cars(out.getvalue().splitlines(keepends=True), 'csv', User.objects.get())
+        self.assertEqual((report.created, report.errors), (2, []))
+
+    def test_export_cars_jsonl(self):
+        '''
+        Test the cars are exported as one JSON object per line
+        '''
+        out = StringIO()
+        call_command('export_cars', format='jsonl', stdout=out)
+
+        rows = [json.loads(line) for line in out.getvalue().splitlines()]
+        self.assertEqual(len(rows), 2)
+        self.assertEqual(rows[1]['model'], 'Corolla')
+        self.assertIn('updated_at', rows[1])
+
+def make_image(name='car.png', size=(1600, 1200), color='red'):
+    '''
+    An uploaded PNG image
+    '''
+    buffer = BytesIO()
+    Image.new('RGB', size, color).save(buffer, 'PNG')
+    return SimpleUploadedFile(name, buffer.getvalue(), content_type='image/png')
+
+class GenerateThumbnailsTest(TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        media = self.settings(MEDIA_ROOT=directory.name)
+        media.enable()
+        self.addCleanup(media.disable)
+
+        brand = Car_Brand.objects.create(name='Test Brand')
+        model = Car_Model.objects.create(brand=brand, name='Test Model')
+        fuel_type = Fuel_Type.objects.create(name='Petrol')
+        transmission = Transmission_Type.objects.create(name='Automatic')
+        owner = User.objects.create(username='owner@example.com', email='owner@example.com')
+        self.cars = [Car.objects.create(
+            year=2020,
+            model=model,
+            registration_number='ABC123',
+            status='AVAILABLE',
+            odometer=50000,
+            price=price,
+            condition='GOOD',
+            fuel_type=fuel_type,
+            transmission=transmission,
+            owner=owner,
+            location='Sydney',
+        ) for price in [10000, 20000]]
+
+    def test_save_car_image_dedupes(self):
+        '''
+        Test an image uploaded for two cars is stored once, and attached once to a car
+        '''
+        first, created = save_car_image(self.cars[0], make_image())
+        second, _ = save_car_image(self.cars[1], make_image('copy.png'))
+        again, created_again = save_car_image(self.cars[0], make_image('again.png'))
+
+        self.assertTrue(created)
+        self.assertFalse(created_again)
+        self.assertEqual(again, first)
+        self.assertEqual(first.file.name, second.file.name)
+        self.assertEqual(first.file.name, image_name(first.sha256, '.png'))
+        self.assertEqual(len(default_storage.listdir(os.path.dirname(first.file.name))[1]), 1)
+
+    def test_generate_thumbnails(self):
+        '''
+        Test every size of thumbnail is generated once per content, and a file that is not an image is reported
+        '''
+        image, _ = save_car_image(self.cars[0], make_image())
+        broken, _ = save_car_image(self.cars[1], SimpleUploadedFile('broken.png', b'not an image'))
+
+        out = StringIO()
+        call_command('generate_thumbnails', stdout=out)
+        self.assertIn('Processed 2 images.', out.getvalue())
+
+        image.refresh_from_db()
+        self.assertIsNotNone(image.thumbnailed_at)
+        self.assertEqual(image.thumbnail_error, '')
+        for size, (width, height) in settings.CAR_IMAGE_THUMBNAIL_SIZES.items():
+            with default_storage.open(thumbnail_name(image.sha256, size)) as file, Image.open(file) as thumbnail:
+                self.assertEqual(thumbnail.format, 'JPEG')
+                self.assertLessEqual(thumbnail.size[0], width)
+                self.assertLessEqual(thumbnail.size[1], height)
+        broken.refresh_from_db()
+        self.assertNotEqual(broken.thumbnail_error, '')
+
+        # the same content uploaded again is ready straight away
+        copy, _ = save_car_image(self.cars[1], make_image('copy.png'))
+        self.assertIsNotNone(copy.thumbnailed_at)
+
+    @override_settings(CAR_IMAGE_THUMBNAIL_LEASE=300)
+    def test_generate_thumbnails_claimed(self):
+        '''
+        Test an image claimed by a worker is left to it until its lease runs out, and any error of an image is recorded
+        '''
+        image, _ = save_car_image(self.cars[0], make_image())
+        Car_File.objects.update(thumbnail_claimed_until=timezone.now() + timezone.timedelta(seconds=60))
+        self.assertEqual(generate_thumbnails(), 0)
+
+        Car_File.objects.update(thumbnail_claimed_until=timezone.now())
+        with mock.patch('marketplace_app.images.make_thumbnails', side_effect=Image.DecompressionBombError('Image size exceeds limit')):
+            self.assertEqual(generate_thumbnails(), 1)
+        image.refresh_from_db()
+        self.assertIsNotNone(image.thumbnailed_at)
+        self.assertEqual(image.thumbnail_error, 'DecompressionBombError: Image size exceeds limit')
+
+    def test_delete_car_image(self):
+        '''
+        Test a stored image is deleted with the last car using it
+        '''
+        first, _ = save_car_image(self.cars[0], make_image())
+        second, _ = save_car_image(self.cars[1], make_image())
+        call_command('generate_thumbnails', stdout=StringIO())
+
+        with self.captureOnCommitCallbacks(execute=True):
+            first.delete()
+        self.assertTrue(default_storage.exists(second.file.name))
+
+        with self.captureOnCommitCallbacks(execute=True):
+            second.delete()
+        self.assertFalse(default_storage.exists(second.file.name))
+        self.assertFalse(default_storage.exists(thumbnail_name(second.sha256, 'card')))
+
+class LoadFixturesTest(TestCase):
+    def test_loaddata_natural_keys(self):
+        '''
+        Test the fixtures load with their natural keys resolved from the lookup cache
+        '''
+        for user_id in [1, 2, 4, 5]:
+            User.objects.create(id=user_id, username='user{}'.format(user_id))
+        call_command('loaddata', 'car_brand', 'car_model', 'fuel_type', 'transmission', verbosity=0)
+
+        with CaptureQueriesContext(connection) as queries:
+            call_command('loaddata', 'car', verbosity=0)
+        lookup_queries = [query for query in queries if query['sql'].startswith('SELECT') and '"marketplace_app_car_model"' in query['sql']]
+        self.assertLessEqual(len(lookup_queries), 1)
+
+        self.assertEqual(
+            list(Car.objects.order_by('id').values_list('model__brand__name', 'model__name')[:2]),
+            [('Mazda', 'Mazda 3'), ('Mazda', 'Mazda CX-30')],
+        )
+
+class SeedMarketplaceTest(TestCase):
+    def seed(self, seed):
+        '''
+        Seed the marketplace and read back the generated cars, without their ids
+        '''
+        call_command('seed_marketplace', '--date=2024-06-01', users=50, cars=200, seed=seed, stdout=StringIO())
+        return list(Car.objects.order_by('id').values_list(
+            'year', 'model__name', 'registration_number', 'status', 'odometer', 'price', 'owner__username', 'location',
+        ))
+
+    def test_seed_marketplace(self):
+        '''
+        Test the seed writes every table and rebuilds the search vectors, the preference index and the rating summaries
+        '''
+        self.seed(1)
+
+        self.assertEqual(User.objects.count(), 50)
+        self.assertEqual(User_Detail.objects.count(), 50)
+        self.assertEqual(Car.objects.count(), 200)
+        self.assertFalse(Car.objects.filter(search_vector__isnull=True).exists())
+        self.assertFalse(Car.objects.filter(year__gt=2024).exists())
+        self.assertTrue(Preference.objects.exists())
+        self.assertTrue(Wishlist.cars.through.objects.exists())
+        self.assertEqual(
+            set(Preference_Term.objects.values_list('preference_id', flat=True)),
+            set(Preference.objects.values_list('pk', flat=True)),
+        )
+        # every sold car has its completed order, and every order has a buyer other than the seller
+        self.assertEqual(Car.objects.filter(status='SOLD').count(), Order.objects.filter(status='COMPLETED').count())
+        self.assertFalse(Order.objects.filter(buyer=F('seller')).exists())
+        self.assertEqual(
+            Rating_Summary.objects.aggregate(total=Sum('seller_rating_count'))['total'],
+            Seller_Rating.objects.count(),
+        )
+
+        with self.assertRaises(CommandError):
+            call_command('seed_marketplace', users=50, cars=200, seed=1, stdout=StringIO())
+
+    def test_seed_marketplace_deterministic(self):
+        '''
+        Test the same seed generates the same cars, and another seed other cars
+        '''
+        with transaction.atomic():
+            cars = self.seed(1)
+            transaction.set_rollback(True)
+
+        with transaction.atomic():
+            self.assertEqual(self.seed(1), cars)
+            transaction.set_rollback(True)
+
+        self.assertNotEqual(self.seed(2), cars)
+
+class BenchmarkUrlsTest(TestCase):
+    def setUp(self):
+        call_command('seed_marketplace', users=30, cars=100, seed=3, stdout=StringIO())
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+        self.output = os.path.join(self.directory.name, 'results.json')
+
+    def test_benchmark_urls(self):
+        '''
+        Test every route is measured and the results are written as JSON
+        '''
+        call_command('benchmark_urls', iterations=3, warmup=0, output=self.output, stdout=StringIO())
+
+        with open(self.output) as file:
+            results = json.load(file)
+        self.assertEqual(results['iterations'], 3)
+        self.assertIn('car_listing', results['routes'])
+        self.assertIn('account_detail', results['routes'])
+        for name, result in results['routes'].items():
+            with self.subTest(route=name):
+                self.assertEqual(result['status'], 200)
+                self.assertGreater(result['bytes'], 0)
+                self.assertLessEqual(result['p50'], result['p95'])
+                self.assertLessEqual(result['p95'], result['p99'])
+        self.assertGreater(results['routes']['account_detail']['queries'], 0)
+
+    def test_benchmark_urls_compare(self):
+        '''
+        Test a route making more queries than in the baseline is a regression
+        '''
+        call_command('benchmark_urls', iterations=2, warmup=0, route=['rating_seller'], output=self.output, stdout=StringIO())
+        with open(self.output) as file:
+            baseline = json.load(file)
+        baseline['routes']['rating_seller']['queries'] -= 1
+        with open(self.output, 'w') as file:
+            json.dump(baseline, file)
+
+        with self.assertRaisesMessage(CommandError, 'rating_seller'):
+            call_command('benchmark_urls', iterations=2, warmup=0, route=['rating_seller'], compare=self.output, threshold=100, stdout=StringIO())
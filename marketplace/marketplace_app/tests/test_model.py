@@ -1,7 +1,16 @@
-from django.test import TestCase
+import threading
+from unittest import mock
+
+from django.db import IntegrityError, connection, transaction
+from django.db.migrations.executor import MigrationExecutor
+from django.test import TestCase, TransactionTestCase
+from django.contrib.postgres.search import SearchQuery
 from psycopg2.errors import NumericValueOutOfRange
 
+from marketplace_app.forms import CarForm
+from marketplace_app.lookups import get_lookups
 from marketplace_app.models import *
+from marketplace_app.orders import OrderError, OrderForbidden, cancel_order, complete_order, place_order
 
 class UserDeatilTest(TestCase):
     def setUp(self) -> None:
@@ -38,6 +47,105 @@ class TestCarModel(TestCase):
 
         self.assertEqual(model.name, str(Car_Model.objects.filter(name=model_name).first()))
 
+    def test_car_model_natural_key(self):
+        '''
+        Test a model name is unique within its brand only, and found by its brand and name
+        '''
+        other_brand = Car_Brand.objects.create(name="Other Brand")
+        model = Car_Model.objects.create(brand=self.brand_detail, name="Test Model")
+        other_model = Car_Model.objects.create(brand=other_brand, name="Test Model")
+
+        self.assertEqual(model.natural_key(), ("Test Brand", "Test Model"))
+        self.assertEqual(Car_Model.objects.get_by_natural_key("Other Brand", "Test Model"), other_model)
+        with self.assertRaises(IntegrityError):
+            Car_Model.objects.create(brand=self.brand_detail, name="Test Model")
+
+    def test_car_model_natural_key_cached(self):
+        '''
+        Test the natural keys are found in memory once loaded, and a model by the new name of its brand
+        '''
+        model = Car_Model.objects.create(brand=self.brand_detail, name="Test Model")
+        Car_Model.objects.get_by_natural_key("Test Brand", "Test Model")
+        Car_Brand.objects.get_by_natural_key("Test Brand")
+        with self.assertNumQueries(0):
+            self.assertEqual(Car_Model.objects.get_by_natural_key("Test Brand", "Test Model"), model)
+            self.assertEqual(Car_Brand.objects.get_by_natural_key("Test Brand"), self.brand_detail)
+
+        self.brand_detail.name = "Renamed Brand"
+        self.brand_detail.save()
+        self.assertEqual(Car_Model.objects.get_by_natural_key("Renamed Brand", "Test Model"), model)
+        with self.assertRaises(Car_Model.DoesNotExist):
+            Car_Model.objects.get_by_natural_key("Test Brand", "Test Model")
+
+    def test_lookups_copied(self):
+        '''
+        Test every caller gets its own copies of the cached lookup rows
+        '''
+        model = Car_Model.objects.create(brand=self.brand_detail, name="Test Model")
+        get_lookups(Car_Model)[model.pk].name = "Changed"
+        Car_Model.objects.get_by_natural_key("Test Brand", "Test Model").name = "Changed"
+        self.assertEqual(get_lookups(Car_Model)[model.pk].name, "Test Model")
+        self.assertEqual(Car_Model.objects.get_by_natural_key("Test Brand", "Test Model").name, "Test Model")
+
+    def test_lookup_choices_read_once(self):
+        '''
+        Test the choices of a lookup field are read from the cache once, however they are used
+        '''
+        Car_Model.objects.create(brand=self.brand_detail, name="Test Model")
+        choices = CarForm().fields['model'].choices
+        with mock.patch('marketplace_app.forms.get_lookups', wraps=get_lookups) as lookups:
+            self.assertTrue(choices)
+            self.assertEqual(len(choices), 2)
+            self.assertEqual([str(label) for value, label in choices], ['---------', 'Test Model'])
+        lookups.assert_called_once_with(Car_Model)
+
+    def test_lookup_names_unique(self):
+        for model in [Car_Brand, Fuel_Type, Transmission_Type]:
+            with self.subTest(model=model):
+                model.objects.create(name="Name")
+                with self.assertRaises(IntegrityError), transaction.atomic():
+                    model.objects.create(name="Name")
+
+class MergeDuplicateLookupsTest(TransactionTestCase):
+    '''
+    Migration 0020 merges the lookup rows with the same name before the names are made unique.
+    '''
+    before = [('marketplace_app', '0019_car_file_images')]
+    after = [('marketplace_app', '0020_merge_duplicate_lookups')]
+
+    def migrate(self, targets):
+        executor = MigrationExecutor(connection)
+        executor.migrate(targets)
+        return executor.loader.project_state(targets).apps
+
+    def tearDown(self):
+        self.migrate(MigrationExecutor(connection).loader.graph.leaf_nodes())
+
+    def test_merge_duplicate_lookups_preference_terms(self):
+        apps = self.migrate(self.before)
+        Brand = apps.get_model('marketplace_app', 'Car_Brand')
+        Preference = apps.get_model('marketplace_app', 'Preference')
+        Term = apps.get_model('marketplace_app', 'Preference_Term')
+        User = apps.get_model('auth', 'User')
+
+        keep, *duplicates = [Brand.objects.create(name="Toyota") for _ in range(3)]
+        choices = {'duplicate': [duplicates[0]], 'both': [keep, duplicates[0]], 'duplicates': duplicates}
+        for username, brands in choices.items():
+            preference = Preference.objects.create(user=User.objects.create(username=username))
+            preference.brand.set(brands)
+            # the index rows the signals wrote when the preference was saved
+            Term.objects.bulk_create(Term(preference=preference, dimension='make', term='make:brand:{}'.format(brand.pk)) for brand in brands)
+
+        apps = self.migrate(self.after)
+        Preference = apps.get_model('marketplace_app', 'Preference')
+        Term = apps.get_model('marketplace_app', 'Preference_Term')
+
+        self.assertEqual(list(apps.get_model('marketplace_app', 'Car_Brand').objects.values_list('pk', flat=True)), [keep.pk])
+        for username in choices:
+            preference = Preference.objects.get(user__username=username)
+            self.assertEqual(list(preference.brand.values_list('pk', flat=True)), [keep.pk])
+            self.assertEqual(list(Term.objects.filter(preference=preference).values_list('term', flat=True)), ['make:brand:{}'.format(keep.pk)])
+
 class TestTransmissionType(TestCase):
     def test_transmission_type_display(self):
         transmission_name = "Test Transmission"
@@ -90,6 +198,32 @@ class TestCar(TestCase):
 
         self.assertTrue(Car.objects.filter(year=2021, model=self.model_detail, registration_number=self.registration_number, odometer=self.odometer, fuel_type=self.fuel_detail, status=self.status, price=self.price, description=description, condition=self.condition, owner=self.owner, location=self.location).exists())
 
+class TestCarSearchVector(TestCase):
+    def setUp(self) -> None:
+        self.brand_detail = Car_Brand.objects.create(name="Mazda")
+        self.model_detail = Car_Model.objects.create(name="CX-5", brand=self.brand_detail)
+        self.car = Car.objects.create(transmission=Transmission_Type.objects.create(name="Automatic"), year=2020, model=self.model_detail, registration_number="ABC123", odometer=1000, fuel_type=Fuel_Type.objects.create(name="Petrol"), status="AVAILABLE", price=1000, description="Towbar fitted", condition="GOOD", owner=User.objects.create(username="test", password="test"), location="Sydney")
+
+    def search(self, keywords):
+        return list(Car.objects.filter(search_vector=SearchQuery(keywords, config='english')))
+
+    def test_search_vector_on_create(self):
+        self.assertEqual(self.search("mazda"), [self.car])
+        self.assertEqual(self.search("towbar"), [self.car])
+        self.assertEqual(self.search("sydney"), [self.car])
+
+    def test_search_vector_on_car_update(self):
+        self.car.description = "Roof racks"
+        self.car.save()
+        self.assertEqual(self.search("towbar"), [])
+        self.assertEqual(self.search("racks"), [self.car])
+
+    def test_search_vector_on_brand_rename(self):
+        self.brand_detail.name = "Toyota"
+        self.brand_detail.save()
+        self.assertEqual(self.search("mazda"), [])
+        self.assertEqual(self.search("toyota"), [self.car])
+
 class OrderTest(TestCase):
 
     def setUp(self) -> None:
@@ -137,6 +271,89 @@ class OrderTest(TestCase):
                 Order.objects.create(seller=self.seller, buyer=self.buyer, car=self.car, status=status)
                 self.assertTrue(Order.objects.filter(seller=self.seller, buyer=self.buyer, car=self.car, status=status).exists())
     
+    def test_place_order(self):
+        '''
+        Test an order holds the car for the buyer, and the car cannot be ordered again
+        '''
+        order = place_order(self.buyer, self.car.pk)
+        self.assertEqual((order.status, order.seller, order.car), ("PENDING", self.seller, self.car))
+        self.car.refresh_from_db()
+        self.assertEqual(self.car.status, "PENDING")
+
+        other_buyer = User.objects.create(username="other", password="other")
+        with self.assertRaisesMessage(OrderError, "The car is no longer available."):
+            place_order(other_buyer, self.car.pk)
+        with self.assertRaises(OrderForbidden):
+            place_order(self.seller, self.car.pk)
+        self.assertEqual(Order.objects.count(), 1)
+
+    def test_complete_order(self):
+        '''
+        Test only the seller completes an order, which sells the car
+        '''
+        order = place_order(self.buyer, self.car.pk)
+        with self.assertRaises(OrderForbidden):
+            complete_order(order.pk, self.buyer)
+
+        complete_order(order.pk, self.seller)
+        order.refresh_from_db()
+        self.car.refresh_from_db()
+        self.assertEqual(order.status, "COMPLETED")
+        self.assertIsNotNone(order.completed_at)
+        self.assertEqual(self.car.status, "SOLD")
+
+        with self.assertRaisesMessage(OrderError, "The order is not pending."):
+            cancel_order(order.pk, self.buyer)
+
+    def test_cancel_order(self):
+        '''
+        Test a cancelled order makes the car available to other buyers again
+        '''
+        order = place_order(self.buyer, self.car.pk)
+        cancel_order(order.pk, self.buyer)
+        order.refresh_from_db()
+        self.assertEqual(order.status, "CANCELLED")
+
+        other_buyer = User.objects.create(username="other", password="other")
+        self.assertEqual(place_order(other_buyer, self.car.pk).buyer, other_buyer)
+
+class PlaceOrderConcurrencyTest(TransactionTestCase):
+    '''
+    Many buyers order the same car at the same time, each in its own thread and database connection.
+    '''
+    BUYERS = 20
+
+    def test_place_order_concurrent_buyers(self):
+        seller = User.objects.create(username="seller", password="seller")
+        model = Car_Model.objects.create(name="Test Model", brand=Car_Brand.objects.create(name="Test Brand"))
+        car = Car.objects.create(transmission=Transmission_Type.objects.create(name="Test Transmission"), year=2021, model=model, registration_number="ABC123", odometer=1000, fuel_type=Fuel_Type.objects.create(name="Test Fuel"), status="AVAILABLE", price=1000, description="", condition="EXCELLENT", owner=seller, location="Sydney")
+        buyers = [User.objects.create(username="buyer{}".format(number), password="buyer") for number in range(self.BUYERS)]
+
+        barrier = threading.Barrier(self.BUYERS)
+        orders = []
+        errors = []
+
+        def order(buyer):
+            try:
+                barrier.wait()
+                orders.append(place_order(buyer, car.pk))
+            except OrderError as error:
+                errors.append(str(error))
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=order, args=(buyer,)) for buyer in buyers]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(len(orders), 1)
+        self.assertEqual(len(errors), self.BUYERS - 1)
+        self.assertEqual(list(Order.objects.values_list('buyer', flat=True)), [orders[0].buyer_id])
+        car.refresh_from_db()
+        self.assertEqual(car.status, "PENDING")
+
 class TestPreferredYearRange(TestCase):
     def test_invalid_max_year(self):
         year_min = 1990
@@ -383,6 +600,49 @@ class TestSellerRating(TestCase):
         Seller_Rating.objects.create(rating=1, comment=comment, seller=self.seller, buyer=self.buyer)
         self.assertTrue(Seller_Rating.objects.filter(rating=1, comment=comment, seller=self.seller, buyer=self.buyer).exists())
 
+class TestRatingSummary(TestCase):
+    def setUp(self) -> None:
+        self.seller = User.objects.create(username="seller", password="seller")
+        self.buyer = User.objects.create(username="buyer", password="buyer")
+
+    def test_summary_on_create(self):
+        for rating in [5, 4, 4]:
+            Seller_Rating.objects.create(rating=rating, seller=self.seller, buyer=self.buyer)
+        Buyer_Rating.objects.create(rating=2, seller=self.seller, buyer=self.buyer)
+
+        seller_summary = Rating_Summary.objects.get(user=self.seller)
+        self.assertEqual(seller_summary.seller_rating_count, 3)
+        self.assertEqual(seller_summary.seller_rating_sum, 13)
+        self.assertAlmostEqual(seller_summary.seller_rating_average, 13 / 3)
+        self.assertEqual(seller_summary.seller_histogram(), [0, 0, 0, 2, 1])
+        self.assertEqual(seller_summary.buyer_rating_count, 0)
+
+        buyer_summary = Rating_Summary.objects.get(user=self.buyer)
+        self.assertEqual(buyer_summary.buyer_rating_average, 2)
+        self.assertEqual(buyer_summary.buyer_histogram(), [0, 1, 0, 0, 0])
+
+    def test_summary_on_update_and_delete(self):
+        first = Seller_Rating.objects.create(rating=5, seller=self.seller, buyer=self.buyer)
+        second = Seller_Rating.objects.create(rating=3, seller=self.seller, buyer=self.buyer)
+
+        first.rating = 1
+        first.save()
+        summary = Rating_Summary.objects.get(user=self.seller)
+        self.assertEqual(summary.seller_rating_average, 2)
+        self.assertEqual(summary.seller_histogram(), [1, 0, 1, 0, 0])
+
+        first.delete()
+        second.delete()
+        summary.refresh_from_db()
+        self.assertEqual(summary.seller_rating_count, 0)
+        self.assertIsNone(summary.seller_rating_average)
+        self.assertEqual(summary.seller_histogram(), [0, 0, 0, 0, 0])
+
+    def test_summary_on_user_delete(self):
+        Seller_Rating.objects.create(rating=5, seller=self.seller, buyer=self.buyer)
+        self.seller.delete()
+        self.assertFalse(Rating_Summary.objects.exists())
+
 class TestBuyerRating(TestCase):
     def setUp(self) -> None:
         self.seller = User.objects.create(username="seller", password="seller")
@@ -1,16 +1,40 @@
-from django.test import TestCase
+import json
+import os
+import tempfile
+import time
+from io import BytesIO
+from unittest import mock
+
+from django.test import TestCase, override_settings
+from django.core.files.uploadedfile import SimpleUploadedFile
 from django.urls import reverse, NoReverseMatch
 from django.core import mail
+from django.core.cache import cache
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
 
 from django.contrib.auth.tokens import default_token_generator
-from django.utils.http import urlsafe_base64_encode
+from django.utils import timezone
+from django.utils.http import http_date, urlsafe_base64_encode
 
 from marketplace_app.models import *
+from marketplace_app.emails import send_queued_emails
+from marketplace_app.images import generate_thumbnails, thumbnail_name
+from marketplace_app.listing_cache import car_version_key
+from marketplace_app.instrumentation import reset_metrics
+from marketplace_app.matching import candidate_preference_ids, get_matching_car_ids, matches_cache_key, matching_user_ids
+from marketplace_app.notifications import send_notifications
+from marketplace_app.orders import place_order
 from marketplace_app.tokens import *
+from marketplace_app.tests.query_budget import QueryBudgetClient, QueryBudgetExceeded, query_budget
+from marketplace_app.urls import QUERY_BUDGETS, urlpatterns
+from PIL import Image
 
 APP_NAME = "marketplace_app/"
 
 class ViewsTest(TestCase):
+    client_class = QueryBudgetClient
+
     # -- LOGOUT -- 
     def test_logout_view_get(self):
         '''
@@ -369,7 +393,12 @@ class ViewsTest(TestCase):
         self.assertFalse(User.objects.get(username='user@example.com').is_active)
         self.assertEqual(User_Detail.objects.count(), user_count_before + 1)
 
+        # check email is queued, not sent within the request
+        self.assertEqual(len(mail.outbox), 0)
+        self.assertEqual(Outbound_Email.objects.count(), 1)
+
         # check email is sent for activating carsales account
+        send_queued_emails()
         self.assertEqual(len(mail.outbox), 1)
         self.assertEqual('Activate Your Carsales Account', mail.outbox[0].subject)
 
@@ -657,6 +686,7 @@ class ViewsTest(TestCase):
         self.assertRedirects(response, reverse('reset_email_sent'))
 
         # check email has been sent for resetting account password
+        send_queued_emails()
         self.assertEqual(len(mail.outbox), 1)
         self.assertEqual('Reset Your Carsales Account Password', mail.outbox[0].subject)
 
@@ -921,12 +951,126 @@ class ViewsTest(TestCase):
         self.assertTemplateUsed(response, APP_NAME + 'car_listing.html')
         self.assertEqual(response.context['car'], test_car)
 
+    def test_car_listing_view_get_cached(self):
+        '''
+        Test the car listing is served from the cache until the car or its related rows change
+        '''
+        car = self.create_test_cars([10000])[0]
+        self.client.get(reverse('car_listing', args=[car.id]))
+
+        # only the last change of the car and the ids of its ready images are read, the cache key is made of them
+        with self.assertNumQueries(1):
+            response = self.client.get(reverse('car_listing', args=[car.id]))
+        self.assertContains(response, 'Test Brand Test Model')
+        self.assertNotIn('car', response.context)
+
+        # a change made by a process not sharing the cache sends no invalidation
+        Car.objects.filter(pk=car.pk).update(price=23456, updated_at=timezone.now())
+        self.assertContains(self.client.get(reverse('car_listing', args=[car.id])), '$23456.00')
+
+        with self.captureOnCommitCallbacks(execute=True):
+            car.price = 12345
+            car.save()
+        self.assertContains(self.client.get(reverse('car_listing', args=[car.id])), '$12345.00')
+
+        with self.captureOnCommitCallbacks(execute=True):
+            car.model.brand.name = 'Renamed Brand'
+            car.model.brand.save()
+        self.assertContains(self.client.get(reverse('car_listing', args=[car.id])), 'Renamed Brand Test Model')
+
+        with self.captureOnCommitCallbacks(execute=True):
+            car.owner.first_name = 'Renamed'
+            car.owner.save()
+        self.assertContains(self.client.get(reverse('car_listing', args=[car.id])), 'Renamed Name')
+
+    def test_car_listing_view_get_order_button(self):
+        '''
+        Test the order button is only shown to a logged in user other than the owner, while the car is available
+        '''
+        car = self.create_test_cars([10000])[0]
+        self.assertNotContains(self.client.get(reverse('car_listing', args=[car.id])), 'Order this Car')
+
+        User.objects.create_user(username='buyer@example.com', password='your_password')
+        self.client.login(username='buyer@example.com', password='your_password')
+        self.assertContains(self.client.get(reverse('car_listing', args=[car.id])), 'Order this Car')
+
+        with self.captureOnCommitCallbacks(execute=True):
+            car.status = 'SOLD'
+            car.save()
+        self.assertNotContains(self.client.get(reverse('car_listing', args=[car.id])), 'Order this Car')
+
+        Car.objects.filter(pk=car.pk).update(status='AVAILABLE')
+        car.owner.set_password('your_password')
+        car.owner.save()
+        self.client.login(username='owner@example.com', password='your_password')
+        response = self.client.get(reverse('car_listing', args=[car.id]))
+        self.assertNotContains(response, 'Order this Car')
+        self.assertContains(response, 'Manage Images')
+
+    def test_create_car_view_get_cached_lookups(self):
+        '''
+        Test the car form renders its choices without querying the lookup tables once they are cached
+        '''
+        self.create_test_cars([10000])
+        User.objects.create_user(username='seller@example.com', password='your_password')
+        self.client.login(username='seller@example.com', password='your_password')
+        self.client.get(reverse('create-car'))
+
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(reverse('create-car'))
+        self.assertContains(response, '<option value="{}">Test Brand</option>'.format(Car_Brand.objects.get().pk), html=True)
+        self.assertFalse([query for query in queries if 'marketplace_app_' in query['sql']])
+        # the models are loaded once a brand is chosen
+        self.assertNotContains(response, 'Test Model')
+        self.assertContains(response, 'data-models-url="{}"'.format(reverse('api_brand_models', args=[0])))
+
+        # a new lookup row is listed straight away
+        with self.captureOnCommitCallbacks(execute=True):
+            Fuel_Type.objects.create(name='Hydrogen')
+        self.assertContains(self.client.get(reverse('create-car')), 'Hydrogen')
+
+    def test_create_car_view_post_brand_models(self):
+        '''
+        Test the model select lists the models of the posted brand, and a model of another brand is rejected
+        '''
+        car = self.create_test_cars([10000])[0]
+        other_brand = Car_Brand.objects.create(name='Other Brand')
+        other_model = Car_Model.objects.create(brand=other_brand, name='Other Model')
+        User.objects.create_user(username='seller@example.com', password='your_password')
+        self.client.login(username='seller@example.com', password='your_password')
+
+        data = {
+            'registration_number': 'XYZ789',
+            'prev_owner_count': 0,
+            'odometer': 1000,
+            'year': 2021,
+            'status': 'AVAILABLE',
+            'condition': 'GOOD',
+            'price': 20000,
+            'brand': car.model.brand_id,
+            'model': other_model.pk,
+            'fuel_type': car.fuel_type_id,
+            'transmission': car.transmission_id,
+            'location': 'Sydney',
+            'description': 'A car',
+        }
+        response = self.client.post(reverse('create-car'), data)
+        self.assertContains(response, 'The model is not a model of the chosen brand.')
+        self.assertContains(response, '<option value="{}">Test Model</option>'.format(car.model_id), html=True)
+        self.assertNotContains(response, 'Other Model')
+
+        data['brand'] = other_brand.pk
+        self.client.post(reverse('create-car'), data)
+        self.assertTrue(Car.objects.filter(registration_number='XYZ789', model=other_model).exists())
+
     def test_car_listing_view_get_invalid(self):
         '''
         Test invalid get car listing
         '''
         response = self.client.get(reverse('car_listing', args=[999]))
         self.assertTemplateUsed(response, APP_NAME + 'error_page.html')
+        # no version is kept for a car which does not exist
+        self.assertIsNone(cache.get(car_version_key(999)))
 
     def test_car_listings_view_get_valid(self):
         '''
@@ -936,6 +1080,277 @@ class ViewsTest(TestCase):
         self.assertEqual(response.status_code, 200)
         self.assertTemplateUsed(response, APP_NAME + 'car_listings.html')
 
+    def create_test_cars(self, prices):
+        '''
+        Create one car per price for the listing tests
+        '''
+        car_brand = Car_Brand.objects.create(name='Test Brand')
+        car_model = Car_Model.objects.create(brand=car_brand, name='Test Model')
+        fuel_type = Fuel_Type.objects.create(name='Petrol')
+        transmission_type = Transmission_Type.objects.create(name='Automatic')
+        owner = User.objects.create(
+            username='owner@example.com',
+            password='your_password',
+            first_name='Owner',
+            last_name='Name',
+            email='owner@example.com'
+        )
+
+        return [Car.objects.create(
+            year=2020,
+            model=car_model,
+            registration_number='ABC123',
+            status='AVAILABLE',
+            odometer=50000,
+            price=price,
+            condition='GOOD',
+            fuel_type=fuel_type,
+            transmission=transmission_type,
+            owner=owner,
+            location='Sydney',
+        ) for price in prices]
+
+    def test_car_listings_view_get_paginated(self):
+        '''
+        Test car listings are split into pages by cursor, newest first
+        '''
+        cars = self.create_test_cars([10000, 20000, 30000, 40000, 50000])
+
+        response = self.client.get(reverse('car_listings'), {'page_size': 2})
+        self.assertEqual(list(response.context['all_car_listings']), [cars[4], cars[3]])
+        self.assertTrue(response.context['page'].has_next())
+
+        # follow the cursors until the last page
+        cursor = response.context['page'].next_cursor
+        response = self.client.get(reverse('car_listings'), {'page_size': 2, 'cursor': cursor})
+        self.assertEqual(list(response.context['all_car_listings']), [cars[2], cars[1]])
+
+        cursor = response.context['page'].next_cursor
+        response = self.client.get(reverse('car_listings'), {'page_size': 2, 'cursor': cursor})
+        self.assertEqual(list(response.context['all_car_listings']), [cars[0]])
+        self.assertFalse(response.context['page'].has_next())
+
+    def test_car_listings_view_get_seller_rating(self):
+        '''
+        Test every card shows its seller's rating without a query per card
+        '''
+        cars = self.create_test_cars([10000] * 10)
+        buyer = User.objects.create(username='buyer@example.com', email='buyer@example.com')
+        for index, car in enumerate(cars):
+            seller = User.objects.create(username='seller{}@example.com'.format(index), first_name='Seller')
+            Car.objects.filter(pk=car.pk).update(owner=seller)
+            Seller_Rating.objects.create(rating=1 + index % 5, seller=seller, buyer=buyer)
+
+        with CaptureQueriesContext(connection) as small_page:
+            response = self.client.get(reverse('car_listings'), {'page_size': 2})
+        self.assertEqual(response.context['all_car_listings'][0].seller_rating, 5)
+        self.assertContains(response, 'Seller Rating:</strong> &#9733; 5.0 (1 rating)', html=False)
+
+        with CaptureQueriesContext(connection) as large_page:
+            response = self.client.get(reverse('car_listings'), {'page_size': 10})
+        self.assertEqual([car.seller_rating_count for car in response.context['all_car_listings']], [1] * 10)
+        self.assertEqual(len(small_page), len(large_page))
+
+    def test_car_listing_view_get_seller_rating(self):
+        '''
+        Test the car listing shows its seller's rating, or none when the seller was never rated
+        '''
+        car = self.create_test_cars([10000])[0]
+        response = self.client.get(reverse('car_listing', args=[car.id]))
+        self.assertEqual(response.context['car'].seller_rating_count, 0)
+        self.assertContains(response, 'No ratings yet')
+
+        buyer = User.objects.create(username='buyer@example.com', email='buyer@example.com')
+        with self.captureOnCommitCallbacks(execute=True):
+            Seller_Rating.objects.create(rating=4, seller=car.owner, buyer=buyer)
+        with self.assertNumQueries(2):
+            response = self.client.get(reverse('car_listing', args=[car.id]))
+        self.assertEqual(response.context['car'].seller_rating, 4)
+
+    def test_car_listings_view_get_sorted_by_price(self):
+        '''
+        Test car listings sorted by price keep ties in a stable order across pages
+        '''
+        cars = self.create_test_cars([30000, 10000, 20000, 10000])
+
+        response = self.client.get(reverse('car_listings'), {'sort': 'price', 'page_size': 2})
+        self.assertEqual(list(response.context['all_car_listings']), [cars[1], cars[3]])
+
+        cursor = response.context['page'].next_cursor
+        response = self.client.get(reverse('car_listings'), {'sort': 'price', 'page_size': 2, 'cursor': cursor})
+        self.assertEqual(list(response.context['all_car_listings']), [cars[2], cars[0]])
+
+    def test_car_listings_view_get_invalid_cursor(self):
+        '''
+        Test an invalid cursor falls back to the first page
+        '''
+        cars = self.create_test_cars([10000, 20000])
+
+        response = self.client.get(reverse('car_listings'), {'cursor': 'not-a-cursor'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(list(response.context['all_car_listings']), [cars[1], cars[0]])
+
+    def test_car_listings_view_get_tampered_cursor(self):
+        '''
+        Test a cursor holding values of the wrong type falls back to the first page
+        '''
+        cars = self.create_test_cars([10000, 20000])
+
+        for sort, position in [
+            ('price', [None, 1]),
+            ('-price', ['abc', 1]),
+            ('price', [True, 1]),
+            ('price', [10000, '1']),
+            ('newest', [False]),
+            ('newest', [None]),
+        ]:
+            cursor = urlsafe_base64_encode(json.dumps(position).encode())
+            response = self.client.get(reverse('car_listings'), {'sort': sort, 'cursor': cursor})
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(set(response.context['all_car_listings']), set(cars))
+            self.assertTrue(response.context['page'].is_first())
+
+    # -- SEARCH --
+    def test_search_view_get(self):
+        '''
+        Test get search without filters lists every car
+        '''
+        cars = self.create_test_cars([10000, 20000])
+
+        response = self.client.get(reverse('search'))
+        self.assertEqual(response.status_code, 200)
+        self.assertTemplateUsed(response, APP_NAME + 'search.html')
+        self.assertEqual(response.context['total'], 2)
+        self.assertEqual(list(response.context['results']), [cars[1], cars[0]])
+
+    def test_search_view_get_filtered(self):
+        '''
+        Test search filters by price range and condition
+        '''
+        cars = self.create_test_cars([10000, 20000, 30000, 40000])
+        cars[2].condition = 'FAIR'
+        cars[2].save()
+
+        response = self.client.get(reverse('search'), {
+            'price_min': 15000,
+            'price_max': 35000,
+            'condition': 'GOOD',
+        })
+        self.assertEqual(response.context['total'], 1)
+        self.assertEqual(list(response.context['results']), [cars[1]])
+
+    def test_search_view_get_sorted(self):
+        '''
+        Test search sorted by odometer
+        '''
+        cars = self.create_test_cars([10000, 20000, 30000])
+        for odometer, car in zip([300, 100, 200], cars):
+            car.odometer = odometer
+            car.save()
+
+        response = self.client.get(reverse('search'), {'sort': 'odometer'})
+        self.assertEqual(list(response.context['results']), [cars[1], cars[2], cars[0]])
+
+    def test_search_view_get_facets(self):
+        '''
+        Test search counts the cars per facet value
+        '''
+        cars = self.create_test_cars([10000, 20000, 30000])
+        cars[0].status = 'SOLD'
+        cars[0].location = 'Melbourne'
+        cars[0].save()
+
+        response = self.client.get(reverse('search'))
+        facets = response.context['facets']
+
+        self.assertEqual(facets['brand'], [
+            {'value': cars[0].model.brand.id, 'label': 'Test Brand', 'count': 3, 'query': 'brand={}'.format(cars[0].model.brand.id)},
+        ])
+        self.assertEqual([(facet['value'], facet['count']) for facet in facets['status']], [('AVAILABLE', 2), ('SOLD', 1)])
+        self.assertEqual([(facet['value'], facet['count']) for facet in facets['location']], [('Sydney', 2), ('Melbourne', 1)])
+        self.assertEqual([(facet['value'], facet['count']) for facet in facets['year']], [(2020, 3)])
+
+    def test_search_view_get_bounded_queries(self):
+        '''
+        Test the number of queries of a search does not grow with the results
+        '''
+        cars = self.create_test_cars([10000, 20000])
+        # load the lookup tables into the lookup cache
+        self.client.get(reverse('search'))
+        with CaptureQueriesContext(connection) as few_cars:
+            self.client.get(reverse('search'))
+
+        # copy the cars until there are more than fit in one page
+        for price in range(30):
+            cars[0].pk = None
+            cars[0].price = price
+            cars[0].save()
+        with CaptureQueriesContext(connection) as many_cars:
+            self.client.get(reverse('search'))
+
+        self.assertEqual(len(few_cars), len(many_cars))
+
+    def test_search_view_get_keywords(self):
+        '''
+        Test search by keywords matches the description and ranks by relevance
+        '''
+        cars = self.create_test_cars([10000, 20000, 30000])
+        cars[0].description = 'Sunroof and leather seats'
+        cars[0].save()
+        cars[2].description = 'Leather seats'
+        cars[2].save()
+
+        response = self.client.get(reverse('search'), {'q': 'leather sunroof'})
+        self.assertEqual(list(response.context['results']), [cars[0]])
+
+        response = self.client.get(reverse('search'), {'q': 'leather'})
+        self.assertEqual(response.context['total'], 2)
+        self.assertEqual(set(response.context['results']), {cars[0], cars[2]})
+
+    def test_search_view_get_keywords_misspelled(self):
+        '''
+        Test search by a misspelled brand falls back to similar brand names
+        '''
+        cars = self.create_test_cars([10000])
+        cars[0].model.brand.name = 'Toyota'
+        cars[0].model.brand.save()
+
+        response = self.client.get(reverse('search'), {'q': 'toyta'})
+        self.assertEqual(list(response.context['results']), [cars[0]])
+
+        response = self.client.get(reverse('search'), {'q': 'ferrari'})
+        self.assertEqual(list(response.context['results']), [])
+
+    def test_search_view_get_keywords_paginated(self):
+        '''
+        Test paging through cars tied on relevance shows every car once and ends
+        '''
+        cars = self.create_test_cars([10000, 20000, 30000, 40000])
+        cars[0].model.brand.name = 'Toyota'
+        cars[0].model.brand.save()
+
+        # the full-text ranks, then the similarities of a misspelled brand
+        for keywords in ('toyota', 'toyta'):
+            seen = []
+            cursor = ''
+            for _ in range(len(cars) + 1):
+                response = self.client.get(reverse('search'), {'q': keywords, 'page_size': 1, 'cursor': cursor})
+                seen.extend(response.context['results'])
+                cursor = response.context['page'].next_cursor
+                if cursor is None:
+                    break
+            self.assertIsNone(cursor)
+            self.assertEqual(seen, cars[::-1])
+
+    def test_search_view_get_invalid_range(self):
+        '''
+        Test search with a minimum year greater than the maximum year
+        '''
+        response = self.client.get(reverse('search'), {'year_min': 2020, 'year_max': 2010})
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('The minimum year cannot be greater than the maximum year.', response.context['search_form'].errors['__all__'])
+        self.assertNotIn('results', response.context)
+
     # -- SELLER RATINGS --
     def test_rate_seller_view_get_valid(self):
         '''
@@ -1053,6 +1468,22 @@ class ViewsTest(TestCase):
         self.assertEqual(response.status_code, 200)
         self.assertTemplateUsed(response, APP_NAME + 'rating_buyer.html')
 
+    def test_rate_buyer_view_get_average(self):
+        '''
+        Test the rating buyer get view shows the ratings of the user as a buyer only
+        '''
+        buyer_user = User.objects.create(username='buyer@example.com', email='buyer@example.com')
+        seller_user = User.objects.create(username='seller@example.com', email='seller@example.com')
+        Buyer_Rating.objects.create(rating=4, buyer=buyer_user, seller=seller_user)
+        Buyer_Rating.objects.create(rating=5, buyer=buyer_user, seller=seller_user)
+        Seller_Rating.objects.create(rating=1, buyer=buyer_user, seller=seller_user)
+
+        with self.assertNumQueries(2):
+            response = self.client.get(reverse('rating_buyer', args=[buyer_user.id]))
+        self.assertEqual(response.context['average_rating'], 4.5)
+        self.assertEqual(response.context['rating_count'], 2)
+        self.assertEqual(response.context['histogram'], [0, 0, 0, 1, 1])
+
     def test_rate_buyer_view_post_valid(self):
         '''
         Test valid rating buyer post
@@ -1207,3 +1638,911 @@ class ViewsTest(TestCase):
         # check status code and template
         self.assertEqual(response.status_code, 200)
         self.assertTemplateUsed(response, APP_NAME + 'index.html')
+
+class PreferenceMatchesTest(TestCase):
+    client_class = QueryBudgetClient
+
+    def setUp(self):
+        cache.clear()
+        self.brand = Car_Brand.objects.create(name='Test Brand')
+        self.other_brand = Car_Brand.objects.create(name='Other Brand')
+        self.model = Car_Model.objects.create(brand=self.brand, name='Test Model')
+        self.other_model = Car_Model.objects.create(brand=self.other_brand, name='Other Model')
+        self.petrol = Fuel_Type.objects.create(name='Petrol')
+        self.diesel = Fuel_Type.objects.create(name='Diesel')
+        self.transmission = Transmission_Type.objects.create(name='Automatic')
+        self.seller = User.objects.create(username='seller@example.com', email='seller@example.com')
+        self.buyer = User.objects.create_user(
+            username='buyer@example.com',
+            password='your_password',
+            first_name='Buyer',
+            last_name='Name',
+            email='buyer@example.com'
+        )
+
+        self.preference = Preference.objects.create(
+            user=self.buyer,
+            price_range=Preferred_Price_Range.objects.create(price_min=10000, price_max=20000),
+        )
+        self.preference.fuel.add(self.petrol)
+        self.preference.brand.add(self.brand)
+        self.client.login(username='buyer@example.com', password='your_password')
+
+    def create_car(self, price=15000, fuel_type=None, model=None, status='AVAILABLE'):
+        return Car.objects.create(
+            year=2020,
+            model=model or self.model,
+            registration_number='ABC123',
+            status=status,
+            odometer=50000,
+            price=price,
+            condition='GOOD',
+            fuel_type=fuel_type or self.petrol,
+            transmission=self.transmission,
+            owner=self.seller,
+            location='Sydney',
+        )
+
+    def test_preference_matches_view_get(self):
+        '''
+        Test only the available cars matching every part of the preference are listed
+        '''
+        matching = self.create_car()
+        self.create_car(price=25000)
+        self.create_car(fuel_type=self.diesel)
+        self.create_car(model=self.other_model)
+        self.create_car(status='SOLD')
+
+        response = self.client.get(reverse('preference_matches'))
+        self.assertEqual(response.status_code, 200)
+        self.assertTemplateUsed(response, APP_NAME + 'preference_matches.html')
+        self.assertEqual(response.context['matches'], [matching])
+
+    def test_preference_matches_view_get_paginated(self):
+        '''
+        Test the matches are paginated by cursor, newest first
+        '''
+        cars = [self.create_car() for i in range(3)]
+
+        response = self.client.get(reverse('preference_matches'), {'page_size': 2})
+        self.assertEqual(response.context['matches'], [cars[2], cars[1]])
+
+        response = self.client.get(reverse('preference_matches'), {'page_size': 2, 'cursor': response.context['next_cursor']})
+        self.assertEqual(response.context['matches'], [cars[0]])
+        self.assertIsNone(response.context['next_cursor'])
+
+    def test_preference_matches_view_get_no_preference(self):
+        '''
+        Test a user without a preference has no matches
+        '''
+        self.preference.delete()
+        self.create_car()
+
+        response = self.client.get(reverse('preference_matches'))
+        self.assertEqual(response.context['matches'], [])
+
+    def test_preference_matches_view_get_not_logged_in(self):
+        '''
+        Test the matches require login
+        '''
+        self.client.logout()
+        response = self.client.get(reverse('preference_matches'))
+        self.assertEqual(response.status_code, 302)
+
+    def test_preference_matches_invalidated_on_car_save(self):
+        '''
+        Test the cached matches of the users a car starts or stops matching are recomputed, and the others kept
+        '''
+        other = User.objects.create(username='other@example.com')
+        Preference.objects.create(user=other).brand.add(self.other_brand)
+        self.client.get(reverse('preference_matches'))
+        self.assertEqual(get_matching_car_ids(other), [])
+        with self.captureOnCommitCallbacks(execute=True):
+            car = self.create_car()
+        self.assertIsNone(cache.get(matches_cache_key(self.buyer.pk)))
+        self.assertEqual(get_matching_car_ids(self.buyer), [car.id])
+        with self.assertNumQueries(0):
+            self.assertEqual(get_matching_car_ids(other), [])
+
+        with self.captureOnCommitCallbacks(execute=True):
+            car.status = 'SOLD'
+            car.save()
+        self.assertEqual(get_matching_car_ids(self.buyer), [])
+
+        # a change the matches do not depend on keeps them cached
+        with self.captureOnCommitCallbacks(execute=True):
+            car.description = 'Repainted'
+            car.save()
+        with self.assertNumQueries(0):
+            self.assertEqual(get_matching_car_ids(self.buyer), [])
+
+        with self.captureOnCommitCallbacks(execute=True):
+            car.delete()
+        self.assertEqual(get_matching_car_ids(self.buyer), [])
+
+    def test_preference_matches_invalidated_on_preference_change(self):
+        '''
+        Test the cached matches are recomputed when the preference changes
+        '''
+        car = self.create_car(fuel_type=self.diesel)
+        self.assertEqual(get_matching_car_ids(self.buyer), [])
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.preference.fuel.add(self.diesel)
+        self.assertEqual(get_matching_car_ids(self.buyer), [car.id])
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.preference.price_range.price_max = 12000
+            self.preference.price_range.save()
+        self.assertEqual(get_matching_car_ids(self.buyer), [])
+
+    def test_preference_index_candidates(self):
+        '''
+        Test a car only reads the index rows of the preferences restricting one of its values or nothing
+        '''
+        for number in range(20):
+            other = Preference.objects.create(user=User.objects.create(username='other{}@example.com'.format(number)))
+            other.brand.add(self.other_brand)
+        anything = Preference.objects.create(user=User.objects.create(username='anything@example.com'))
+        self.assertEqual(list(anything.terms.values_list('dimension', 'term')), [('all', 'all:*')])
+        self.assertEqual(list(self.preference.terms.values_list('term', flat=True)), ['make:brand:{}'.format(self.brand.pk)])
+
+        car = self.create_car(price=25000)
+        self.assertEqual(set(candidate_preference_ids(car).values_list('preference_id', flat=True)), {self.buyer.pk, anything.pk})
+        # the candidates are compared on every dimension
+        self.assertEqual(matching_user_ids(car), {anything.pk})
+
+    def test_preference_matches_invalidated_on_choice_cleared(self):
+        '''
+        Test clearing the preferences of a brand from the brand side reindexes them
+        '''
+        self.assertEqual(get_matching_car_ids(self.buyer), [])
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.brand.preferences.clear()
+        self.assertFalse(self.preference.terms.filter(term='make:brand:{}'.format(self.brand.pk)).exists())
+
+        # the preference now matches any brand, so a car of another brand is found and notified
+        car = self.create_car(model=self.other_model)
+        self.assertEqual(get_matching_car_ids(self.buyer), [car.id])
+        self.assertEqual(list(Notification.objects.values_list('car', flat=True)), [car.id])
+
+    def test_new_car_notifies_matching_buyers(self):
+        '''
+        Test a new car notifies only the buyers whose preference it matches, not its owner
+        '''
+        Preference.objects.create(user=self.seller)
+        car = self.create_car()
+        self.create_car(price=25000)
+
+        notifications = Notification.objects.all()
+        self.assertEqual([(n.user, n.car) for n in notifications], [(self.buyer, car)])
+
+        # changing the car does not notify again
+        car.price = 16000
+        car.save()
+        self.assertEqual(Notification.objects.count(), 1)
+
+    def test_new_car_notifies_after_preference_change(self):
+        '''
+        Test the preference index follows the changes to the preference
+        '''
+        self.create_car(fuel_type=self.diesel)
+        self.assertFalse(Notification.objects.exists())
+
+        self.preference.fuel.add(self.diesel)
+        self.preference.price_range.price_max = 40000
+        self.preference.price_range.save()
+        car = self.create_car(price=35000, fuel_type=self.diesel)
+        self.assertEqual(list(Notification.objects.values_list('car', flat=True)), [car.id])
+
+    def test_send_notifications(self):
+        '''
+        Test the queued notifications are sent as one digest per user and marked as sent
+        '''
+        first = self.create_car()
+        second = self.create_car(price=18000)
+
+        self.assertEqual(send_notifications(), 2)
+        send_queued_emails()
+        self.assertEqual(len(mail.outbox), 1)
+        self.assertEqual(mail.outbox[0].to, ['buyer@example.com'])
+        self.assertIn(reverse('car_listing', kwargs={'car_id': first.id}), mail.outbox[0].body)
+        self.assertIn(reverse('car_listing', kwargs={'car_id': second.id}), mail.outbox[0].body)
+        self.assertFalse(Notification.objects.filter(sent_at__isnull=True).exists())
+
+        # nothing is sent twice
+        self.assertEqual(send_notifications(), 0)
+        self.assertEqual(send_queued_emails(), 0)
+        self.assertEqual(len(mail.outbox), 1)
+
+class CarImportTest(TestCase):
+    client_class = QueryBudgetClient
+
+    def setUp(self):
+        brand = Car_Brand.objects.create(name='Toyota')
+        Car_Model.objects.create(brand=brand, name='Corolla')
+        Fuel_Type.objects.create(name='Petrol')
+        Transmission_Type.objects.create(name='Automatic')
+        self.dealer = User.objects.create_user(username='dealer@example.com', email='dealer@example.com', password='your_password')
+        self.client.login(username='dealer@example.com', password='your_password')
+
+    def test_car_import_view_get(self):
+        '''
+        Test the import page is only shown to logged in users
+        '''
+        response = self.client.get(reverse('import-cars'))
+        self.assertEqual(response.status_code, 200)
+        self.assertTemplateUsed(response, APP_NAME + 'car_import.html')
+
+        self.client.logout()
+        response = self.client.get(reverse('import-cars'))
+        self.assertEqual(response.status_code, 302)
+
+    def test_car_import_view_post(self):
+        '''
+        Test the uploaded cars are imported for the user and the invalid rows reported
+        '''
+        content = (
+            'year,registration_number,status,odometer,price,condition,prev_owner_count,location,description,brand,model,fuel_type,transmission\n'
+            '2019,ABC123,AVAILABLE,40000,20000,GOOD,1,Sydney,,Toyota,Corolla,Petrol,Automatic\n'
+            '2019,DEF456,BROKEN,40000,20000,GOOD,1,Sydney,,Toyota,Corolla,Petrol,Automatic\n'
+        )
+        response = self.client.post(reverse('import-cars'), {
+            'file': SimpleUploadedFile('cars.csv', content.encode(), content_type='text/csv'),
+        })
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.context['report'].created, 1)
+        self.assertEqual([line for line, message in response.context['errors']], [3])
+        self.assertEqual(Car.objects.get().owner, self.dealer)
+
+    def test_car_import_view_post_unreadable_rows(self):
+        '''
+        Test the cars read before a line which cannot be decoded are imported, and the report says where the import stopped
+        '''
+        content = (
+            'year,registration_number,status,odometer,price,condition,prev_owner_count,location,description,brand,model,fuel_type,transmission\n'
+            '2019,ABC123,AVAILABLE,40000,20000,GOOD,1,Sydney,,Toyota,Corolla,Petrol,Automatic\n'
+        ).encode() + b'2019,DEF456,AVAILABLE,40000,20000,GOOD,1,\xff,,Toyota,Corolla,Petrol,Automatic\n'
+        response = self.client.post(reverse('import-cars'), {
+            'file': SimpleUploadedFile('cars.csv', content, content_type='text/csv'),
+        })
+        self.assertEqual(response.context['report'].created, 1)
+        self.assertEqual(response.context['report'].stopped[0], 2)
+        self.assertContains(response, 'The import stopped after line 2')
+        self.assertEqual(Car.objects.get().registration_number, 'ABC123')
+
+    def test_car_import_view_post_invalid_file(self):
+        '''
+        Test a file of another type is rejected
+        '''
+        response = self.client.post(reverse('import-cars'), {
+            'file': SimpleUploadedFile('cars.xlsx', b'data'),
+        })
+        self.assertIsNone(response.context['report'])
+        self.assertTrue(response.context['form'].errors)
+        self.assertFalse(Car.objects.exists())
+
+class CarExportTest(TestCase):
+    client_class = QueryBudgetClient
+
+    def test_car_export_view_get(self):
+        '''
+        Test the export is streamed to staff users only
+        '''
+        User.objects.create_user(username='user@example.com', password='your_password')
+        User.objects.create_user(username='staff@example.com', password='your_password', is_staff=True)
+
+        self.client.login(username='user@example.com', password='your_password')
+        response = self.client.get(reverse('export-cars'))
+        self.assertEqual(response.status_code, 302)
+
+        self.client.login(username='staff@example.com', password='your_password')
+        response = self.client.get(reverse('export-cars'), {'format': 'jsonl'})
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.streaming)
+        self.assertEqual(response['Content-Disposition'], 'attachment; filename="cars.jsonl"')
+        self.assertEqual(b''.join(response.streaming_content), b'')
+
+class CarApiTest(TestCase):
+    client_class = QueryBudgetClient
+
+    def setUp(self):
+        brand = Car_Brand.objects.create(name='Test Brand')
+        self.model = Car_Model.objects.create(brand=brand, name='Test Model')
+        self.fuel_type = Fuel_Type.objects.create(name='Petrol')
+        self.transmission = Transmission_Type.objects.create(name='Automatic')
+        self.owner = User.objects.create(username='owner@example.com', email='owner@example.com')
+        self.cars = [self.create_car(price) for price in [30000, 10000, 20000]]
+
+    def create_car(self, price):
+        return Car.objects.create(
+            year=2020,
+            model=self.model,
+            registration_number='ABC123',
+            status='AVAILABLE',
+            odometer=50000,
+            price=price,
+            condition='GOOD',
+            fuel_type=self.fuel_type,
+            transmission=self.transmission,
+            owner=self.owner,
+            location='Sydney',
+        )
+
+    def test_car_list_api_get(self):
+        '''
+        Test the cars are listed as compact JSON in one query, paginated by cursor
+        '''
+        with self.assertNumQueries(1):
+            response = self.client.get(reverse('api_car_list'), {'sort': 'price', 'page_size': 2})
+        self.assertEqual(response.status_code, 200)
+        data = response.json()
+        self.assertEqual([car['id'] for car in data['results']], [self.cars[1].id, self.cars[2].id])
+        self.assertEqual(data['results'][0]['brand_name'], 'Test Brand')
+        self.assertEqual(data['results'][0]['transmission_name'], 'Automatic')
+        self.assertNotIn('description', data['results'][0])
+
+        response = self.client.get(reverse('api_car_list'), {'sort': 'price', 'page_size': 2, 'cursor': data['next_cursor']})
+        self.assertEqual([car['id'] for car in response.json()['results']], [self.cars[0].id])
+        self.assertIsNone(response.json()['next_cursor'])
+
+    def test_car_list_api_get_not_modified(self):
+        '''
+        Test an unchanged list is not sent again, and a changed car changes the ETag
+        '''
+        response = self.client.get(reverse('api_car_list'))
+        etag = response.headers['ETag']
+
+        response = self.client.get(reverse('api_car_list'), HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.content, b'')
+
+        self.cars[0].price = 25000
+        self.cars[0].save()
+        response = self.client.get(reverse('api_car_list'), HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response.headers['ETag'], etag)
+
+    def test_car_list_api_get_deleted(self):
+        '''
+        Test a list has no Last-Modified, so a client asking since its last update still sees a car deleted
+        '''
+        response = self.client.get(reverse('api_car_list'))
+        self.assertNotIn('Last-Modified', response.headers)
+        etag = response.headers['ETag']
+
+        # the latest update of the cars left does not move
+        self.cars[0].delete()
+        response = self.client.get(reverse('api_car_list'), HTTP_IF_MODIFIED_SINCE=http_date())
+        self.assertEqual(response.status_code, 200)
+        self.assertNotIn(self.cars[0].id, [car['id'] for car in response.json()['results']])
+
+        response = self.client.get(reverse('api_car_list'), HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+
+    def test_car_detail_api_get(self):
+        '''
+        Test a car is returned with its details and supports conditional requests
+        '''
+        car = self.cars[0]
+        response = self.client.get(reverse('api_car_detail', args=[car.id]))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['registration_number'], 'ABC123')
+        self.assertEqual(response.json()['model_name'], 'Test Model')
+
+        response = self.client.get(reverse('api_car_detail', args=[car.id]), HTTP_IF_MODIFIED_SINCE=response.headers['Last-Modified'])
+        self.assertEqual(response.status_code, 304)
+
+        # renaming the brand changes the cars showing it
+        etag = self.client.get(reverse('api_car_detail', args=[car.id])).headers['ETag']
+        self.model.brand.name = 'Renamed Brand'
+        self.model.brand.save()
+        response = self.client.get(reverse('api_car_detail', args=[car.id]), HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['brand_name'], 'Renamed Brand')
+
+    def test_car_detail_api_get_invalid(self):
+        '''
+        Test a missing car is a JSON 404 and writes are not allowed
+        '''
+        response = self.client.get(reverse('api_car_detail', args=[999999]))
+        self.assertEqual(response.status_code, 404)
+        self.assertIn('error', response.json())
+
+        response = self.client.post(reverse('api_car_detail', args=[self.cars[0].id]))
+        self.assertEqual(response.status_code, 405)
+
+    def test_car_search_api_get(self):
+        '''
+        Test the search api filters the cars and reports invalid filters
+        '''
+        response = self.client.get(reverse('api_car_search'), {'price_max': 20000, 'sort': '-price'})
+        self.assertEqual([car['id'] for car in response.json()['results']], [self.cars[2].id, self.cars[1].id])
+
+        response = self.client.get(reverse('api_car_search'), {'q': 'test brand'})
+        self.assertEqual(len(response.json()['results']), 3)
+        self.assertNotIn('rank', response.json()['results'][0])
+
+        response = self.client.get(reverse('api_car_search'), {'price_min': 30000, 'price_max': 10000})
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('errors', response.json())
+
+    def test_brand_models_api_get(self):
+        '''
+        Test the models of a brand are listed from the lookup cache, with a 304 response until a model changes
+        '''
+        other_brand = Car_Brand.objects.create(name='Other Brand')
+        Car_Model.objects.create(brand=other_brand, name='Other Model')
+        brand_id = self.model.brand_id
+        Car_Model.objects.create(brand_id=brand_id, name='Another Model')
+
+        response = self.client.get(reverse('api_brand_models', args=[brand_id]))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([model['name'] for model in response.json()['results']], ['Another Model', 'Test Model'])
+
+        with self.assertNumQueries(0):
+            response = self.client.get(reverse('api_brand_models', args=[brand_id]), HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(response.status_code, 304)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            Car_Model.objects.create(brand_id=brand_id, name='New Model')
+        response = self.client.get(reverse('api_brand_models', args=[brand_id]), HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('New Model', [model['name'] for model in response.json()['results']])
+
+        self.assertEqual(self.client.get(reverse('api_brand_models', args=[9999])).status_code, 404)
+
+    @override_settings(LOOKUP_CACHE_TIMEOUT=60)
+    def test_brand_models_api_get_changed_elsewhere(self):
+        '''
+        Test a model added by a process not sharing the cache is listed once the lookup version expires
+        '''
+        brand_id = self.model.brand_id
+        response = self.client.get(reverse('api_brand_models', args=[brand_id]))
+
+        # a bulk create sends no signal, as if the model was added by another process
+        Car_Model.objects.bulk_create([Car_Model(brand_id=brand_id, name='New Model')])
+        response = self.client.get(reverse('api_brand_models', args=[brand_id]), HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(response.status_code, 304)
+
+        with mock.patch('time.time', return_value=time.time() + 61):
+            response = self.client.get(reverse('api_brand_models', args=[brand_id]), HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('New Model', [model['name'] for model in response.json()['results']])
+
+class WishlistTest(TestCase):
+    client_class = QueryBudgetClient
+
+    def setUp(self):
+        brand = Car_Brand.objects.create(name='Test Brand')
+        model = Car_Model.objects.create(brand=brand, name='Test Model')
+        fuel_type = Fuel_Type.objects.create(name='Petrol')
+        transmission = Transmission_Type.objects.create(name='Automatic')
+        owner = User.objects.create(username='owner@example.com', email='owner@example.com')
+        self.cars = [Car.objects.create(
+            year=2020,
+            model=model,
+            registration_number='ABC123',
+            status='AVAILABLE',
+            odometer=50000,
+            price=price,
+            condition='GOOD',
+            fuel_type=fuel_type,
+            transmission=transmission,
+            owner=owner,
+            location='Sydney',
+        ) for price in [10000, 20000, 30000, 40000, 50000]]
+        self.user = User.objects.create_user(username='buyer@example.com', email='buyer@example.com', password='your_password')
+        self.client.login(username='buyer@example.com', password='your_password')
+
+    def test_wishlist_add_and_remove(self):
+        '''
+        Test a car is added to the wishlist once, and removed, returning to the page the button was on
+        '''
+        car = self.cars[0]
+        response = self.client.post(reverse('wishlist_add', args=[car.id]), {'next': '/car_listings?sort=price'})
+        self.assertRedirects(response, '/car_listings?sort=price', fetch_redirect_response=False)
+        self.client.post(reverse('wishlist_add', args=[car.id]))
+        self.assertEqual(list(self.user.wishlist.cars.all()), [car])
+
+        # the button points back to the same site only
+        response = self.client.post(reverse('wishlist_remove', args=[car.id]), {'next': 'https://example.org/'})
+        self.assertRedirects(response, reverse('wishlist'), fetch_redirect_response=False)
+        self.assertFalse(self.user.wishlist.cars.exists())
+
+        self.assertEqual(self.client.get(reverse('wishlist_add', args=[car.id])).status_code, 405)
+        response = self.client.post(reverse('wishlist_add', args=[9999]))
+        self.assertTemplateUsed(response, APP_NAME + 'error_page.html')
+
+    def test_wishlist_add_requires_login(self):
+        '''
+        Test an anonymous user is sent to the login page
+        '''
+        self.client.logout()
+        response = self.client.post(reverse('wishlist_add', args=[self.cars[0].id]))
+        self.assertEqual(response.status_code, 302)
+        self.assertFalse(Wishlist.objects.exists())
+
+    def test_car_listings_view_get_in_wishlist(self):
+        '''
+        Test the cards of a page are marked in one query whatever the page size
+        '''
+        wishlist = Wishlist.objects.create(user=self.user)
+        wishlist.cars.add(self.cars[0], self.cars[3])
+
+        with CaptureQueriesContext(connection) as small_page:
+            response = self.client.get(reverse('car_listings'), {'sort': 'price', 'page_size': 2})
+        self.assertEqual([car.in_wishlist for car in response.context['all_car_listings']], [True, False])
+
+        with CaptureQueriesContext(connection) as large_page:
+            response = self.client.get(reverse('car_listings'), {'sort': 'price', 'page_size': 5})
+        self.assertEqual([car.in_wishlist for car in response.context['all_car_listings']], [True, False, False, True, False])
+        self.assertEqual(len(small_page), len(large_page))
+        self.assertContains(response, 'Remove from Wishlist', count=2)
+
+        response = self.client.get(reverse('car_listing', args=[self.cars[0].id]))
+        self.assertContains(response, 'Remove from Wishlist')
+
+    def test_wishlist_view_get_paginated(self):
+        '''
+        Test the wishlist lists only the user's cars, newest first, with the same queries on every page
+        '''
+        wishlist = Wishlist.objects.create(user=self.user)
+        wishlist.cars.add(*self.cars[:4])
+        other = User.objects.create(username='other@example.com', email='other@example.com')
+        Wishlist.objects.create(user=other).cars.add(self.cars[4])
+
+        with CaptureQueriesContext(connection) as first_page:
+            response = self.client.get(reverse('wishlist'), {'page_size': 3})
+        self.assertEqual(list(response.context['wishlist']), self.cars[3:0:-1])
+        self.assertTrue(all(car.in_wishlist for car in response.context['wishlist']))
+
+        with CaptureQueriesContext(connection) as next_page:
+            response = self.client.get(reverse('wishlist'), {'page_size': 3, 'cursor': response.context['page'].next_cursor})
+        self.assertEqual(list(response.context['wishlist']), [self.cars[0]])
+        self.assertEqual(len(first_page), len(next_page))
+
+    def test_car_change_notifies_wishlists(self):
+        '''
+        Test a price drop and a sale notify the users wishlisting the car, read from the loaded car without querying it again
+        '''
+        car = Car.objects.get(pk=self.cars[0].pk)
+        Wishlist.objects.create(user=self.user).cars.add(car)
+        Wishlist.objects.create(user=car.owner).cars.add(car)
+
+        car.price = 12000
+        car.save()
+        self.assertFalse(Notification.objects.exists())
+
+        car.price = 9000
+        with CaptureQueriesContext(connection) as queries:
+            car.save()
+        self.assertFalse([query for query in queries if query['sql'].startswith('SELECT') and 'FROM "marketplace_app_car"' in query['sql']])
+
+        car.status = 'SOLD'
+        car.save(update_fields=['status'])
+        # a change that is not saved is not notified
+        car.price = 5000
+        car.save(update_fields=['description'])
+
+        notifications = Notification.objects.order_by('id')
+        self.assertEqual(
+            [(n.user, n.kind, n.previous_price, n.status) for n in notifications],
+            [(self.user, 'PRICE_DROP', 12000, ''), (self.user, 'STATUS_CHANGE', None, 'SOLD')],
+        )
+
+        self.assertEqual(send_notifications(), 2)
+        send_queued_emails()
+        self.assertEqual(len(mail.outbox), 1)
+        self.assertIn('(was $12000.00)', mail.outbox[0].body)
+        self.assertIn('The car is sold.', mail.outbox[0].body)
+
+class OrderViewsTest(TestCase):
+    client_class = QueryBudgetClient
+
+    def setUp(self):
+        brand = Car_Brand.objects.create(name='Test Brand')
+        self.seller = User.objects.create(username='seller@example.com', email='seller@example.com')
+        self.car = Car.objects.create(
+            year=2020,
+            model=Car_Model.objects.create(brand=brand, name='Test Model'),
+            registration_number='ABC123',
+            status='AVAILABLE',
+            odometer=50000,
+            price=10000,
+            condition='GOOD',
+            fuel_type=Fuel_Type.objects.create(name='Petrol'),
+            transmission=Transmission_Type.objects.create(name='Automatic'),
+            owner=self.seller,
+            location='Sydney',
+        )
+        self.buyer = User.objects.create_user(username='buyer@example.com', password='your_password')
+        self.client.login(username='buyer@example.com', password='your_password')
+
+    def test_order_car_view_post(self):
+        '''
+        Test ordering a car from its page holds it for the buyer, and a second order is refused with a message
+        '''
+        response = self.client.post(reverse('order_car', args=[self.car.id]), follow=True)
+        self.assertRedirects(response, reverse('car_listing', args=[self.car.id]))
+        self.assertContains(response, 'Your order has been placed')
+        self.assertEqual(Order.objects.get().buyer, self.buyer)
+
+        response = self.client.post(reverse('order_car', args=[self.car.id]), follow=True)
+        self.assertContains(response, 'The car is no longer available.')
+        self.assertEqual(Order.objects.count(), 1)
+        self.assertEqual(self.client.get(reverse('order_car', args=[self.car.id])).status_code, 405)
+
+    def test_order_api_post(self):
+        '''
+        Test the order api answers with the order, or a conflict once the car is taken
+        '''
+        response = self.client.post(reverse('api_order_car', args=[self.car.id]))
+        self.assertEqual(response.status_code, 201)
+        order = response.json()
+        self.assertEqual((order['car_id'], order['buyer_id'], order['status']), (self.car.id, self.buyer.id, 'PENDING'))
+
+        response = self.client.post(reverse('api_order_car', args=[self.car.id]))
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(self.client.post(reverse('api_order_car', args=[9999])).status_code, 404)
+        self.assertEqual(self.client.post(reverse('api_complete_order', args=[order['id']])).status_code, 403)
+
+        response = self.client.post(reverse('api_cancel_order', args=[order['id']]))
+        self.assertEqual(response.json()['status'], 'CANCELLED')
+        self.car.refresh_from_db()
+        self.assertEqual(self.car.status, 'AVAILABLE')
+
+        self.client.logout()
+        self.assertEqual(self.client.post(reverse('api_order_car', args=[self.car.id])).status_code, 401)
+
+    def create_orders(self, count):
+        '''
+        Create completed orders of other cars of the seller for the buyer
+        '''
+        orders = []
+        for price in range(count):
+            car = Car.objects.get(pk=self.car.pk)
+            car.pk = None
+            car.price = 1000 * (price + 1)
+            car.save()
+            orders.append(Order.objects.create(seller=self.seller, buyer=self.buyer, car=car, status='COMPLETED', completed_at=timezone.now() + timezone.timedelta(days=2)))
+        return orders
+
+    def test_order_dashboard_view_get(self):
+        '''
+        Test the dashboards list the orders and their stats with the same queries whatever the number of orders
+        '''
+        with self.captureOnCommitCallbacks(execute=True):
+            self.create_orders(1)
+        with CaptureQueriesContext(connection) as one_order:
+            response = self.client.get(reverse('purchase_orders'))
+        self.assertEqual(len(response.context['orders']), 1)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.create_orders(3)
+            place_order(self.buyer, self.car.pk)
+        with CaptureQueriesContext(connection) as five_orders:
+            response = self.client.get(reverse('purchase_orders'))
+        self.assertEqual(len(response.context['orders']), 5)
+        self.assertEqual(len(one_order), len(five_orders))
+
+        stats = response.context['stats']
+        self.assertEqual(stats['counts'], {'PENDING': 1, 'COMPLETED': 4, 'CANCELLED': 0})
+        self.assertEqual(stats['total_value'], 7000)
+        self.assertAlmostEqual(stats['average_days'], 2, places=2)
+        self.assertContains(response, 'Total Spent:</strong> $7000.00')
+
+        response = self.client.get(reverse('purchase_orders'), {'status': 'PENDING'})
+        self.assertEqual([order.car for order in response.context['orders']], [self.car])
+
+    def test_order_dashboard_view_get_cached_stats(self):
+        '''
+        Test the stats are cached per user, and recomputed once one of their orders changes
+        '''
+        with self.captureOnCommitCallbacks(execute=True):
+            order = place_order(self.buyer, self.car.pk)
+        self.client.force_login(self.seller)
+        self.client.get(reverse('sales_orders'))
+
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(reverse('sales_orders'))
+        self.assertFalse([query for query in queries if 'GROUP BY' in query['sql']])
+        self.assertEqual(response.context['stats']['counts']['PENDING'], 1)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post(reverse('complete_order', args=[order.pk]))
+        self.assertRedirects(response, reverse('sales_orders'), fetch_redirect_response=False)
+        response = self.client.get(reverse('sales_orders'))
+        self.assertEqual(response.context['stats']['counts'], {'PENDING': 0, 'COMPLETED': 1, 'CANCELLED': 0})
+        self.assertEqual(response.context['stats']['total_value'], 10000)
+
+class CarImagesTest(TestCase):
+    client_class = QueryBudgetClient
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        media = self.settings(MEDIA_ROOT=directory.name)
+        media.enable()
+        self.addCleanup(media.disable)
+
+        self.owner = User.objects.create_user(username='owner@example.com', password='your_password')
+        self.car = Car.objects.create(
+            year=2020,
+            model=Car_Model.objects.create(brand=Car_Brand.objects.create(name='Test Brand'), name='Test Model'),
+            registration_number='ABC123',
+            status='AVAILABLE',
+            odometer=50000,
+            price=10000,
+            condition='GOOD',
+            fuel_type=Fuel_Type.objects.create(name='Petrol'),
+            transmission=Transmission_Type.objects.create(name='Automatic'),
+            owner=self.owner,
+            location='Sydney',
+        )
+        self.client.login(username='owner@example.com', password='your_password')
+
+    def make_image(self, name, color):
+        buffer = BytesIO()
+        Image.new('RGB', (800, 600), color).save(buffer, 'PNG')
+        return SimpleUploadedFile(name, buffer.getvalue(), content_type='image/png')
+
+    def test_car_images_view_post(self):
+        '''
+        Test the owner uploads several images at once, and the cards show their thumbnail once generated
+        '''
+        response = self.client.post(reverse('car_images', args=[self.car.id]), {'images': [self.make_image('front.png', 'red'), self.make_image('back.png', 'blue')]})
+        self.assertRedirects(response, reverse('car_images', args=[self.car.id]))
+        self.assertEqual(self.car.files.count(), 2)
+
+        # the card shows a placeholder until the thumbnails are generated
+        response = self.client.get(reverse('car_listings'))
+        self.assertContains(response, 'no_image.svg')
+
+        with self.captureOnCommitCallbacks(execute=True):
+            generate_thumbnails()
+        first = self.car.files.order_by('id').first()
+        response = self.client.get(reverse('car_listings'))
+        self.assertContains(response, thumbnail_name(first.sha256, 'card'))
+        self.assertNotContains(response, 'imageio.forbes.com')
+
+        response = self.client.get(reverse('car_listing', args=[self.car.id]))
+        self.assertContains(response, thumbnail_name(first.sha256, 'large'))
+        self.assertContains(response, 'Manage Images')
+
+    def test_car_listing_view_get_thumbnails_generated_elsewhere(self):
+        '''
+        Test the cached car listing shows the images once a worker not sharing the cache made their thumbnails
+        '''
+        self.client.post(reverse('car_images', args=[self.car.id]), {'images': self.make_image('front.png', 'red')})
+        response = self.client.get(reverse('car_listing', args=[self.car.id]))
+        image = self.car.files.get()
+        self.assertNotContains(response, thumbnail_name(image.sha256, 'large'))
+
+        # the commit callbacks are not run, as the worker's invalidation would not reach this process
+        generate_thumbnails()
+        response = self.client.get(reverse('car_listing', args=[self.car.id]))
+        self.assertContains(response, thumbnail_name(image.sha256, 'large'))
+
+    def test_car_images_view_post_invalid(self):
+        '''
+        Test a file that is not an image is refused, and only the owner manages the images
+        '''
+        response = self.client.post(reverse('car_images', args=[self.car.id]), {'images': SimpleUploadedFile('car.png', b'not an image')})
+        self.assertFalse(response.context['form'].is_valid())
+        self.assertFalse(self.car.files.exists())
+
+        User.objects.create_user(username='other@example.com', password='your_password')
+        self.client.login(username='other@example.com', password='your_password')
+        response = self.client.post(reverse('car_images', args=[self.car.id]), {'images': self.make_image('car.png', 'red')})
+        self.assertTemplateUsed(response, APP_NAME + 'error_page.html')
+        self.assertFalse(self.car.files.exists())
+
+class QueryBudgetTest(TestCase):
+    client_class = QueryBudgetClient
+
+    def setUp(self):
+        car_brand = Car_Brand.objects.create(name='Test Brand')
+        fuel_type = Fuel_Type.objects.create(name='Petrol')
+        transmission_type = Transmission_Type.objects.create(name='Automatic')
+        owner = User.objects.create(username='owner@example.com', email='owner@example.com')
+        for name in ['Model A', 'Model B', 'Model C']:
+            Car.objects.create(
+                year=2020, model=Car_Model.objects.create(brand=car_brand, name=name),
+                registration_number='ABC123', status='AVAILABLE', odometer=50000, price=10000,
+                condition='GOOD', fuel_type=fuel_type, transmission=transmission_type,
+                owner=owner, location='Sydney',
+            )
+
+    def test_every_url_has_a_budget(self):
+        for pattern in urlpatterns:
+            with self.subTest(url=pattern.name):
+                self.assertIn(pattern.name, QUERY_BUDGETS)
+
+    def test_view_over_budget(self):
+        '''
+        Test a view running more queries than the budget of its url fails its tests
+        '''
+        self.client.get(reverse('car_listings'))
+
+        with mock.patch.dict(QUERY_BUDGETS, {'car_listings': 0}):
+            with self.assertRaisesMessage(QueryBudgetExceeded, 'over its budget of 0'):
+                self.client.get(reverse('car_listings'))
+
+    def test_query_for_each_row(self):
+        '''
+        Test a query run for each row is found, and the same rows read by a join are not
+        '''
+        with self.assertRaisesMessage(QueryBudgetExceeded, 'ran the same query 3 times'):
+            with query_budget(10):
+                [car.model.name for car in Car.objects.all()]
+
+        with query_budget(1):
+            [car.model.name for car in Car.objects.select_related('model')]
+
+@override_settings(PERFORMANCE_METRICS=True, PERFORMANCE_METRICS_TOKEN='')
+class PerformanceMiddlewareTest(TestCase):
+    client_class = QueryBudgetClient
+
+    def setUp(self):
+        reset_metrics()
+        self.addCleanup(reset_metrics)
+        cache.clear()
+
+    def test_server_timing(self):
+        '''
+        Test every response has the timings of its request in a Server-Timing header
+        '''
+        response = self.client.get(reverse('car_listings'))
+
+        self.assertRegex(response['Server-Timing'], r'^total;dur=[\d.]+, db;dur=[\d.]+;desc="1 queries", template;dur=[\d.]+, cache;desc="\d+ hits \d+ misses"$')
+
+    def test_metrics_view_get(self):
+        '''
+        Test the metrics of the requests are served by url name in the Prometheus text format
+        '''
+        car_brand = Car_Brand.objects.create(name='Test Brand')
+        car = Car.objects.create(
+            year=2020, model=Car_Model.objects.create(brand=car_brand, name='Test Model'),
+            registration_number='ABC123', status='AVAILABLE', odometer=50000, price=10000, condition='GOOD',
+            fuel_type=Fuel_Type.objects.create(name='Petrol'), transmission=Transmission_Type.objects.create(name='Automatic'),
+            owner=User.objects.create(username='owner@example.com', email='owner@example.com'), location='Sydney',
+        )
+        self.client.get(reverse('car_listing', args=[car.id]))
+        self.client.get(reverse('car_listing', args=[car.id]))
+        self.client.get(reverse('car_listings'))
+        self.client.get(reverse('car_listings'))
+        self.client.get('/no_such_page')
+
+        response = self.client.get(reverse('metrics'))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], 'text/plain; version=0.0.4; charset=utf-8')
+        content = response.content.decode()
+        # the series of each worker process are told apart by its pid
+        pid = 'pid="{}",'.format(os.getpid())
+        self.assertIn('marketplace_requests_total{' + pid + 'view="car_listings",method="GET",status="200"} 2\n', content)
+        self.assertIn('marketplace_requests_total{' + pid + 'view="unresolved",method="GET",status="404"} 1\n', content)
+        self.assertIn('marketplace_request_duration_seconds_bucket{' + pid + 'view="car_listings",method="GET",le="+Inf"} 2\n', content)
+        self.assertIn('marketplace_request_duration_seconds_count{' + pid + 'view="car_listings",method="GET"} 2\n', content)
+        self.assertIn('marketplace_db_queries_total{' + pid + 'view="car_listings",method="GET"} 2\n', content)
+        self.assertIn('# TYPE marketplace_template_duration_seconds_total counter\n', content)
+        # the car listing is rendered once, then read from the cache
+        self.assertRegex(content, r'marketplace_cache_hits_total\{' + pid + r'view="car_listing",method="GET"\} [1-9]')
+        self.assertRegex(content, r'marketplace_cache_misses_total\{' + pid + r'view="car_listing",method="GET"\} [1-9]')
+
+    @override_settings(PERFORMANCE_METRICS_TOKEN='secret')
+    def test_metrics_view_get_token(self):
+        self.assertEqual(self.client.get(reverse('metrics')).status_code, 401)
+        self.assertEqual(self.client.get(reverse('metrics'), HTTP_AUTHORIZATION='Bearer wrong').status_code, 401)
+        self.assertEqual(self.client.get(reverse('metrics'), HTTP_AUTHORIZATION='Bearer secret').status_code, 200)
+
+    @override_settings(PERFORMANCE_METRICS=False)
+    def test_metrics_disabled(self):
+        '''
+        Test the middleware removes itself and the metrics are not served when the metrics are off
+        '''
+        response = self.client.get(reverse('car_listings'))
+
+        self.assertNotIn('Server-Timing', response)
+        self.assertEqual(self.client.get(reverse('metrics')).status_code, 404)
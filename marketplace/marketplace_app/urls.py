@@ -1,5 +1,5 @@
 from django.urls import path, re_path
-from . import views
+from . import api, views
 
 urlpatterns = [
     path('', views.index, name="index"),
@@ -37,12 +37,44 @@ urlpatterns = [
     
     # car creations
     path('car', views.CarCreateView.as_view(), name="create-car"),
+    path('car/import', views.car_import_view, name="import-cars"),
+    path('car/export', views.car_export_view, name="export-cars"),
     path('model', views.CarModelCreateView.as_view(), name="create-model"),
     path('brand', views.CarBrandCreateView.as_view(), name="create-brand"),
     path('transmission', views.TransmissionCreateView.as_view(), name="create-transmission"),
     path("fuel", views.FuelCreateView.as_view(), name="create-fuel"),
     path("car_listings", views.car_listings_view, name="car_listings"),
     path('car_listing/<int:car_id>/', views.car_listing_view, name='car_listing'),
+    path('car_listing/<int:car_id>/images', views.car_images_view, name='car_images'),
+    path('car_listing/<int:car_id>/images/<int:file_id>/delete', views.car_image_delete_view, name='delete_car_image'),
+    path('search', views.search_view, name='search'),
+    path('matches', views.preference_matches_view, name='preference_matches'),
+
+    # wishlist
+    path('wishlist', views.wishlist_view, name='wishlist'),
+    path('wishlist/add/<int:car_id>', views.wishlist_add_view, name='wishlist_add'),
+    path('wishlist/remove/<int:car_id>', views.wishlist_remove_view, name='wishlist_remove'),
+
+    # orders
+    path('car_listing/<int:car_id>/order', views.order_car_view, name='order_car'),
+    path('order/<int:order_id>/complete', views.complete_order_view, name='complete_order'),
+    path('order/<int:order_id>/cancel', views.cancel_order_view, name='cancel_order'),
+    path('orders/sales', views.order_dashboard_view, {'role': 'sales'}, name='sales_orders'),
+    path('orders/purchases', views.order_dashboard_view, {'role': 'purchases'}, name='purchase_orders'),
+
+    # read api
+    path('api/cars', api.car_list_api, name='api_car_list'),
+    path('api/cars/search', api.car_search_api, name='api_car_search'),
+    path('api/cars/<int:car_id>', api.car_detail_api, name='api_car_detail'),
+    path('api/brands/<int:brand_id>/models', api.brand_models_api, name='api_brand_models'),
+
+    # order api
+    path('api/cars/<int:car_id>/order', api.order_car_api, name='api_order_car'),
+    path('api/orders/<int:order_id>/complete', api.complete_order_api, name='api_complete_order'),
+    path('api/orders/<int:order_id>/cancel', api.cancel_order_api, name='api_cancel_order'),
+
+    # request metrics for Prometheus
+    path('metrics', views.metrics_view, name='metrics'),
     
     #edit lists
     # path('create_listing/', views.create_listing, name='create_listing'),
@@ -51,3 +83,57 @@ urlpatterns = [
     # path('listing_detail/<int:listing_id>/', views.listing_detail, name='listing_detail'),
 ]
 
+# the most queries each view may run, for every method or by method, checked by
+# the view tests through QueryBudgetClient. A logged in request reads the
+# session and the user first. A view running more queries, or the same query
+# for each row of a page, fails its tests: raise its budget only when the
+# queries added do not grow with the number of rows.
+QUERY_BUDGETS = {
+    'index': 2,
+    'error_page': 2,
+    'login': {'GET': 2, 'POST': 9},
+    'signup': {'GET': 0, 'POST': 5},
+    'logout': 4,
+    # deleting an account runs the delete signals of each of its cars
+    'account_delete': {'GET': 2, 'POST': None},
+    'forgotpassword': {'GET': 0, 'POST': 3},
+    'reset_password': {'GET': 0, 'POST': 3},
+    'reset_email_sent': 0,
+    'invalid_reset': 0,
+    'activate': 13,
+    'activate_email_sent': 0,
+    'invalid_activation': 0,
+    'rating_seller': {'GET': 3, 'POST': 14},
+    'rating_buyer': {'GET': 3, 'POST': 13},
+    'confirm_rating': 2,
+    'account_detail': {'GET': 3, 'POST': 6},
+    'create-car': {'GET': 6, 'POST': 8},
+    'import-cars': {'GET': 2, 'POST': 11},
+    'export-cars': 3,
+    'create-model': {'GET': 2, 'POST': 6},
+    'create-brand': {'GET': 2, 'POST': 4},
+    'create-transmission': {'GET': 2, 'POST': 4},
+    'create-fuel': {'GET': 2, 'POST': 4},
+    'car_listings': 4,
+    'car_listing': 6,
+    'car_images': {'GET': 4, 'POST': 13},
+    'delete_car_image': 4,
+    'search': 7,
+    'preference_matches': 6,
+    'wishlist': 3,
+    'wishlist_add': 8,
+    'wishlist_remove': 3,
+    'order_car': 10,
+    'complete_order': 10,
+    'cancel_order': 11,
+    'sales_orders': 4,
+    'purchase_orders': 4,
+    'api_car_list': 1,
+    'api_car_search': 2,
+    'api_car_detail': 1,
+    'api_brand_models': 2,
+    'api_order_car': 10,
+    'api_complete_order': 8,
+    'api_cancel_order': 11,
+    'metrics': 0,
+}
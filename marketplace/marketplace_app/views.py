@@ -1,26 +1,43 @@
 from django.shortcuts import render, redirect, get_object_or_404
 from django.contrib.sites.shortcuts import get_current_site
 from django.template.loader import render_to_string
-from django.http import HttpResponse, Http404
+from django.urls import reverse
+from django.http import HttpResponse, Http404, StreamingHttpResponse
 from django.utils.html import escape
+from django.utils.safestring import mark_safe
+from django.core.cache import cache
 from django.utils.encoding import force_bytes, force_str
-from django.utils.http import urlsafe_base64_encode, urlsafe_base64_decode
+from django.utils.crypto import constant_time_compare
+from django.utils.http import urlsafe_base64_encode, urlsafe_base64_decode, url_has_allowed_host_and_scheme
 from django.contrib.auth import login, authenticate, get_user_model
-from django.core.mail import send_mail
 from django.contrib.auth.mixins import LoginRequiredMixin
 from django.forms.models import BaseModelForm
 from django.views.generic import CreateView
-from django.db.models import Avg
+from django.views.decorators.http import require_POST, require_safe
+from django.db import transaction
 from django.conf import settings
 from django.contrib.auth.forms import UserChangeForm
 from django.contrib import messages
 
 # from .forms import UserDetailForm
 from django.contrib.auth.decorators import login_required
+from django.contrib.admin.views.decorators import staff_member_required
 from django.contrib.auth import logout
 from .forms import UserUpdateForm, User_DetailUpdateForm
 
 from .tokens import account_activation_token, reset_password_token
+from .pagination import KeysetPaginator, get_page_size
+from .emails import enqueue_email
+from .exporter import EXPORT_FORMATS, export_lines
+from .images import save_car_image, with_cover_image, with_image_ids, with_images
+from .importer import decode_lines, import_cars
+from .instrumentation import render_metrics
+from .listing_cache import car_listing_cache_key
+from .matching import get_matching_car_ids
+from .orders import ORDER_ROLES, OrderError, cancel_order, complete_order, get_order_stats, place_order
+from .ratings import get_rating_summary, with_seller_rating
+from .search import SEARCH_SORTS, filter_cars, get_facets, keyword_search
+from .wishlists import add_to_wishlist, mark_wishlisted, remove_from_wishlist, wishlisted_car_ids
 from .models import *
 from .forms import *
 
@@ -109,7 +126,8 @@ def signup_view(request):
                 user.is_active = False 
                 user.save()
 
-                User_Detail.objects.create(user=user, mobile=form.number_exists())
+                # the number was checked to be unused by save
+                User_Detail.objects.create(user=user, mobile=user.number)
 
                 # sending email to user to confirm
                 current_site = get_current_site(request)
@@ -120,7 +138,7 @@ def signup_view(request):
                     'uid': urlsafe_base64_encode(force_bytes(user.pk)),
                     'token': account_activation_token.make_token(user),
                 })
-                send_mail(subject=subject, message=message, from_email=settings.EMAIL_HOST_USER, recipient_list=[user.email])
+                enqueue_email(subject=subject, message=message, from_email=settings.EMAIL_HOST_USER, recipient_list=[user.email])
                 return redirect('activate_email_sent')
             
             else: # if user signs up with number or email that already exists
@@ -151,7 +169,7 @@ def forgotpassword_view(request):
                     'uid': urlsafe_base64_encode(force_bytes(user.pk)),
                     'token': reset_password_token.make_token(user),
                 })
-                send_mail(subject=subject, message=message, from_email=settings.EMAIL_HOST_USER, recipient_list=[user.email])
+                enqueue_email(subject=subject, message=message, from_email=settings.EMAIL_HOST_USER, recipient_list=[user.email])
 
             else:
                 print("Email does not exist")
@@ -216,7 +234,9 @@ def rate_seller_view(request, seller_id):
 
                 print('Seller:', seller)
                 print('User:', user)
-                Seller_Rating.objects.create(seller=seller, buyer=user, rating=rating, comment=comment)
+                # the rating and the summary of the seller are saved together
+                with transaction.atomic():
+                    Seller_Rating.objects.create(seller=seller, buyer=user, rating=rating, comment=comment)
 
             except Http404: # seller is not found
                 return redirect('error_page')
@@ -225,15 +245,19 @@ def rate_seller_view(request, seller_id):
         return redirect('confirm_rating')
     else:
         try:
-            seller = get_object_or_404(User, id=seller_id)
-            user = request.user
-            if (seller == user):
+            # rating oneself is refused before the user is loaded a second time
+            if seller_id == request.user.pk:
                 return redirect('error_page')
+            seller = get_object_or_404(User, id=seller_id)
 
-            seller_ratings = Seller_Rating.objects.filter(seller=seller)
-            average_rating = seller_ratings.aggregate(Avg('rating'))['rating__avg']
+            summary = get_rating_summary(seller)
 
-            return render(request,  APP_NAME + 'rating_seller.html', {'seller': seller, 'average_rating': average_rating})
+            return render(request,  APP_NAME + 'rating_seller.html', {
+                'seller': seller,
+                'average_rating': summary.seller_rating_average,
+                'rating_count': summary.seller_rating_count,
+                'histogram': summary.seller_histogram(),
+            })
         except Http404:
             # seller is not found
             return redirect('error_page')
@@ -253,7 +277,8 @@ def rate_buyer_view(request, buyer_id):
 
                 print('Buyer:', buyer)
                 print('User:', user)
-                Buyer_Rating.objects.create(seller=user, buyer=buyer, rating=rating, comment=comment)
+                with transaction.atomic():
+                    Buyer_Rating.objects.create(seller=user, buyer=buyer, rating=rating, comment=comment)
 
             except Http404: # seller is not found
                 return redirect('error_page')
@@ -262,41 +287,356 @@ def rate_buyer_view(request, buyer_id):
         return redirect('confirm_rating')
     else:
         try:
-            buyer = get_object_or_404(User, id=buyer_id)
-            user = request.user
-            if (buyer == user):
+            # rating oneself is refused before the user is loaded a second time
+            if buyer_id == request.user.pk:
                 return redirect('error_page')
+            buyer = get_object_or_404(User, id=buyer_id)
 
-            buyer_ratings = Seller_Rating.objects.filter(buyer=buyer)
-            average_rating = buyer_ratings.aggregate(Avg('rating'))['rating__avg']
+            summary = get_rating_summary(buyer)
 
-            return render(request,  APP_NAME + 'rating_buyer.html', {'buyer': buyer, 'average_rating': average_rating})
+            return render(request,  APP_NAME + 'rating_buyer.html', {
+                'buyer': buyer,
+                'average_rating': summary.buyer_rating_average,
+                'rating_count': summary.buyer_rating_count,
+                'histogram': summary.buyer_histogram(),
+            })
         except Http404:
             # buyer is not found
             return redirect('error_page')
 
 # single car listing view
+# the car details are rendered once and cached until the car, its related rows or its ready images change
 def car_listing_view(request, car_id):
-    try:
-        current_car = get_object_or_404(Car, id=car_id)
-        return render(request, APP_NAME + 'car_listing.html', {'car': current_car})
-    except Http404:
+    # the last change of the car and its ready images are read on every request, as they may be
+    # changed by a process not sharing the cache, with what the buttons shown to the user depend on
+    state = with_image_ids(Car.objects.filter(pk=car_id)).values_list('updated_at', 'image_ids', 'status', 'owner_id').first()
+    if state is None:
         return render(request, APP_NAME + 'error_page.html')
+    updated_at, image_ids, status, owner_id = state
+    key = car_listing_cache_key(car_id, updated_at, image_ids)
+    car_detail = cache.get(key)
+    context = {}
 
-# all car listings view
+    if car_detail is None:
+        try:
+            cars = with_seller_rating(Car.objects.select_related('model__brand', 'fuel_type', 'transmission', 'owner'))
+            cars = with_images(cars)
+            current_car = get_object_or_404(cars, id=car_id)
+        except Http404:
+            return render(request, APP_NAME + 'error_page.html')
+        car_detail = render_to_string(APP_NAME + 'car_listing_detail.html', {'car': current_car})
+        cache.set(key, car_detail, settings.CAR_LISTING_CACHE_TIMEOUT)
+        context['car'] = current_car
+
+    context['car_detail'] = mark_safe(car_detail)
+    # the wishlist button is per user, so it is left out of the cached details
+    context['car_id'] = car_id
+    context['is_owner'] = request.user.is_authenticated and owner_id == request.user.pk
+    # only an available car of another user can be ordered
+    context['can_order'] = request.user.is_authenticated and not context['is_owner'] and status == 'AVAILABLE'
+    context['in_wishlist'] = car_id in wishlisted_car_ids(request.user, [car_id])
+    return render(request, APP_NAME + 'car_listing.html', context)
+
+# the only fields loaded for the car cards of the listing pages
+CAR_CARD_FIELDS = (
+    'id', 'price', 'condition',
+    'model__name', 'model__brand__name',
+    'owner__first_name', 'owner__last_name',
+)
+
+def car_cards(cars):
+    '''
+    The cars with what their cards show, in one query: the card fields, the
+    seller's rating and the cover image.
+    '''
+    return with_cover_image(with_seller_rating(cars.select_related('model__brand', 'owner').only(*CAR_CARD_FIELDS)))
+
+# sort options for the car listings, mapped to the keyset ordering
+CAR_LISTINGS_SORTS = {
+    'newest': '-id',
+    'price': 'price',
+    '-price': '-price',
+}
+
+# all car listings view, paginated by cursor
 def car_listings_view(request):
-    all_car_listings = Car.objects.all()
+    sort = request.GET.get('sort', 'newest')
+    if sort not in CAR_LISTINGS_SORTS:
+        sort = 'newest'
+
+    all_car_listings = car_cards(Car.objects.all())
     # if request.user.is_authenticated: # dont show logged in users listings
     #     user = request.user
     #     all_car_listings = all_car_listings.exclude(owner=user)
 
-    return render(request, APP_NAME + 'car_listings.html', {'all_car_listings': all_car_listings})
+    page_size = get_page_size(request, settings.CAR_LISTINGS_PAGE_SIZE, settings.CAR_LISTINGS_MAX_PAGE_SIZE)
+    paginator = KeysetPaginator(all_car_listings, CAR_LISTINGS_SORTS[sort], page_size)
+    page = paginator.page(request.GET.get('cursor'))
+
+    return render(request, APP_NAME + 'car_listings.html', {
+        'all_car_listings': mark_wishlisted(request.user, page.object_list),
+        'page': page,
+        'sort': sort,
+        'page_size': page_size,
+    })
+
+# car search with filters, sorting and facet counts
+def search_view(request):
+    form = CarSearchForm(request.GET)
+    context = {'search_form': form}
+
+    if form.is_valid():
+        results = filter_cars(Car.objects.all(), form.cleaned_data)
+        keywords = form.cleaned_data['q']
+        if keywords:
+            results = keyword_search(results, keywords)
+        total, facets = get_facets(results)
+
+        # cars are only ranked by relevance to keywords
+        sort = form.cleaned_data['sort'] or ('relevance' if keywords else 'newest')
+        if sort == 'relevance' and not keywords:
+            sort = 'newest'
+        results = car_cards(results)
+        page_size = get_page_size(request, settings.CAR_LISTINGS_PAGE_SIZE, settings.CAR_LISTINGS_MAX_PAGE_SIZE)
+        page = KeysetPaginator(results, SEARCH_SORTS[sort], page_size).page(request.GET.get('cursor'))
+
+        # the query string of every facet value, applied on top of the current filters
+        for name, values in facets.items():
+            for facet in values:
+                query = request.GET.copy()
+                query.pop('cursor', None)
+                if name == 'year':
+                    query['year_min'] = query['year_max'] = facet['value']
+                else:
+                    query[name] = facet['value']
+                facet['query'] = query.urlencode()
+
+        next_query = request.GET.copy()
+        next_query['cursor'] = page.next_cursor or ''
+
+        context.update({
+            'results': mark_wishlisted(request.user, page.object_list),
+            'page': page,
+            'total': total,
+            'facets': facets,
+            'next_query': next_query.urlencode(),
+        })
+
+    return render(request, APP_NAME + 'search.html', context)
+
+# cars matching the preference of the user, from the cached matching car ids
+@login_required
+def preference_matches_view(request):
+    car_ids = get_matching_car_ids(request.user)
+
+    # the ids are sorted newest first, so the cursor is the last id of the previous page
+    try:
+        cursor = int(request.GET.get('cursor', ''))
+    except ValueError:
+        cursor = None
+    if cursor is not None:
+        car_ids = [car_id for car_id in car_ids if car_id < cursor]
+
+    page_size = get_page_size(request, settings.CAR_LISTINGS_PAGE_SIZE, settings.CAR_LISTINGS_MAX_PAGE_SIZE)
+    page_ids = car_ids[:page_size]
+    cars = car_cards(Car.objects.all()).in_bulk(page_ids)
+
+    return render(request, APP_NAME + 'preference_matches.html', {
+        'matches': mark_wishlisted(request.user, [cars[car_id] for car_id in page_ids if car_id in cars]),
+        'next_cursor': page_ids[-1] if len(car_ids) > page_size else None,
+        'page_size': page_size,
+    })
+
+# the cars in the wishlist of the user, newest first and paginated by cursor
+@login_required
+def wishlist_view(request):
+    cars = car_cards(Car.objects.filter(wishlists=request.user.pk))
+    page_size = get_page_size(request, settings.CAR_LISTINGS_PAGE_SIZE, settings.CAR_LISTINGS_MAX_PAGE_SIZE)
+    page = KeysetPaginator(cars, '-id', page_size).page(request.GET.get('cursor'))
+    for car in page:
+        car.in_wishlist = True
+
+    return render(request, APP_NAME + 'wishlist.html', {
+        'wishlist': page.object_list,
+        'page': page,
+        'page_size': page_size,
+    })
+
+def redirect_back(request, *default):
+    '''
+    Redirect to the page the button was pressed on, or to the default page.
+    '''
+    next_url = request.POST.get('next')
+    if next_url and url_has_allowed_host_and_scheme(next_url, allowed_hosts={request.get_host()}, require_https=request.is_secure()):
+        return redirect(next_url)
+    return redirect(*default)
+
+@login_required
+@require_POST
+def wishlist_add_view(request, car_id):
+    if not Car.objects.filter(pk=car_id).exists():
+        return render(request, APP_NAME + 'error_page.html')
+    add_to_wishlist(request.user, car_id)
+    return redirect_back(request, 'wishlist')
+
+@login_required
+@require_POST
+def wishlist_remove_view(request, car_id):
+    remove_from_wishlist(request.user, car_id)
+    return redirect_back(request, 'wishlist')
+
+# order a car, the car is held for the buyer until the seller completes or cancels the order
+@login_required
+@require_POST
+def order_car_view(request, car_id):
+    try:
+        place_order(request.user, car_id)
+    except OrderError as error:
+        messages.error(request, str(error))
+    else:
+        messages.success(request, "Your order has been placed, the car is held for you until the seller completes it.")
+    return redirect('car_listing', car_id=car_id)
+
+@login_required
+@require_POST
+def complete_order_view(request, order_id):
+    try:
+        complete_order(order_id, request.user)
+    except OrderError as error:
+        messages.error(request, str(error))
+    else:
+        messages.success(request, "The order is completed and the car is sold.")
+    return redirect_back(request, 'sales_orders')
+
+@login_required
+@require_POST
+def cancel_order_view(request, order_id):
+    try:
+        cancel_order(order_id, request.user)
+    except OrderError as error:
+        messages.error(request, str(error))
+    else:
+        messages.success(request, "The order is cancelled and the car is available again.")
+    return redirect_back(request, 'purchase_orders')
+
+# the other party of the orders on each dashboard
+ORDER_COUNTERPARTY = {
+    'sales': 'buyer',
+    'purchases': 'seller',
+}
+
+# the orders of a user as a seller or as a buyer, with their stats
+@login_required
+def order_dashboard_view(request, role):
+    orders = Order.objects.filter(**{ORDER_ROLES[role]: request.user}).select_related('car__model__brand', ORDER_COUNTERPARTY[role])
+    status = request.GET.get('status', '')
+    if status in dict(Order.ORDER_STATUS):
+        orders = orders.filter(status=status)
+    else:
+        status = ''
+
+    page_size = get_page_size(request, settings.CAR_LISTINGS_PAGE_SIZE, settings.CAR_LISTINGS_MAX_PAGE_SIZE)
+    page = KeysetPaginator(orders, '-id', page_size).page(request.GET.get('cursor'))
+
+    return render(request, APP_NAME + 'order_dashboard.html', {
+        'role': role,
+        'orders': page.object_list,
+        'page': page,
+        'page_size': page_size,
+        'status': status,
+        'statuses': Order.ORDER_STATUS,
+        'stats': get_order_stats(role, request.user),
+    })
+
+# the images of a car, uploaded by its owner
+@login_required
+def car_images_view(request, car_id):
+    car = Car.objects.select_related('model__brand').filter(pk=car_id, owner=request.user).first()
+    if car is None:
+        return render(request, APP_NAME + 'error_page.html')
+
+    if request.method == 'POST':
+        form = CarImageUploadForm(request.POST, request.FILES)
+        if form.is_valid():
+            for image in form.cleaned_data['images']:
+                save_car_image(car, image)
+            messages.success(request, "The images are uploaded, their thumbnails will be ready shortly.")
+            return redirect('car_images', car_id=car.pk)
+    else:
+        form = CarImageUploadForm()
+
+    return render(request, APP_NAME + 'car_images.html', {
+        'car': car,
+        'form': form,
+        'images': car.files.order_by('id'),
+    })
+
+@login_required
+@require_POST
+def car_image_delete_view(request, car_id, file_id):
+    Car_File.objects.filter(pk=file_id, car_id=car_id, car__owner=request.user).delete()
+    return redirect('car_images', car_id=car_id)
+
+# the number of row errors shown after an import
+CAR_IMPORT_ERRORS_SHOWN = 100
+
+# bulk import of a dealer's cars from a CSV or JSON lines file
+@login_required
+def car_import_view(request):
+    report = None
+    if request.method == 'POST':
+        form = CarImportUploadForm(request.POST, request.FILES)
+        if form.is_valid():
+            file = form.cleaned_data['file']
+            format = 'csv' if file.name.lower().endswith('.csv') else 'jsonl'
+            report = import_cars(decode_lines(file), format, request.user, create_lookups=form.cleaned_data['create_lookups'])
+    else:
+        form = CarImportUploadForm()
+
+    return render(request, APP_NAME + 'car_import.html', {
+        'form': form,
+        'report': report,
+        'errors': report.errors[:CAR_IMPORT_ERRORS_SHOWN] if report else [],
+    })
+
+# export of every car for analytics, streamed as it is read from the database
+@staff_member_required
+def car_export_view(request):
+    format = request.GET.get('format', 'csv')
+    if format not in EXPORT_FORMATS:
+        format = 'csv'
+
+    content_type = 'text/csv' if format == 'csv' else 'application/x-ndjson'
+    response = StreamingHttpResponse(export_lines(format), content_type=content_type)
+    response['Content-Disposition'] = 'attachment; filename="cars.{}"'.format(format)
+    return response
+
+# the request metrics of this process for Prometheus, recorded by instrumentation.PerformanceMiddleware
+@require_safe
+def metrics_view(request):
+    if not settings.PERFORMANCE_METRICS:
+        raise Http404
+    token = settings.PERFORMANCE_METRICS_TOKEN
+    if token and not constant_time_compare(request.headers.get('Authorization', ''), 'Bearer ' + token):
+        response = HttpResponse(status=401)
+        response['WWW-Authenticate'] = 'Bearer'
+        return response
+    return HttpResponse(render_metrics(), content_type='text/plain; version=0.0.4; charset=utf-8')
 
 class CarCreateView(LoginRequiredMixin, CreateView):
     model = Car
     success_url = 'index'
     form_class = CarForm
 
+    def get_form_kwargs(self):
+        kwargs = super().get_form_kwargs()
+        kwargs['lazy_models'] = True
+        return kwargs
+
+    def get_success_url(self):
+        # the images are uploaded once the car is created
+        return reverse('car_images', args=[self.object.pk])
+
     def form_valid(self, form):
         form.instance.owner = self.request.user
         return super().form_valid(form)
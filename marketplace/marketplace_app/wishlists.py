@@ -0,0 +1,34 @@
+from .models import Wishlist
+
+# the rows linking the wishlists to their cars, the primary key of a wishlist is its user id
+WishlistCar = Wishlist.cars.through
+
+def add_to_wishlist(user, car_id):
+    '''
+    Add a car to the wishlist of a user, creating the wishlist on first use.
+    Adding a car twice keeps a single row.
+    '''
+    wishlist, _ = Wishlist.objects.get_or_create(user=user)
+    wishlist.cars.add(car_id)
+
+def remove_from_wishlist(user, car_id):
+    WishlistCar.objects.filter(wishlist_id=user.pk, car_id=car_id).delete()
+
+def wishlisted_car_ids(user, car_ids):
+    '''
+    The ids of the given cars that are in the wishlist of the user, read in
+    one query for a whole page of cars.
+    '''
+    if not user.is_authenticated or not car_ids:
+        return set()
+    return set(WishlistCar.objects.filter(wishlist_id=user.pk, car_id__in=car_ids).values_list('car_id', flat=True))
+
+def mark_wishlisted(user, cars):
+    '''
+    Set in_wishlist on each car of a page, for the wishlist buttons of the car cards.
+    '''
+    cars = list(cars)
+    car_ids = wishlisted_car_ids(user, [car.pk for car in cars])
+    for car in cars:
+        car.in_wishlist = car.pk in car_ids
+    return cars